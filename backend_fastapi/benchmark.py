@@ -0,0 +1,345 @@
+"""
+VeriFin offline benchmark
+Load-tests the API in-process with deterministic local stand-ins for yfinance and Gemini,
+so throughput and latency can be measured without network access or API quotas.
+
+Usage:
+    python benchmark.py                                  # all scenarios, defaults
+    python benchmark.py --scenarios company-overview chat --concurrency 32 --requests 500
+    python benchmark.py --yf-latency-ms 200 --yf-error-rate 0.05 --json results.json
+    python benchmark.py --baseline results.json --max-regression 0.2   # exit 1 on p95 regression
+"""
+
+import argparse
+import asyncio
+import atexit
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+# Keep the app quiet while it is being hammered
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+# Every run starts from a cold per-process cache (CACHE_BACKEND=sqlite measures the shared store)
+os.environ.setdefault("CACHE_BACKEND", "memory")
+os.environ.setdefault("CACHE_WARMUP", "false")
+os.environ.setdefault("SCREENER_REFRESH_SECONDS", "0")
+os.environ.setdefault("REFRESH_AHEAD", "false")
+# Fake market data must never reach the real cache / last-known-good files (or their signing key)
+_SCRATCH_DIR = tempfile.mkdtemp(prefix="verifin-bench-")
+atexit.register(shutil.rmtree, _SCRATCH_DIR, True)
+os.environ.setdefault("CACHE_PATH", os.path.join(_SCRATCH_DIR, "cache.sqlite3"))
+os.environ.setdefault("LKG_PATH", os.path.join(_SCRATCH_DIR, "lkg.sqlite3"))
+os.environ.setdefault("CACHE_SECRET", os.urandom(16).hex())
+
+import numpy as np
+import pandas as pd
+import httpx
+
+
+# ==================== FAKE UPSTREAMS ====================
+class LatencyModel:
+    """
+    Log-normal latency around a median plus an independent error probability.
+    Seeded and lock-protected so runs are reproducible across executor threads.
+    """
+    def __init__(self, median_ms: float, sigma: float, error_rate: float, seed: int):
+        self.median_ms = median_ms
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def wait(self, what: str):
+        with self._lock:
+            delay = self.median_ms * math.exp(self._rng.gauss(0, self.sigma)) / 1000 if self.median_ms > 0 else 0
+            fail = self._rng.random() < self.error_rate
+        time.sleep(delay)
+        if fail:
+            raise Exception(f"Too Many Requests (simulated {what} failure)")
+
+
+def _base_price(symbol: str) -> float:
+    return 50.0 + (sum(map(ord, symbol)) % 400) * 7.5
+
+
+class FakeFastInfo:
+    def __init__(self, ticker: "FakeTicker"):
+        self._ticker = ticker
+        self._loaded = False
+
+    def _load(self):
+        if not self._loaded:
+            self._ticker.latency.wait("fast_info")
+            self._loaded = True
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        self._load()
+        price = _base_price(self._ticker.symbol)
+        values = {
+            "last_price": price,
+            "previous_close": price * 0.99,
+            "market_cap": price * 1_000_000_000,
+            "last_volume": 1_500_000,
+            "year_high": price * 1.25,
+            "year_low": price * 0.8,
+        }
+        if name not in values:
+            raise AttributeError(name)
+        return values[name]
+
+
+class FakeTicker:
+    """Subset of yfinance.Ticker used by main.py, with synthetic but stable data"""
+    def __init__(self, symbol: str, latency: LatencyModel):
+        self.symbol = symbol
+        self.latency = latency
+        self.fast_info = FakeFastInfo(self)
+
+    def history(self, period=None, start=None, end=None, interval="1d", **kwargs):
+        self.latency.wait("history")
+        days = {"1d": 1, "5d": 5, "1mo": 30, "1y": 365, "5y": 5 * 365}.get(period, 365)
+        end = end or datetime.now()
+        start = start or end - timedelta(days=days)
+        freq = {"1mo": "MS", "1wk": "W"}.get(interval, "B")
+        index = pd.date_range(start=start, end=end, freq=freq)
+        if len(index) == 0:
+            index = pd.DatetimeIndex([pd.Timestamp(end).normalize()])
+        rng = np.random.default_rng(sum(map(ord, self.symbol)))
+        close = _base_price(self.symbol) * np.exp(np.cumsum(rng.normal(0, 0.01, len(index))))
+        return pd.DataFrame({
+            "Open": close * 0.995,
+            "High": close * 1.01,
+            "Low": close * 0.99,
+            "Close": close,
+            "Volume": rng.integers(100_000, 5_000_000, len(index)),
+        }, index=index)
+
+    @property
+    def info(self):
+        self.latency.wait("info")
+        price = _base_price(self.symbol)
+        return {
+            "sector": "Technology",
+            "industry": "Software",
+            "longBusinessSummary": f"{self.symbol} is a synthetic benchmark company.",
+            "website": "https://example.com",
+            "fullTimeEmployees": 12000,
+            "trailingPE": 18 + (sum(map(ord, self.symbol)) % 20),
+            "dividendYield": 0.012,
+            "marketCap": price * 1_000_000_000,
+            "volume": 1_500_000,
+            "enterpriseValue": price * 1_100_000_000,
+            "returnOnEquity": 0.18,
+            "profitMargins": 0.21,
+            "totalRevenue": price * 80_000_000,
+        }
+
+    @property
+    def financials(self):
+        self.latency.wait("financials")
+        years = [pd.Timestamp(year=datetime.now().year - i, month=3, day=31) for i in range(1, 5)]
+        revenue = [_base_price(self.symbol) * 80_000_000 * (1 - 0.08 * i) for i in range(4)]
+        return pd.DataFrame(
+            [revenue, [r * 0.15 for r in revenue]],
+            index=["Total Revenue", "Net Income"],
+            columns=years
+        )
+
+
+class FakeYFinance:
+    """Drop-in for the yfinance module as used by main.py"""
+    def __init__(self, latency: LatencyModel):
+        self.latency = latency
+
+    def Ticker(self, symbol: str):
+        return FakeTicker(symbol, self.latency)
+
+    def download(self, tickers, period="5d", interval="1d", group_by="ticker", **kwargs):
+        """One batched call: columns are (ticker, field) like yf.download(group_by="ticker")"""
+        self.latency.wait("download")
+        tickers = [tickers] if isinstance(tickers, str) else list(tickers)
+        frames = {}
+        for symbol in tickers:
+            ticker = FakeTicker(symbol, LatencyModel(0, 0, 0, seed=0))
+            frames[symbol] = ticker.history(period=period, interval=interval)
+        return pd.concat(frames, axis=1)
+
+
+class FakeGeminiResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeGeminiModel:
+    """Stand-in for genai.GenerativeModel: canned chat text, or analysis JSON for document prompts"""
+    def __init__(self, latency: LatencyModel):
+        self.latency = latency
+
+    def generate_content(self, prompt: str):
+        self.latency.wait("gemini")
+        if "RETURN JSON FORMAT ONLY" in prompt:
+            return FakeGeminiResponse(json.dumps({
+                "document_type": "Annual Report",
+                "company_name": "Benchmark Industries Limited",
+                "financial_data": {"revenue": "5000 Crore", "net_profit": "750 Crore", "total_assets": "12000 Crore", "eps": "42.5"},
+                "sentiment": "Positive",
+                "insights": ["Revenue grew steadily", "Margins expanded", "Debt reduced"],
+                "summary": "Synthetic benchmark summary."
+            }))
+        return FakeGeminiResponse("Synthetic benchmark answer about diversification and P/E ratios.")
+
+
+def install_fakes(main, args) -> None:
+    """Swap main.py's upstream clients for the local fakes"""
+    main.yf = FakeYFinance(LatencyModel(args.yf_latency_ms, args.latency_sigma, args.yf_error_rate, args.seed))
+    main.gemini_model = FakeGeminiModel(LatencyModel(args.gemini_latency_ms, args.latency_sigma, args.gemini_error_rate, args.seed + 1))
+    main.upstream = main.UpstreamScheduler(args.upstream_rate, max(1, int(args.upstream_rate * 2)))
+
+
+def make_pdf(pages: int) -> bytes:
+    """Small synthetic annual report used by the document scenario"""
+    import fitz
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Benchmark Industries Limited\nAnnual Report - page {i + 1}\n"
+                                   f"Revenue: Rs. {5000 + i},00 crore, strong growth despite some risk.\n"
+                                   f"Net profit: {750 + i} crore.", fontsize=10)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+# ==================== SCENARIOS ====================
+COMPANIES = ["Apple", "Microsoft", "TCS", "Reliance", "Infosys", "Tesla", "HDFC Bank", "Nvidia", "Wipro", "Amazon"]
+
+
+def build_scenarios(args):
+    rng = random.Random(args.seed)
+    pdf = make_pdf(args.pdf_pages)
+    return {
+        "resolve-company": lambda: ("POST", "/resolve-company", {"json": {"query": rng.choice(COMPANIES)}}),
+        "company-overview": lambda: ("POST", "/company-overview", {"json": {"query": rng.choice(COMPANIES)}}),
+        "company-compare": lambda: ("POST", "/company-compare", {"json": {"company1": rng.choice(COMPANIES), "company2": rng.choice(COMPANIES)}}),
+        "market-indices": lambda: ("GET", "/market-indices", {}),
+        "chat": lambda: ("POST", "/chat", {"json": {"message": "How should I compare P/E ratios?"}}),
+        "document-analyze-upload": lambda: ("POST", "/document-analyze-upload", {"files": {"file": ("bench.pdf", pdf, "application/pdf")}}),
+    }
+
+
+def percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    rank = max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)
+    return sorted_values[rank]
+
+
+async def run_scenario(client: httpx.AsyncClient, make_request, concurrency: int, total: int):
+    latencies = []
+    errors = 0
+    remaining = total
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            method, path, kwargs = make_request()
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, path, **kwargs)
+                if response.status_code >= 400:
+                    errors += 1
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+async def run(args):
+    import main
+    install_fakes(main, args)
+    scenarios = build_scenarios(args)
+    selected = args.scenarios or list(scenarios)
+    unknown = [s for s in selected if s not in scenarios]
+    if unknown:
+        raise SystemExit(f"Unknown scenarios: {', '.join(unknown)}")
+
+    results = {}
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=120) as client:
+            for name in selected:
+                # Warm-up pass so one-off costs (imports, first connections) don't skew the numbers
+                await run_scenario(client, scenarios[name], min(args.concurrency, 4), min(args.requests, 4))
+                results[name] = await run_scenario(client, scenarios[name], args.concurrency, args.requests)
+                print(f"{name:<26} {results[name]['rps']:>8} rps  p50 {results[name]['p50_ms']:>9} ms  "
+                      f"p95 {results[name]['p95_ms']:>9} ms  p99 {results[name]['p99_ms']:>9} ms  "
+                      f"errors {results[name]['errors']}", flush=True)
+    return results
+
+
+def compare_to_baseline(results, baseline_path: str, max_regression: float) -> bool:
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    ok = True
+    for name, current in results.items():
+        if name not in baseline or not baseline[name]["p95_ms"]:
+            continue
+        change = current["p95_ms"] / baseline[name]["p95_ms"] - 1
+        if change > max_regression:
+            print(f"REGRESSION {name}: p95 {baseline[name]['p95_ms']} ms -> {current['p95_ms']} ms (+{change:.0%})")
+            ok = False
+    return ok
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Offline VeriFin API load test")
+    parser.add_argument("--scenarios", nargs="*", help="Scenarios to run (default: all)")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario")
+    parser.add_argument("--yf-latency-ms", type=float, default=80.0, help="Median fake yfinance latency")
+    parser.add_argument("--yf-error-rate", type=float, default=0.0, help="Fraction of fake yfinance calls failing with 429")
+    parser.add_argument("--upstream-rate", type=float, default=1000.0,
+                        help="Upstream scheduler rate (req/s); lower it to exercise queueing and backoff")
+    parser.add_argument("--gemini-latency-ms", type=float, default=600.0, help="Median fake Gemini latency")
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0)
+    parser.add_argument("--latency-sigma", type=float, default=0.35, help="Log-normal spread of fake latencies")
+    parser.add_argument("--pdf-pages", type=int, default=20, help="Pages in the synthetic upload")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="Write results to this file")
+    parser.add_argument("--baseline", help="Compare against a previous --json result")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="Allowed p95 increase vs baseline")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+    if args.baseline and not compare_to_baseline(results, args.baseline, args.max_regression):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
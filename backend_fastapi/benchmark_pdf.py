@@ -0,0 +1,270 @@
+"""
+VeriFin document analyzer micro-benchmark
+Generates a synthetic PDF corpus locally with PyMuPDF (10, 100, 1000 and 5000 pages by default),
+runs each document through the analysis pipeline with Gemini stubbed out, and reports the time
+and peak RSS of every stage.
+
+Stages:
+    read       load the file into memory (what the upload endpoint does)
+    open       fitz.open
+    text       per-page text extraction
+    scan       single-pass signal scanner (keywords, doc type, revenue/profit regexes)
+    tables     statement table detection on candidate pages
+    llm        stubbed Gemini call (prompt building + --llm-latency-ms)
+    score      merge + response build
+    serialize  JSON rendering of the response
+
+Each document is also checked against the original full-text keyword/regex fallback: the
+scanner's sentiment counts and figures must match it exactly (exit 1 otherwise).
+
+Usage:
+    python benchmark_pdf.py
+    python benchmark_pdf.py --pages 100 1000 --repeat 5 --json pdf_results.json
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+# Importing benchmark also points CACHE_PATH, LKG_PATH and CACHE_SECRET at a throwaway
+# temp dir, so stubbed results never land in the real stores
+from benchmark import FakeGeminiModel, LatencyModel
+
+FILLER = (
+    "The company delivered strong growth in its core segments while managing risk across markets. "
+    "Revenue from operations improved on higher volumes, although input costs led to a decline in "
+    "margins for the commodities business. The board remains focused on profit, cash generation and "
+    "capital allocation. "
+)
+
+
+# ==================== CORPUS ====================
+def _draw_statement(page, title: str, rows):
+    page.insert_text((72, 60), title, fontsize=11)
+    x = [72, 292, 342, 442, 542]
+    y = 90
+    for row in rows:
+        for i, cell in enumerate(row):
+            page.insert_text((x[i] + 3, y + 14), cell, fontsize=8)
+        page.draw_line((x[0], y), (x[-1], y))
+        y += 20
+    page.draw_line((x[0], y), (x[-1], y))
+    for xi in x:
+        page.draw_line((xi, 90), (xi, y))
+
+
+def generate_pdf(path: str, pages: int):
+    """Annual-report-like document: narrative pages, a statement every 100 pages, a scanned page every 50"""
+    import fitz
+    doc = fitz.open()
+    scan = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 64, 64), False)
+    scan.clear_with(220)
+    for i in range(pages):
+        page = doc.new_page()
+        if i == 0:
+            page.insert_text((72, 72), "Benchmark Industries Limited\nAnnual Report 2024-25", fontsize=16)
+        elif i % 100 == 10:
+            _draw_statement(page, "Statement of Profit and Loss for the year ended 31 March 2025", [
+                ["Particulars", "Note", "FY2025", "FY2024"],
+                ["Revenue from operations", "23", f"{50000 + i:,}.00", "45,120.00"],
+                ["Other income", "24", "1,210.00", "980.00"],
+                ["Total expenses", "25", "41,500.00", "38,200.00"],
+                ["Profit for the year", "", f"{7500 + i:,}.00", "6,400.00"],
+                ["Basic EPS", "", "42.10", "36.20"],
+            ])
+        elif i % 50 == 25:
+            page.insert_image(fitz.Rect(36, 36, 576, 756), pixmap=scan)
+        else:
+            text = f"Management discussion - page {i + 1}\n" + "\n".join(FILLER[j:j + 95] for j in range(0, len(FILLER), 95)) * 6
+            page.insert_text((50, 60), text, fontsize=8)
+    doc.save(path, garbage=3, deflate=True)
+    doc.close()
+
+
+def corpus_path(corpus_dir: str, pages: int) -> str:
+    path = os.path.join(corpus_dir, f"verifin_bench_{pages}p.pdf")
+    if not os.path.exists(path):
+        started = time.perf_counter()
+        generate_pdf(path, pages)
+        print(f"generated {path} ({os.path.getsize(path) / 1e6:.1f} MB) in {time.perf_counter() - started:.1f}s", flush=True)
+    return path
+
+
+# ==================== PROFILER ====================
+class RssSampler(threading.Thread):
+    """Samples this process's RSS every few ms and keeps the peak per labelled stage"""
+    def __init__(self, interval: float = 0.002):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stage = None
+        self.peaks = {}
+        self._running = True
+        self._page_size = os.sysconf("SC_PAGE_SIZE")
+
+    def rss(self) -> int:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * self._page_size
+
+    def mark(self, stage):
+        """Switch the stage new samples are attributed to (sampled once right away)"""
+        self.stage = stage
+        if stage:
+            self.peaks[stage] = max(self.peaks.get(stage, 0), self.rss())
+
+    def run(self):
+        while self._running:
+            stage = self.stage
+            if stage:
+                self.peaks[stage] = max(self.peaks.get(stage, 0), self.rss())
+            time.sleep(self.interval)
+
+    def stop(self):
+        self._running = False
+
+
+def profile_document(main, path: str, sampler: RssSampler):
+    timings = {}
+    clock = time.perf_counter
+
+    sampler.mark("read")
+    started = clock()
+    with open(path, "rb") as f:
+        contents = f.read()
+    timings["read"] = clock() - started
+
+    stage_started = {}
+
+    def on_stage(stage, status):
+        if status == "running":
+            sampler.mark(stage)
+            stage_started[stage] = clock()
+        else:
+            timings[stage] = clock() - stage_started[stage]
+
+    # Keep the extracted sub-stage timings (open/text/scan/tables) from the pipeline itself
+    extract_document = main.extract_document
+    extracted_timings = {}
+
+    def timed_extract(source, **kwargs):
+        extracted = extract_document(source, **kwargs)
+        extracted_timings.update(extracted["timings"])
+        return extracted
+
+    main.extract_document = timed_extract
+    try:
+        result = main.run_document_analysis(contents, os.path.basename(path), on_stage)
+    finally:
+        main.extract_document = extract_document
+
+    sampler.mark("serialize")
+    started = clock()
+    body = main.FastJSONResponse(result).body
+    timings["serialize"] = clock() - started
+    sampler.mark(None)
+
+    for name in ("open", "text", "scan", "tables"):
+        timings[name] = extracted_timings.get(name, 0.0)
+    timings["total"] = timings["read"] + timings["extract"] + timings["llm"] + timings["score"] + timings["serialize"]
+    return timings, result, len(body)
+
+
+# ==================== SCANNER CHECK ====================
+def baseline_signals(page_texts):
+    """The original fallback: one lowercased full text, str.count sentiment and re.search figures"""
+    import re
+    text_lower = "\n".join(page_texts).lower()
+    rev = re.search(r'revenue[:\s]+(?:rs\.?|₹)?\s*([\d,]+\.?\d*)', text_lower)
+    profit = re.search(r'(?:net profit|pat)[:\s]+(?:rs\.?|₹)?\s*([\d,]+\.?\d*)', text_lower)
+    return {
+        "positive": sum(text_lower.count(w) for w in ['growth', 'profit', 'strong']),
+        "negative": sum(text_lower.count(w) for w in ['loss', 'decline', 'risk']),
+        "revenue": rev.group(1) if rev else None,
+        "net_profit": profit.group(1) if profit else None,
+    }
+
+
+def check_scanner(main, path: str) -> dict:
+    """Scanner counts/figures must equal the baseline's (exit 1 otherwise); returns both timings"""
+    import fitz
+    with fitz.open(path) as doc:
+        page_texts = [page.get_text() for page in doc]
+    started = time.perf_counter()
+    expected = baseline_signals(page_texts)
+    baseline_ms = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    scanner = main.DocumentSignalScanner()
+    for number, text in enumerate(page_texts, 1):
+        scanner.scan_page(number, text)
+    scanner_ms = (time.perf_counter() - started) * 1000
+
+    actual = {
+        "positive": scanner.positive_count,
+        "negative": scanner.negative_count,
+        "revenue": scanner.values.get("revenue"),
+        "net_profit": scanner.values.get("net_profit"),
+    }
+    if actual != expected:
+        raise SystemExit(f"scanner mismatch on {path}: {actual} != baseline {expected}")
+    return {"baseline_ms": round(baseline_ms, 1), "scanner_ms": round(scanner_ms, 1), **actual}
+
+
+STAGES = ("read", "open", "text", "scan", "tables", "llm", "score", "serialize", "total")
+RSS_STAGES = ("read", "extract", "llm", "score", "serialize")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Per-stage profile of the VeriFin document analyzer")
+    parser.add_argument("--pages", type=int, nargs="*", default=[10, 100, 1000, 5000])
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per document (median reported)")
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0, help="Latency of the stubbed Gemini call")
+    parser.add_argument("--corpus-dir", default=os.path.join(tempfile.gettempdir(), "verifin_pdf_corpus"))
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    import main
+    main.gemini_model = FakeGeminiModel(LatencyModel(args.llm_latency_ms, 0.0, 0.0, seed=1))
+    os.makedirs(args.corpus_dir, exist_ok=True)
+
+    sampler = RssSampler()
+    sampler.start()
+    results = {}
+    header = f"{'pages':>6} " + " ".join(f"{s:>10}" for s in STAGES) + "   (ms)"
+    print(header)
+    for pages in args.pages:
+        path = corpus_path(args.corpus_dir, pages)
+        runs = []
+        for _ in range(args.repeat):
+            sampler.peaks.clear()
+            timings, result, body_size = profile_document(main, path, sampler)
+            runs.append((timings, dict(sampler.peaks)))
+        median = {s: sorted(r[0][s] for r in runs)[len(runs) // 2] for s in STAGES}
+        peak_rss = {s: max(r[1].get(s, 0) for r in runs) for s in RSS_STAGES}
+        results[pages] = {
+            "file_mb": round(os.path.getsize(path) / 1e6, 2),
+            "stage_ms": {s: round(v * 1000, 2) for s, v in median.items()},
+            "peak_rss_mb": {s: round(v / 1e6, 1) for s, v in peak_rss.items()},
+            "response_bytes": body_size,
+            "scanned_pages": len(result["scanned_pages"]),
+            "statement_tables": len(result["financial_statements"]),
+            "scanner_check": check_scanner(main, path),
+        }
+        print(f"{pages:>6} " + " ".join(f"{median[s] * 1000:>10.1f}" for s in STAGES))
+        check = results[pages]["scanner_check"]
+        print(f"{'':>6} scanner matches baseline (pos {check['positive']}, neg {check['negative']}): "
+              f"{check['scanner_ms']} ms vs {check['baseline_ms']} ms full-text baseline")
+        print(f"{'':>6} peak RSS MB: " + ", ".join(f"{s} {results[pages]['peak_rss_mb'][s]}" for s in RSS_STAGES), flush=True)
+    sampler.stop()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
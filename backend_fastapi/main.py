@@ -3,17 +3,41 @@ VeriFin FastAPI Backend
 Free hosting on Render.com
 """
 
-from fastapi import FastAPI, HTTPException, File, UploadFile
+from fastapi import FastAPI, HTTPException, File, UploadFile, Query, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, NamedTuple
 import os
 import asyncio
+from contextlib import asynccontextmanager, contextmanager
 from dotenv import load_dotenv
 import httpx
-from rapidfuzz import fuzz
+from rapidfuzz import fuzz, process
 import time
 import math
+import operator
+import re
+import json
+import uuid
+import binascii
+import threading
+import logging
+import queue
+import sys
+import atexit
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ThreadPoolExecutor
+import tempfile
+import hashlib
+import hmac
+import heapq
+import itertools
+import contextvars
+import pickle
+import sqlite3
+import zlib
+from collections import Counter, OrderedDict, deque
 
 def clean_float(val):
     """Sanitize float values for JSON compliance (no NaN/Inf)"""
@@ -25,17 +49,285 @@ def clean_float(val):
         return f
     except:
         return 0.0
-import yfinance as yf
+import importlib
+import importlib.util
+
+class LazyModule:
+    """Module stand-in that imports the real module on first attribute access (keeps cold start fast)"""
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+# yfinance pulls in pandas/numpy; imported on the first market data call
+yf = LazyModule("yfinance")
+np = LazyModule("numpy")
 from datetime import datetime, timedelta
 
 # Load environment variables
 load_dotenv()
 
+# Background services register start/stop coroutines here; they run in the app lifespan
+startup_hooks: List[Any] = []
+shutdown_hooks: List[Any] = []
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    for hook in startup_hooks:
+        await hook()
+    yield
+    for hook in reversed(shutdown_hooks):
+        await hook()
+
+# ==================== METRICS ====================
+# In-process Prometheus registry. Timing spans around every upstream call (yfinance,
+# Gemini), PDF stages and response serialization feed one histogram, exposed on /metrics.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Metrics:
+    """Minimal thread-safe registry of labelled counters, histograms and callback gauges"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta: Dict[str, tuple] = {}  # name -> (type, help)
+        self._counters: Dict[tuple, float] = {}
+        self._histograms: Dict[tuple, List[float]] = {}  # bucket counts..., +Inf, sum
+        self._gauges: Dict[str, Any] = {}
+
+    def describe(self, name: str, metric_type: str, help_text: str):
+        self._meta[name] = (metric_type, help_text)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [0.0] * (len(LATENCY_BUCKETS) + 2)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def gauge(self, name: str, help_text: str, callback):
+        """Register a gauge whose value is read from callback() at scrape time"""
+        self.describe(name, "gauge", help_text)
+        self._gauges[name] = callback
+
+    def render(self) -> str:
+        def fmt_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{str(v)}"' for k, v in pairs) + "}"
+
+        lines = []
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+        for name in sorted(set(k[0] for k in counters) | set(k[0] for k in histograms) | set(self._gauges)):
+            metric_type, help_text = self._meta.get(name, ("untyped", name))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if name in self._gauges:
+                try:
+                    lines.append(f"{name} {float(self._gauges[name]())}")
+                except Exception:
+                    pass
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    lines.append(f"{name}{fmt_labels(labels)} {value}")
+            for (n, labels), series in sorted(histograms.items()):
+                if n != name:
+                    continue
+                for bound, count in zip(LATENCY_BUCKETS, series):
+                    lines.append(f"{name}_bucket{fmt_labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{fmt_labels(labels, [('le', '+Inf')])} {series[-2]}")
+                lines.append(f"{name}_count{fmt_labels(labels)} {series[-2]}")
+                lines.append(f"{name}_sum{fmt_labels(labels)} {series[-1]}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("verifin_http_request_seconds", "histogram", "HTTP request latency by route")
+metrics.describe("verifin_span_seconds", "histogram", "Duration of timed spans (upstream calls, PDF stages, serialization)")
+metrics.describe("verifin_fallbacks_total", "counter", "Responses served from fallback paths (last-known-good data, pattern matching)")
+
+@contextmanager
+def span(name: str):
+    """Time a block into verifin_span_seconds{span=name}, marking status=error if it raises"""
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        metrics.observe("verifin_span_seconds", time.perf_counter() - start, span=name, status=status)
+
+try:
+    import orjson
+except ImportError:  # optional: falls back to the stdlib encoder
+    orjson = None
+
+def _json_default(obj):
+    """Encode the values orjson/json don't know natively (pandas Timestamps, NumPy/pandas scalars, sets)"""
+    if type(obj).__name__ in ("NaTType", "NAType"):
+        return None
+    if hasattr(obj, "isoformat"):
+        return obj.isoformat()
+    if hasattr(obj, "item"):
+        return _sanitize_json(obj.item())
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def _sanitize_json(value):
+    """NaN/Infinity -> null for the stdlib fallback (orjson already does this)"""
+    if isinstance(value, float):
+        return None if math.isnan(value) or math.isinf(value) else value
+    if isinstance(value, dict):
+        return {k: _sanitize_json(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_sanitize_json(v) for v in value]
+    if hasattr(value, "tolist"):  # NumPy arrays / scalars
+        return _sanitize_json(value.tolist())
+    return value
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON response rendered with orjson (stdlib fallback) that records serialization time.
+    NumPy/pandas values are encoded natively and NaN/Infinity become null here, so handlers
+    don't need per-field clean_float passes. Returning it directly from a handler also skips
+    FastAPI's jsonable_encoder walk over the response.
+    """
+    def render(self, content: Any) -> bytes:
+        with span("serialize"):
+            return dumps_json(content)
+
+def dumps_json(content: Any) -> bytes:
+    """Compact UTF-8 JSON with the FastJSONResponse encoding rules"""
+    if orjson is not None:
+        return orjson.dumps(
+            content, default=_json_default,
+            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        )
+    return json.dumps(
+        _sanitize_json(content), default=_json_default,
+        ensure_ascii=False, allow_nan=False, separators=(",", ":")
+    ).encode("utf-8")
+
+class MetricsMiddleware:
+    """Pure ASGI per-route latency histogram (route templates, so /company-financials/{ticker} is one series)"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status_code = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status_code[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            metrics.observe(
+                "verifin_http_request_seconds", time.perf_counter() - start,
+                method=scope["method"],
+                route=getattr(route, "path", "unmatched"),
+                status=f"{status_code[0] // 100}xx"
+            )
+
 # Initialize FastAPI app
 app = FastAPI(
     title="VeriFin API",
     description="Financial Intelligence Platform Backend",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse
+)
+
+# Request body limits - the document endpoints accept large PDFs, everything else is small JSON
+DOCUMENT_MAX_BYTES = int(float(os.getenv("DOCUMENT_MAX_MB", "100")) * 1024 * 1024)  # largest decoded PDF
+MAX_JSON_BODY_BYTES = int(os.getenv("MAX_JSON_BODY_KB", "1024")) * 1024
+MULTIPART_OVERHEAD = 64 * 1024
+
+class RequestBodyTooLarge(HTTPException):
+    def __init__(self, limit: int):
+        super().__init__(status_code=413, detail=f"Request body exceeds {limit // 1024}KB limit")
+
+class BodySizeLimitMiddleware:
+    """
+    Pure ASGI request body limit with per-route limits.
+    A declared Content-Length over the limit is rejected with 413 (a malformed one with 400)
+    before anything is read; bodies without one (chunked) are counted as they arrive and cut
+    off at the limit.
+    """
+    def __init__(self, app, default_limit: int, route_limits: Dict[str, int]):
+        self.app = app
+        self.default_limit = default_limit
+        self.route_limits = route_limits
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] in ("GET", "HEAD", "OPTIONS"):
+            await self.app(scope, receive, send)
+            return
+
+        limit = self.route_limits.get(scope["path"], self.default_limit)
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                if not value.isdigit():
+                    response = JSONResponse({"detail": "Invalid Content-Length header"}, status_code=400)
+                    await response(scope, receive, send)
+                    return
+                if int(value) > limit:
+                    error = RequestBodyTooLarge(limit)
+                    response = JSONResponse({"detail": error.detail}, status_code=413)
+                    await response(scope, receive, send)
+                    return
+                # The server guarantees the body matches the declared length
+                await self.app(scope, receive, send)
+                return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise RequestBodyTooLarge(limit)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+# Added before CORS so that CORS wraps it and 413 responses stay readable by the browser
+app.add_middleware(
+    BodySizeLimitMiddleware,
+    default_limit=MAX_JSON_BODY_BYTES,
+    route_limits={
+        "/document-analyze-upload": DOCUMENT_MAX_BYTES + MULTIPART_OVERHEAD,
+        "/document-analyze-jobs": DOCUMENT_MAX_BYTES + MULTIPART_OVERHEAD,
+        # base64 inflates the document by 4/3, and line wrapping and \/ or \uXXXX escapes add more;
+        # this is only a backstop - Base64FileSink enforces DOCUMENT_MAX_BYTES on the decoded size
+        "/document-analyze": DOCUMENT_MAX_BYTES * 2 + MULTIPART_OVERHEAD,
+    }
 )
 
 # CORS Configuration - CRITICAL for Netlify frontend
@@ -47,18 +339,132 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Increase max upload size to 100MB for large PDFs
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
+# ==================== COMPRESSION ====================
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4  # fast setting; still noticeably smaller than gzip -6 on JSON
+COMPRESSIBLE_TYPES = ("application/json", "text/")
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """Brotli when the client accepts it (and the module is installed), else gzip, else None"""
+    offered = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        offered[name.strip().lower()] = q
+    if brotli is not None and offered.get("br", 0) > 0:
+        return "br"
+    if offered.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+class StreamCompressor:
+    """gzip or Brotli stream; chunks are flushed so streamed responses stay incremental"""
+    def __init__(self, encoding: str):
+        if encoding == "br":
+            compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+            self._compress, self._flush, self._finish = compressor.process, compressor.flush, compressor.finish
+        else:
+            compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+            self._compress = compressor.compress
+            self._flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+            self._finish = compressor.flush
+
+    def chunk(self, data: bytes, last: bool) -> bytes:
+        return self._compress(data) + (self._finish() if last else self._flush())
+
+class CompressionMiddleware:
+    """
+    Pure ASGI gzip/Brotli response compression.
+    Bodies under minimum_size, already-encoded or non-text responses and SSE streams pass
+    through untouched; streamed bodies are compressed chunk by chunk.
+    """
+    def __init__(self, app, minimum_size: int):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        encoding = None
+        if scope["type"] == "http" and scope["method"] != "HEAD":
+            for name, value in scope["headers"]:
+                if name == b"accept-encoding":
+                    encoding = choose_encoding(value.decode("latin-1"))
+                    break
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        compressor = None
+
+        async def compressing_send(message):
+            nonlocal start_message, compressor
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start_message is None and compressor is None:
+                await send(message)
+                return
+
+            if start_message is not None:
+                # First body chunk: decide whether this response is compressed
+                headers = MutableHeaders(raw=start_message["headers"])
+                content_type = headers.get("content-type", "")
+                if (
+                    "content-encoding" in headers
+                    or not content_type.startswith(COMPRESSIBLE_TYPES)
+                    or content_type.startswith("text/event-stream")
+                    or (not more_body and len(body) < self.minimum_size)
+                ):
+                    await send(start_message)
+                    start_message = None
+                    await send(message)
+                    return
+                compressor = StreamCompressor(encoding)
+                headers["Content-Encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
 
-class LargeFileSizeMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        # Set max body size to 100MB
-        request.scope["app"].state.max_body_size = 100 * 1024 * 1024  # 100MB
-        response = await call_next(request)
-        return response
+            compressed = compressor.chunk(body, last=not more_body)
+            metrics.inc("verifin_compression_bytes_total", len(body), encoding=encoding, side="in")
+            metrics.inc("verifin_compression_bytes_total", len(compressed), encoding=encoding, side="out")
+            if start_message is not None:
+                if more_body:
+                    del headers["Content-Length"]
+                else:
+                    headers["Content-Length"] = str(len(compressed))
+                await send(start_message)
+                start_message = None
+            await send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+
+        await self.app(scope, receive, compressing_send)
+
+metrics.describe("verifin_compression_bytes_total", "counter", "Response bytes before (side=in) and after (side=out) compression")
+
+# Inside the metrics middleware, so recorded latency includes compression time
+app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MIN_BYTES)
+
+# Outermost, so request latency includes every other middleware
+app.add_middleware(MetricsMiddleware)
 
-app.add_middleware(LargeFileSizeMiddleware)
+from starlette.requests import Request
+from starlette.datastructures import MutableHeaders
 
 # Environment variables
 FINNHUB_API_KEY = os.getenv("FINNHUB_API_KEY", "")
@@ -67,99 +473,742 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
 APP_MODE = os.getenv("APP_MODE", "development")
 
-# Initialize Gemini
-import google.generativeai as genai
+# Document analysis: how much extracted text is sent to Gemini
+GEMINI_DOC_CHARS = 100000
+GEMINI_DOC_CHARS_WITH_TABLES = 30000
+# Scanned (image-only) pages are skipped, or OCR'd in a separate process pool when enabled
+DOCUMENT_OCR = os.getenv("DOCUMENT_OCR", "false").lower() in ("1", "true", "yes")
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "2"))
+OCR_TIMEOUT = float(os.getenv("OCR_TIMEOUT", "60"))  # seconds a document waits for its OCR pages
+OCR_LANGUAGE = os.getenv("OCR_LANGUAGE", "eng")
+OCR_DPI = 150
+OCR_BATCH_PAGES = 8
+
+# ==================== LOGGING ====================
+# Request threads only enqueue records; a single listener thread writes them to stdout.
+# Production emits JSON lines at INFO, development readable lines at DEBUG (LOG_LEVEL overrides).
+# Hot-path messages pass extra={"sample": rate} to keep only that fraction of them.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO" if APP_MODE == "production" else "DEBUG").upper()
+LOG_QUEUE_SIZE = 10000
+_LOG_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "sample"}
+
+class SamplingFilter(logging.Filter):
+    """Keep 1 in round(1/rate) records per message template for records carrying a sample rate"""
+    def __init__(self):
+        super().__init__()
+        self._seen: Dict[str, int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = getattr(record, "sample", None)
+        if rate is None or rate >= 1:
+            return True
+        if rate <= 0:
+            return False
+        seen = self._seen.get(record.msg, 0)
+        self._seen[record.msg] = seen + 1
+        return seen % round(1 / rate) == 0
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line, including any extra={...} fields"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _LOG_RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class DroppingQueueHandler(QueueHandler):
+    """Never block the caller: when the queue is full the record is dropped and counted"""
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc("verifin_log_dropped_total")
+
+def configure_logging() -> logging.Logger:
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if APP_MODE == "production":
+        stream_handler.setFormatter(JsonLogFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s %(name)s: %(message)s"))
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    app_logger = logging.getLogger("verifin")
+    app_logger.setLevel(LOG_LEVEL)
+    app_logger.handlers[:] = [queue_handler]
+    app_logger.propagate = False
+    return app_logger
+
+metrics.describe("verifin_log_dropped_total", "counter", "Log records dropped because the log queue was full")
+logger = configure_logging()
+
+# ==================== CACHE ====================
+# Market data cache shared by every worker on the host. Backends store opaque bytes with a TTL:
+#   memory  per-process LRU (tests, single worker)
+#   sqlite  one WAL-mode file on local disk, shared by all workers and surviving restarts (default)
+#   redis   any Redis-compatible server via REDIS_URL (needs the optional `redis` package)
+# Entries are pickled and zlib-compressed along with their store time, so every backend
+# returns the same CacheEntry. Only real upstream data is stored - never mock/fallback values.
+# Blobs are HMAC-SHA256 signed and a blob that fails verification is never unpickled, so
+# write access to a shared backend isn't code execution. The key is CACHE_SECRET (set the same
+# value on every host sharing a Redis), else a random key created once next to CACHE_PATH.
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "sqlite").lower()
+CACHE_PATH = os.getenv("CACHE_PATH", os.path.join(tempfile.gettempdir(), "verifin_cache.sqlite3"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "5000"))  # memory backend only
+REDIS_URL = os.getenv("REDIS_URL", "")
+CACHE_SECRET = os.getenv("CACHE_SECRET", "")
+CACHE_COMPRESS_MIN_BYTES = 512
+
+# Seconds each kind of data stays fresh; override with e.g. CACHE_TTL_QUOTE=30
+CACHE_TTLS = {
+    "quote": 60,
+    "indices": 60,
+    "history": 6 * 3600,
+    "metadata": 24 * 3600,
+    "statements": 24 * 3600,
+    "overview": 60,
+    "index": 60,
+    "documents": 24 * 3600,  # analyzed document chunks for /document-ask (opt-in, ?index=true)
+    "chat": 24 * 3600,  # idle chat sessions expire
+}
+for _namespace in CACHE_TTLS:
+    CACHE_TTLS[_namespace] = int(os.getenv(f"CACHE_TTL_{_namespace.upper()}", CACHE_TTLS[_namespace]))
+
+class CacheEntry(NamedTuple):
+    value: Any
+    stored_at: float
+    expires_at: float
+    stale: bool = False  # served from the last-known-good store after an upstream failure
+
+class MemoryCacheBackend:
+    """Per-process LRU with lazy expiry"""
+    name = "memory"
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (blob, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[1] <= time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[0]
+
+    def _store(self, key: str, blob: bytes, ttl: float):
+        self._data[key] = (blob, time.time() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def set(self, key: str, blob: bytes, ttl: float):
+        with self._lock:
+            self._store(key, blob, ttl)
+
+    def add(self, key: str, blob: bytes, ttl: float) -> bool:
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] > time.time():
+                return False
+            self._store(key, blob, ttl)
+            return True
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+class SQLiteCacheBackend:
+    """Single-file store shared by all workers on the host (one connection per thread)"""
+    name = "sqlite"
+    PURGE_EVERY = 500  # writes between expired-row sweeps
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[bytes]:
+        row = self._connection().execute(
+            "SELECT value FROM cache WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, blob: bytes, ttl: float):
+        conn = self._connection()
+        now = time.time()
+        conn.execute("INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)", (key, blob, now + ttl))
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY == 0:
+            conn.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+
+    def add(self, key: str, blob: bytes, ttl: float) -> bool:
+        conn = self._connection()
+        now = time.time()
+        with conn:  # one transaction, so exactly one worker wins
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM cache WHERE key = ? AND expires_at <= ?", (key, now))
+            cursor = conn.execute("INSERT OR IGNORE INTO cache (key, value, expires_at) VALUES (?, ?, ?)", (key, blob, now + ttl))
+        return cursor.rowcount == 1
+
+    def delete(self, key: str):
+        self._connection().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+class RedisCacheBackend:
+    """Redis-compatible server (Redis, Valkey, KeyDB, Dragonfly); expiry is handled server-side"""
+    name = "redis"
+
+    def __init__(self, url: str):
+        import redis
+        self._client = redis.Redis.from_url(url, socket_timeout=1, socket_connect_timeout=1)
+        self._client.ping()
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self._client.get(f"verifin:{key}")
+
+    def set(self, key: str, blob: bytes, ttl: float):
+        self._client.set(f"verifin:{key}", blob, px=max(1, int(ttl * 1000)))
+
+    def add(self, key: str, blob: bytes, ttl: float) -> bool:
+        return bool(self._client.set(f"verifin:{key}", blob, px=max(1, int(ttl * 1000)), nx=True))
+
+    def delete(self, key: str):
+        self._client.delete(f"verifin:{key}")
+
+def load_cache_key() -> bytes:
+    if CACHE_SECRET:
+        return hashlib.sha256(CACHE_SECRET.encode()).digest()
+    path = f"{CACHE_PATH}.key"
+    try:
+        # Write a candidate key, then link it into place: only one process's key wins and
+        # readers never see a partly written file
+        fd, candidate = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".verifin-key-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(os.urandom(32))
+            try:
+                os.link(candidate, path)
+            except FileExistsError:
+                pass
+        finally:
+            os.unlink(candidate)
+        with open(path, "rb") as f:
+            key = f.read()
+        if len(key) == 32:
+            return key
+        logger.warning("Cache key file %s is invalid, using a per-process key", path)
+    except OSError as e:
+        logger.warning("Cache key file %s unavailable (%s), using a per-process key", path, e)
+    return os.urandom(32)
+
+CACHE_KEY = load_cache_key()
+
+class Cache:
+    """
+    Namespaced front over a backend: serialization, TTL defaults and hit/miss stats.
+    Backend failures are logged and treated as misses - the cache never fails a request.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self._stats: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def encode(entry: CacheEntry) -> bytes:
+        """kind byte + HMAC-SHA256 of (kind + payload) + payload"""
+        blob = pickle.dumps((entry.value, entry.stored_at, entry.expires_at), protocol=pickle.HIGHEST_PROTOCOL)
+        kind = b"p"
+        if len(blob) >= CACHE_COMPRESS_MIN_BYTES:
+            kind, blob = b"z", zlib.compress(blob, 1)
+        return kind + hmac.new(CACHE_KEY, kind + blob, hashlib.sha256).digest() + blob
+
+    @staticmethod
+    def decode(blob: bytes) -> CacheEntry:
+        kind, mac, payload = blob[:1], blob[1:33], blob[33:]
+        if not hmac.compare_digest(mac, hmac.new(CACHE_KEY, kind + payload, hashlib.sha256).digest()):
+            raise ValueError("cache entry signature mismatch")
+        if kind == b"z":
+            payload = zlib.decompress(payload)
+        value, stored_at, expires_at = pickle.loads(payload)
+        return CacheEntry(value=value, stored_at=stored_at, expires_at=expires_at)
+
+    def _count(self, namespace: str, result: str):
+        with self._lock:
+            counts = self._stats.setdefault(namespace, {"hit": 0, "miss": 0})
+            counts[result] += 1
+        metrics.inc("verifin_cache_requests_total", namespace=namespace, result=result)
+
+    def get_entry(self, namespace: str, key: str) -> Optional[CacheEntry]:
+        entry = self.peek(namespace, key)
+        self._count(namespace, "hit" if entry is not None else "miss")
+        return entry
+
+    def peek(self, namespace: str, key: str) -> Optional[CacheEntry]:
+        """get_entry without counting a hit or miss (background checks)"""
+        try:
+            blob = self.backend.get(f"{namespace}:{key}")
+            return self.decode(blob) if blob is not None else None
+        except Exception as e:
+            logger.warning("Cache read failed for %s:%s: %s", namespace, key, e, extra={"sample": 0.1})
+            return None
+
+    def get(self, namespace: str, key: str, default: Any = None) -> Any:
+        entry = self.get_entry(namespace, key)
+        return entry.value if entry is not None else default
+
+    def set(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None) -> CacheEntry:
+        now = time.time()
+        ttl = CACHE_TTLS.get(namespace, 60) if ttl is None else ttl
+        entry = CacheEntry(value=value, stored_at=now, expires_at=now + ttl)
+        try:
+            with span("cache.set"):
+                self.backend.set(f"{namespace}:{key}", self.encode(entry), ttl)
+        except Exception as e:
+            logger.warning("Cache write failed for %s:%s: %s", namespace, key, e, extra={"sample": 0.1})
+        return entry
+
+    def add(self, namespace: str, key: str, value: Any, ttl: float) -> bool:
+        """Store only if the key is absent or expired; True if this call stored it (a cross-worker lease)"""
+        now = time.time()
+        try:
+            return self.backend.add(f"{namespace}:{key}", self.encode(CacheEntry(value, now, now + ttl)), ttl)
+        except Exception as e:
+            logger.warning("Cache add failed for %s:%s: %s", namespace, key, e, extra={"sample": 0.1})
+            return True
+
+    def delete(self, namespace: str, key: str):
+        try:
+            self.backend.delete(f"{namespace}:{key}")
+        except Exception as e:
+            logger.warning("Cache delete failed for %s:%s: %s", namespace, key, e, extra={"sample": 0.1})
+
+    def cached_entry(self, namespace: str, key: str, loader, ttl: Optional[float] = None) -> Optional[CacheEntry]:
+        """Return the cache entry, or call loader() and store its result; None if the loader returned None"""
+        entry = self.get_entry(namespace, key)
+        if entry is not None:
+            return entry
+        value = loader()
+        if value is None:
+            return None
+        return self.set(namespace, key, value, ttl)
+
+    def cached(self, namespace: str, key: str, loader, ttl: Optional[float] = None) -> Any:
+        """Return the cached value, or call loader() and store its result unless it is None"""
+        entry = self.cached_entry(namespace, key, loader, ttl)
+        return entry.value if entry is not None else None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"backend": self.backend.name, "namespaces": {ns: dict(c) for ns, c in self._stats.items()}}
+
+def create_cache_backend():
+    if CACHE_BACKEND == "redis" and REDIS_URL:
+        try:
+            return RedisCacheBackend(REDIS_URL)
+        except Exception as e:
+            logger.warning("Redis cache unavailable (%s), using SQLite", e)
+    if CACHE_BACKEND in ("sqlite", "redis"):
+        try:
+            return SQLiteCacheBackend(CACHE_PATH)
+        except Exception as e:
+            logger.warning("SQLite cache unavailable at %s (%s), using in-memory cache", CACHE_PATH, e)
+    return MemoryCacheBackend(CACHE_MAX_ENTRIES)
+
+# HTTP caching: responses built from a cache entry carry an ETag derived from the entry's
+# version (key + store time) and a max-age of its remaining TTL; GETs revalidate with 304.
+def entry_etag(key: str, entry: CacheEntry) -> str:
+    digest = hashlib.blake2b(f"{key}:{entry.stored_at!r}".encode(), digest_size=8).hexdigest()
+    return f'W/"{digest}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    bare = etag[2:] if etag.startswith("W/") else etag
+    return any((tag.strip()[2:] if tag.strip().startswith("W/") else tag.strip()) == bare for tag in if_none_match.split(","))
+
+def cached_json_response(request: Request, content: Any, key: str, entry: Optional[CacheEntry]) -> Response:
+    """FastJSONResponse with validators from the cache entry, or 304 when the client's copy is current"""
+    if entry is None or entry.stale:
+        return FastJSONResponse(content, headers={"Cache-Control": "no-cache"})
+    etag = entry_etag(key, entry)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={max(0, int(entry.expires_at - time.time()))}"
+    }
+    if request.method in ("GET", "HEAD") and etag_matches(request.headers.get("if-none-match"), etag):
+        metrics.inc("verifin_not_modified_total", route=request.url.path.split("/")[1])
+        return Response(status_code=304, headers=headers)
+    return FastJSONResponse(content, headers=headers)
+
+metrics.describe("verifin_not_modified_total", "counter", "Conditional requests answered with 304 Not Modified")
+metrics.describe("verifin_cache_requests_total", "counter", "Market data cache lookups by namespace and result")
+cache = Cache(create_cache_backend())
+logger.info("Market data cache: %s", cache.backend.name)
+
+# ==================== UPSTREAM SCHEDULER ====================
+# Every yfinance call takes a slot from one token bucket per process. Waiting calls are served
+# by priority class (interactive quote > history > statements > background), and the rate
+# adapts AIMD-style: halved with an exponential pause when Yahoo throttles (429), then raised
+# additively back to UPSTREAM_RATE on success. A call that can't get a slot within its queue
+# timeout raises UpstreamThrottled (503 + Retry-After) instead of degrading to fake data.
+UPSTREAM_RATE = float(os.getenv("UPSTREAM_RATE", "10"))  # max requests/second to Yahoo per process
+UPSTREAM_BURST = int(os.getenv("UPSTREAM_BURST", "20"))
+UPSTREAM_MIN_RATE = 0.25
+UPSTREAM_RATE_STEP = 0.05  # additive increase per successful call
+UPSTREAM_MAX_BACKOFF = 60.0
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", "8"))
+UPSTREAM_PRIORITIES = {"quote": 0, "metadata": 0, "history": 1, "statements": 2, "background": 3}
+
+class UpstreamThrottled(HTTPException):
+    def __init__(self, retry_after: float):
+        super().__init__(
+            status_code=503,
+            detail="Market data provider is rate limiting requests, please retry shortly",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+        )
+
+# A standalone 429, so symbols like 0429.HK in an error message don't count
+_STATUS_429 = re.compile(r"(?<![\w.])429(?![\w.])")
+
+def is_throttle_error(error: Exception) -> bool:
+    response = getattr(error, "response", None)
+    status = getattr(error, "status_code", None) or getattr(response, "status_code", None)
+    if status is not None:
+        return status == 429
+    text = f"{type(error).__name__} {error}".lower()
+    return "ratelimit" in text or "rate limit" in text or "too many requests" in text or bool(_STATUS_429.search(text))
+
+class UpstreamScheduler:
+    """Thread-safe priority token bucket with AIMD rate control"""
+    def __init__(self, rate: float, burst: int):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._backoff = 1.0
+        self._waiting: List[tuple] = []  # heap of (priority, seq)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def acquire(self, priority: int, timeout: float) -> bool:
+        """Block until this caller is the highest-priority waiter and a token is free"""
+        with self._cond:
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiting, ticket)
+            deadline = time.monotonic() + timeout
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self._waiting[0] == ticket and self._tokens >= 1 and now >= self._paused_until:
+                    heapq.heappop(self._waiting)
+                    self._tokens -= 1
+                    self._cond.notify_all()
+                    return True
+                if now >= deadline:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                    self._cond.notify_all()
+                    return False
+                next_token = max(self._paused_until - now, (1 - self._tokens) / self.rate, 0.001)
+                self._cond.wait(min(deadline - now, next_token))
+
+    def retry_after(self) -> float:
+        with self._cond:
+            return max(self._paused_until - time.monotonic(), len(self._waiting) / self.rate, 1.0)
+
+    def on_success(self):
+        with self._cond:
+            self.rate = min(self.max_rate, self.rate + UPSTREAM_RATE_STEP)
+            self._backoff = 1.0
+
+    def on_throttle(self):
+        with self._cond:
+            self.rate = max(UPSTREAM_MIN_RATE, self.rate / 2)
+            self._paused_until = time.monotonic() + self._backoff
+            self._tokens = min(self._tokens, 0)
+            self._backoff = min(UPSTREAM_MAX_BACKOFF, self._backoff * 2)
+        logger.warning("Upstream throttled; rate now %.2f/s", self.rate, extra={"sample": 0.1})
+
+    def paused(self) -> bool:
+        return time.monotonic() < self._paused_until
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiting)
+
+upstream = UpstreamScheduler(UPSTREAM_RATE, UPSTREAM_BURST)
+_upstream_priority_floor: contextvars.ContextVar = contextvars.ContextVar("upstream_priority_floor", default=0)
+
+@contextmanager
+def upstream_priority(kind: str):
+    """Run the calls made inside (in this thread) at no higher priority than kind - e.g. cache warm-up"""
+    token = _upstream_priority_floor.set(UPSTREAM_PRIORITIES[kind])
+    try:
+        yield
+    finally:
+        _upstream_priority_floor.reset(token)
+
+@contextmanager
+def upstream_slot(kind: str):
+    """Wait for an upstream slot for a call of this kind, then report how the call went"""
+    priority = max(UPSTREAM_PRIORITIES[kind], _upstream_priority_floor.get())
+    timeout = UPSTREAM_QUEUE_TIMEOUT * (8 if priority == UPSTREAM_PRIORITIES["background"] else 1)
+    started = time.perf_counter()
+    granted = upstream.acquire(priority, timeout)
+    metrics.observe("verifin_upstream_wait_seconds", time.perf_counter() - started, kind=kind)
+    if not granted:
+        metrics.inc("verifin_upstream_throttled_total", kind=kind, reason="queue_timeout")
+        raise UpstreamThrottled(upstream.retry_after())
+    try:
+        yield
+    except UpstreamThrottled:
+        raise
+    except Exception as e:
+        if is_throttle_error(e):
+            upstream.on_throttle()
+            metrics.inc("verifin_upstream_throttled_total", kind=kind, reason="429")
+            raise UpstreamThrottled(upstream.retry_after()) from e
+        raise
+    upstream.on_success()
+
+metrics.describe("verifin_upstream_wait_seconds", "histogram", "Time upstream calls waited for a rate-limit slot")
+metrics.describe("verifin_upstream_throttled_total", "counter", "Upstream calls refused (queue timeout) or throttled by the provider (429)")
+metrics.gauge("verifin_upstream_rate", "Current adaptive upstream request rate (per second)", lambda: upstream.rate)
+metrics.gauge("verifin_upstream_queue_depth", "Upstream calls waiting for a rate-limit slot", lambda: upstream.queue_depth)
+
+# ==================== LAST-KNOWN-GOOD ====================
+# Every successful upstream fetch is also written to a persistent last-known-good store
+# (SQLite, kept for LKG_RETENTION_DAYS). When a fetch fails the snapshot is served at once,
+# marked stale, instead of mock or fabricated data. A key that just failed is not retried
+# upstream for UPSTREAM_FAILURE_TTL seconds, and while the provider is throttling us a stored
+# snapshot is served without queueing, so an outage costs a local read per request.
+LKG_PATH = os.getenv("LKG_PATH", os.path.join(tempfile.gettempdir(), "verifin_lkg.sqlite3"))
+LKG_RETENTION = int(os.getenv("LKG_RETENTION_DAYS", "30")) * 24 * 3600
+UPSTREAM_FAILURE_TTL = float(os.getenv("UPSTREAM_FAILURE_TTL", "30"))
+MAX_FAILURE_MEMO = 10000
+
+def create_last_known_good_store() -> Cache:
+    try:
+        return Cache(SQLiteCacheBackend(LKG_PATH))
+    except Exception as e:
+        logger.warning("Last-known-good store unavailable at %s (%s), keeping it in memory", LKG_PATH, e)
+        return Cache(MemoryCacheBackend(CACHE_MAX_ENTRIES))
+
+last_known_good = create_last_known_good_store()
+_upstream_failures: Dict[str, float] = {}  # namespace:key -> time before which it isn't retried
+_failures_lock = threading.Lock()
+
+metrics.describe("verifin_lkg_lookups_total", "counter", "Last-known-good store lookups by namespace and result")
+
+def _stale_entry(namespace: str, key: str) -> Optional[CacheEntry]:
+    # peek: LKG reads are counted here, not in the main cache hit/miss series
+    entry = last_known_good.peek(namespace, key)
+    metrics.inc("verifin_lkg_lookups_total", namespace=namespace, result="hit" if entry is not None else "miss")
+    if entry is None:
+        return None
+    metrics.inc("verifin_fallbacks_total", kind="last_known_good")
+    return entry._replace(expires_at=time.time(), stale=True)
 
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
-    gemini_model = genai.GenerativeModel('gemini-flash-latest')
-    print("✅ Gemini AI initialized successfully!")
-else:
-    gemini_model = None
-    print("⚠️ No Gemini API key - using fallback responses")
+def _remember_failure(memo_key: str, now: float):
+    with _failures_lock:
+        if len(_upstream_failures) >= MAX_FAILURE_MEMO:
+            for k in [k for k, until in _upstream_failures.items() if until <= now]:
+                del _upstream_failures[k]
+        _upstream_failures[memo_key] = now + UPSTREAM_FAILURE_TTL
+
+def market_data(namespace: str, key: str, loader, refresh: bool = False) -> Optional[CacheEntry]:
+    """
+    Fresh cache entry, else loader() (stored in the cache and as last-known-good), else the
+    last-known-good snapshot with stale=True. None when nothing was ever fetched; an
+    UpstreamThrottled from the loader propagates only if there is no snapshot to serve.
+    refresh=True skips the fresh-entry check (refresh-ahead).
+    """
+    if not refresh:
+        entry = cache.get_entry(namespace, key)
+        if entry is not None:
+            return entry
+
+    memo_key = f"{namespace}:{key}"
+    now = time.time()
+    recently_failed = _upstream_failures.get(memo_key, 0) > now
+    if recently_failed or upstream.paused():
+        stale = _stale_entry(namespace, key)
+        if stale is not None or recently_failed:
+            return stale
+
+    try:
+        value = loader()
+    except UpstreamThrottled:
+        stale = _stale_entry(namespace, key)
+        if stale is None:
+            raise
+        return stale
+    except Exception as e:
+        logger.warning("Upstream fetch failed for %s: %s", memo_key, e, extra={"sample": 0.1})
+        value = None
+
+    if value is None:
+        _remember_failure(memo_key, now)
+        return _stale_entry(namespace, key)
+    last_known_good.set(namespace, key, value, LKG_RETENTION)
+    return cache.set(namespace, key, value)
+
+# Gemini is configured on first use (google.generativeai is a slow import).
+# Tests and benchmarks may assign gemini_model directly.
+_GEMINI_UNSET = object()
+gemini_model: Any = _GEMINI_UNSET
+_gemini_lock = threading.Lock()
+
+def get_gemini_model():
+    """The shared Gemini model, or None when no API key is configured"""
+    global gemini_model
+    if gemini_model is _GEMINI_UNSET:
+        with _gemini_lock:
+            if gemini_model is _GEMINI_UNSET:
+                if GEMINI_API_KEY:
+                    import google.generativeai as genai
+                    genai.configure(api_key=GEMINI_API_KEY)
+                    gemini_model = genai.GenerativeModel('gemini-flash-latest')
+                    logger.info("Gemini AI initialized")
+                else:
+                    gemini_model = None
+                    logger.warning("No Gemini API key - using fallback responses")
+    return gemini_model
 
 # ==================== HELPER FUNCTIONS ====================
-def get_real_stock_data(ticker: str):
+def fetch_quote(ticker: str) -> Optional[Dict[str, Any]]:
     """
-    Fetch real-time stock data using yfinance (Pro Mode)
+    Price snapshot for a ticker, or None if yfinance has no price
     Prioritizes fast_info for reliability and speed.
     """
+    stock = yf.Ticker(ticker)
+    data = {}
+
+    # fast_info attributes: last_price, previous_close, open, day_high, day_low, ...
+    # accessing these triggers the fetch
     try:
-        stock = yf.Ticker(ticker)
-        data = {}
-        
-        # 1. Fetch CRITICAL Data using fast_info (Reliable & Fast)
-        try:
-            # fast_info attributes: last_price, previous_close, open, day_high, day_low, ...
-            # accessing these triggers the fetch
+        with upstream_slot("quote"), span("yfinance.fast_info"):
             price = stock.fast_info.last_price
             prev_close = stock.fast_info.previous_close
-            
             if price:
-                data['current_price'] = price
-                data['previous_close'] = prev_close
-                data['market_cap'] = stock.fast_info.market_cap or 0
-                data['volume'] = stock.fast_info.last_volume or 0
-                data['52_week_high'] = stock.fast_info.year_high or 0
-                data['52_week_low'] = stock.fast_info.year_low or 0
-                
-                # Calculate change
-                change = price - prev_close
-                change_pct = (change / prev_close) * 100
-                
-                data['price_change'] = change
-                data['price_change_pct'] = change_pct
-            else:
-                raise ValueError("No price in fast_info")
-                
-        except Exception as e:
-            print(f"⚠️ fast_info failed for {ticker}: {e}")
-            # Fallback to history (Method 3 in old code)
-            try:
+                market_cap = stock.fast_info.market_cap or 0
+                volume = stock.fast_info.last_volume or 0
+                year_high = stock.fast_info.year_high or 0
+                year_low = stock.fast_info.year_low or 0
+
+        if price:
+            data['current_price'] = price
+            data['previous_close'] = prev_close
+            data['market_cap'] = market_cap
+            data['volume'] = volume
+            data['52_week_high'] = year_high
+            data['52_week_low'] = year_low
+
+            # Calculate change
+            change = price - prev_close
+            change_pct = (change / prev_close) * 100
+
+            data['price_change'] = change
+            data['price_change_pct'] = change_pct
+        else:
+            raise ValueError("No price in fast_info")
+
+    except UpstreamThrottled:
+        raise
+    except Exception as e:
+        logger.warning("fast_info failed for %s: %s", ticker, e, extra={"sample": 0.1})
+        # Fallback to history (Method 3 in old code)
+        try:
+            with upstream_slot("quote"), span("yfinance.history"):
                 hist = stock.history(period="1d")
-                if not hist.empty:
-                    last = hist.iloc[-1]
-                    data['current_price'] = float(last['Close'])
-                    data['previous_close'] = float(last['Open']) # Approx
-                    data['market_cap'] = 0
-                    data['volume'] = int(last['Volume'])
-                    data['52_week_high'] = 0
-                    data['52_week_low'] = 0
-                    data['price_change'] = data['current_price'] - data['previous_close']
-                    data['price_change_pct'] = (data['price_change']/data['previous_close'])*100
-            except:
-                pass
+            if not hist.empty:
+                last = hist.iloc[-1]
+                data['current_price'] = float(last['Close'])
+                data['previous_close'] = float(last['Open']) # Approx
+                data['market_cap'] = 0
+                data['volume'] = int(last['Volume'])
+                data['52_week_high'] = 0
+                data['52_week_low'] = 0
+                data['price_change'] = data['current_price'] - data['previous_close']
+                data['price_change_pct'] = (data['price_change']/data['previous_close'])*100
+        except UpstreamThrottled:
+            raise
+        except:
+            pass
+
+    return data if 'current_price' in data else None
 
-        # If we still have no price, return Mock or None (logic below will handle)
-        if 'current_price' not in data:
-             print(f"❌ Critical Price Data Missing for {ticker}. Using MOCK data.")
-             is_indian = ".NS" in ticker or ".BO" in ticker
-             base_price = 2500.0 if not is_indian else 1000.0 
-             mock_price = base_price + (len(ticker) * 10)
-             
-             return {
-                "current_price": mock_price,
-                "previous_close": mock_price - 15.0,
-                "price_change": 15.0,
-                "price_change_pct": 1.5,
-                "currency": "₹" if is_indian else "$",
-                "market_cap": 10000000000,
-                "volume": 1000000,
-                "pe_ratio": 20.5,
-                "dividend_yield": 0.01,
-                "52_week_high": mock_price * 1.2,
-                "52_week_low": mock_price * 0.8,
-                "sector": "N/A",  
-                "industry": "N/A",
-                "description": f"Real-time data currently unavailable for {ticker}.",
-                "website": "",
-                "employees": 0
-             }
-
-        # 2. Fetch METADATA using .info (Slow, fragile)
-        # We do this separately so if it fails, we still return the Price data from step 1
+def fetch_ticker_info(ticker: str) -> Optional[Dict[str, Any]]:
+    with upstream_slot("metadata"), span("yfinance.info"):
+        info = yf.Ticker(ticker).info
+    return info or None
+
+def get_ticker_info_entry(ticker: str) -> CacheEntry:
+    """yfinance .info (slow, fragile), cached as the 'metadata' namespace; raises if unavailable"""
+    entry = market_data("metadata", ticker, lambda: fetch_ticker_info(ticker))
+    if entry is None:
+        raise ValueError(f"No metadata for {ticker}")
+    return entry
+
+def get_ticker_info(ticker: str) -> Dict[str, Any]:
+    return get_ticker_info_entry(ticker).value
+
+def get_real_stock_data(ticker: str):
+    """
+    Fetch real-time stock data using yfinance (Pro Mode)
+    Quote and metadata come from the cache, upstream, or the last-known-good store (marked stale).
+    """
+    try:
+        # 1. Fetch CRITICAL Data (fast_info, falling back to history)
+        quote = market_data("quote", ticker, lambda: fetch_quote(ticker))
+        if quote is None:
+            logger.warning("No price data for %s (upstream failed, nothing last-known-good)", ticker, extra={"sample": 0.1})
+            return None
+        data = dict(quote.value)
+        if quote.stale:
+            data['stale'] = True
+            data['as_of'] = quote.stored_at
+
+        # 2. Fetch METADATA separately so if it fails, we still return the Price data from step 1
         try:
-            info = stock.info
+            info = get_ticker_info(ticker)
             data['sector'] = info.get('sector', 'N/A')
             data['industry'] = info.get('industry', 'N/A')
             data['description'] = info.get('longBusinessSummary') or info.get('description') or f"No description available for {ticker}"
@@ -173,7 +1222,7 @@ def get_real_stock_data(ticker: str):
             if not data.get('volume'): data['volume'] = info.get('volume', 0)
 
         except Exception as e:
-            print(f"⚠️ Metadata fetch failed for {ticker}: {e}")
+            logger.warning("Metadata fetch failed for %s: %s", ticker, e, extra={"sample": 0.1})
             # Fill defaults
             data.setdefault('sector', 'N/A')
             data.setdefault('industry', 'N/A')
@@ -193,207 +1242,470 @@ def get_real_stock_data(ticker: str):
         
         return data
 
+    except UpstreamThrottled:
+        raise
     except Exception as e:
-        print(f"Error fetching stock data for {ticker}: {e}")
+        logger.error("Error fetching stock data for %s: %s", ticker, e)
         return None
 
 def get_historical_data(ticker: str, years: int = 5):
     """
-    Fetch historical stock data for charts
+    Fetch historical stock data for charts (cached per ticker and range, last-known-good on failure)
     """
+    try:
+        entry = market_data("history", f"{ticker}:{years}", lambda: fetch_historical_data(ticker, years))
+    except UpstreamThrottled:
+        return None
+    if entry is None:
+        return None
+    if entry.stale:
+        return {**entry.value, "stale": True, "as_of": entry.stored_at}
+    return entry.value
+
+def fetch_historical_data(ticker: str, years: int = 5):
     try:
         stock = yf.Ticker(ticker)
         end_date = datetime.now()
         start_date = end_date - timedelta(days=years*365)
         
         # Get historical data
-        hist = stock.history(start=start_date, end=end_date, interval="1mo")
+        with upstream_slot("history"), span("yfinance.history"):
+            hist = stock.history(start=start_date, end=end_date, interval="1mo")
+        if hist.empty:
+            return None
         
         currency = "₹" if ".NS" in ticker or ".BO" in ticker else "$"
         
-        historical_prices = []
-        for date, row in hist.iterrows():
-            historical_prices.append({
-                "date": date.strftime("%Y-%m-%d"),
-                "year": date.year,
-                "month": date.month,
-                "price": clean_float(row['Close']),
-                "volume": int(row['Volume']) if not math.isnan(row['Volume']) else 0
-            })
+        # Column-wise build; missing closes stay NaN and serialize as null
+        dates = hist.index
+        volumes = hist['Volume'].fillna(0).astype("int64").tolist()
+        historical_prices = [
+            {"date": day, "year": year, "month": month, "price": price, "volume": volume}
+            for day, year, month, price, volume in zip(
+                dates.strftime("%Y-%m-%d"), dates.year.tolist(), dates.month.tolist(),
+                hist['Close'].tolist(), volumes
+            )
+        ]
         
         return {
             "prices": historical_prices,
             "currency": currency
         }
+    except UpstreamThrottled:
+        raise
     except Exception as e:
-        print(f"Error fetching historical data for {ticker}: {e}")
+        logger.error("Error fetching historical data for %s: %s", ticker, e)
         return None
 
+# Yahoo info keys behind each /company-financials section (also the /screener columns)
+FINANCIAL_SECTIONS = {
+    "Valuation Measures": {
+        "Market Cap": "marketCap",
+        "Enterprise Value": "enterpriseValue",
+        "Trailing P/E": "trailingPE",
+        "Forward P/E": "forwardPE",
+        "PEG Ratio": "pegRatio",
+        "Price/Sales": "priceToSalesTrailing12Months",
+        "Price/Book": "priceToBook",
+        "EV/Revenue": "enterpriseToRevenue",
+        "EV/EBITDA": "enterpriseToEbitda",
+    },
+    "Financial Highlights": {
+        "Profit Margin": "profitMargins",
+        "Operating Margin": "operatingMargins",
+        "Return on Assets": "returnOnAssets",
+        "Return on Equity": "returnOnEquity",
+        "Revenue (ttm)": "totalRevenue",
+        "Revenue Per Share": "revenuePerShare",
+        "Gross Profit": "grossProfits",  # not reported for every ticker (grossMargins is)
+        "EBITDA": "ebitda",
+        "Net Income (ttm)": "netIncomeToCommon",
+        "Diluted EPS": "trailingEps",
+    },
+    "Balance Sheet": {
+        "Total Cash": "totalCash",
+        "Total Debt": "totalDebt",
+        "Current Ratio": "currentRatio",
+        "Book Value Per Share": "bookValue",
+    },
+    "Cash Flow": {
+        "Operating Cash Flow": "operatingCashflow",
+        "Levered Free Cash Flow": "freeCashflow",
+    },
+}
+
 @app.get("/company-financials/{ticker}")
-async def get_company_financials(ticker: str):
+async def get_company_financials(ticker: str, request: Request):
     """
     Fetch comprehensive financial data for a company using yfinance
     """
     try:
-        stock = yf.Ticker(ticker)
-        info = stock.info
-        
-        # Helper to safely get value from nested dict or large int/float
-        def safe_get(key, default="N/A"):
-            val = info.get(key, default)
-            return val
-
-        # 1. Valuation Measures
-        valuation = {
-            "Market Cap": safe_get("marketCap", 0),
-            "Enterprise Value": safe_get("enterpriseValue", 0),
-            "Trailing P/E": safe_get("trailingPE", 0),
-            "Forward P/E": safe_get("forwardPE", 0),
-            "PEG Ratio": safe_get("pegRatio", 0),
-            "Price/Sales": safe_get("priceToSalesTrailing12Months", 0),
-            "Price/Book": safe_get("priceToBook", 0),
-            "EV/Revenue": safe_get("enterpriseToRevenue", 0),
-            "EV/EBITDA": safe_get("enterpriseToEbitda", 0),
-        }
-
-        # 2. Financial Highlights
-        highlights = {
-            "Profit Margin": safe_get("profitMargins", 0),
-            "Operating Margin": safe_get("operatingMargins", 0),
-            "Return on Assets": safe_get("returnOnAssets", 0),
-            "Return on Equity": safe_get("returnOnEquity", 0),
-            "Revenue (ttm)": safe_get("totalRevenue", 0),
-            "Revenue Per Share": safe_get("revenuePerShare", 0),
-            "Gross Profit": safe_get("grossProfits", 0), # grossProfits might be in financials df, key in info is 'grossMargins' usually or 'grossProfits'
-            "EBITDA": safe_get("ebitda", 0),
-            "Net Income (ttm)": safe_get("netIncomeToCommon", 0),
-            "Diluted EPS": safe_get("trailingEps", 0),
-        }
-
-        # 3. Balance Sheet items
-        balance_sheet = {
-            "Total Cash": safe_get("totalCash", 0),
-            "Total Debt": safe_get("totalDebt", 0),
-            "Current Ratio": safe_get("currentRatio", 0),
-            "Book Value Per Share": safe_get("bookValue", 0),
-        }
-
-        # 4. Cash Flow
-        cash_flow = {
-            "Operating Cash Flow": safe_get("operatingCashflow", 0),
-            "Levered Free Cash Flow": safe_get("freeCashflow", 0),
-        }
+        loop = asyncio.get_running_loop()
+        entry = await loop.run_in_executor(None, get_ticker_info_entry, ticker)
+        info = entry.value
+        popularity.record(ticker)  # only symbols that resolved, so typos never get refreshed
 
-        return {
+        return cached_json_response(request, {
             "sections": [
-                {"title": "Valuation Measures", "data": valuation},
-                {"title": "Financial Highlights", "data": highlights},
-                {"title": "Balance Sheet", "data": balance_sheet},
-                {"title": "Cash Flow", "data": cash_flow}
+                {"title": title, "data": {label: info.get(key, 0) for label, key in fields.items()}}
+                for title, fields in FINANCIAL_SECTIONS.items()
             ]
-        }
+        }, f"financials:{ticker}", entry)
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error fetching financials for {ticker}: {e}")
+        logger.error("Error fetching financials for %s: %s", ticker, e)
         return {"error": str(e)}
 
 @app.get("/market-indices")
-async def get_market_indices():
+async def get_market_indices(request: Request):
     """
     Fetch live market indices
     """
-    indices = {
-        "NIFTY 50": "^NSEI",
-        "SENSEX": "^BSESN",
-        "BANKNIFTY": "^NSEBANK",
-        "NASDAQ": "^IXIC",
-        "GOLD": "GC=F"
-    }
-    
+    loop = asyncio.get_running_loop()
+    results, entry = await loop.run_in_executor(None, get_market_indices_snapshot)
+    return cached_json_response(request, results, "indices:snapshot", entry)
+
+MARKET_INDICES = {
+    "NIFTY 50": "^NSEI",
+    "SENSEX": "^BSESN",
+    "BANKNIFTY": "^NSEBANK",
+    "NASDAQ": "^IXIC",
+    "GOLD": "GC=F"
+}
+
+def get_market_indices_snapshot() -> tuple:
+    """(results, cache entry) - only snapshots of fresh rows for every index are stored; entry is None otherwise"""
+    entry = cache.get_entry("indices", "snapshot")
+    if entry is not None:
+        return entry.value, entry
+    results = fetch_market_indices()
+    if all(r["price"] != "N/A" and not r.get("stale") for r in results):
+        return results, cache.set("indices", "snapshot", results)
+    return results, None
+
+def fetch_market_indices() -> List[Dict[str, Any]]:
     results = []
-    
-    for name, ticker in indices.items():
+    for name, ticker in MARKET_INDICES.items():
         try:
-            # Using Ticker().fast_info is faster but might be limited. Info is slower but detailed.
-            # We need current price and change. 
-            # Let's try to download last 2 days history to calculate change manually if info fails, or just use info.
-            # Using history(period='2d') is usually reliable for change calculation.
-            stock = yf.Ticker(ticker)
-            hist = stock.history(period="5d") # 5d to be safe over weekends
-            
-            if hist.empty:
-                results.append({
-                    "name": name,
-                    "price": "N/A",
-                    "change": "0.00",
-                    "change_pct": "0.00",
-                    "color": "text-gray-400"
-                })
-                continue
-
-            current_row = hist.iloc[-1]
-            prev_row = hist.iloc[-2] if len(hist) > 1 else current_row
-            
-            price = current_row['Close']
-            prev_close = prev_row['Close']
-            
-            change = price - prev_close
-            change_pct = (change / prev_close) * 100
-            
-            color = "text-green-400" if change >= 0 else "text-red-400"
-            sign = "+" if change >= 0 else ""
-            
+            entry = market_data("index", ticker, lambda: fetch_index_row(name, ticker))
+        except UpstreamThrottled:
+            entry = None
+        if entry is None:
             results.append({
                 "name": name,
-                "price": f"{price:,.2f}",
-                "change": f"{sign}{change:,.2f}",
-                "change_pct": f"{sign}{change_pct:.2f}%",
-                "color": color,
-                "icon": "▲" if change >= 0 else "▼"
+                "price": "N/A",
+                "change": "0.00",
+                "change_pct": "0.00",
+                "color": "text-gray-400"
             })
-        except Exception as e:
-            print(f"Error fetching index {name}: {e}")
-            results.append({"name": name, "price": "Error", "change": "0", "change_pct": "0%", "color": "text-gray-400"})
-            
+        elif entry.stale:
+            results.append({**entry.value, "stale": True, "as_of": entry.stored_at})
+        else:
+            results.append(entry.value)
     return results
 
+def fetch_index_row(name: str, ticker: str) -> Optional[Dict[str, Any]]:
+    """Display row for one index from its last sessions, or None if Yahoo has no data"""
+    # Using history(period='5d') is reliable for the change calculation over weekends
+    stock = yf.Ticker(ticker)
+    with upstream_slot("quote"), span("yfinance.history"):
+        hist = stock.history(period="5d")
+    if hist.empty:
+        return None
+
+    current_row = hist.iloc[-1]
+    prev_row = hist.iloc[-2] if len(hist) > 1 else current_row
+    
+    price = current_row['Close']
+    prev_close = prev_row['Close']
+    
+    change = price - prev_close
+    change_pct = (change / prev_close) * 100
+    
+    color = "text-green-400" if change >= 0 else "text-red-400"
+    sign = "+" if change >= 0 else ""
+    
+    return {
+        "name": name,
+        "price": f"{price:,.2f}",
+        "change": f"{sign}{change:,.2f}",
+        "change_pct": f"{sign}{change_pct:.2f}%",
+        "color": color,
+        "icon": "▲" if change >= 0 else "▼"
+    }
+
+
+# Request/Response Models
+class CompanyQuery(BaseModel):
+    query: str
+
+class CompanyCompareQuery(BaseModel):
+    company1: str
+    company2: str
+
+class ChatQuery(BaseModel):
+    message: str
+    context: Optional[Dict[str, Any]] = None
+    session_id: Optional[str] = None  # omit to start a new conversation
+
+class DocumentQuery(BaseModel):
+    file_content: str  # Base64 encoded PDF
+    filename: str
+
+class DocumentAskQuery(BaseModel):
+    document_id: str  # from the document analysis response
+    question: str
+    top_k: int = 5
+
+# ==================== HEALTH CHECK ====================
+@app.get("/")
+def root():
+    """Root endpoint"""
+    return {
+        "service": "VeriFin API",
+        "status": "running",
+        "version": "1.0.0",
+        "docs": "/docs"
+    }
+
+@app.get("/health")
+def health_check():
+    """Health check endpoint for Render"""
+    return {
+        "status": "ok",
+        "mode": APP_MODE,
+        "cache": cache.stats(),
+        "timestamp": time.time()
+    }
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """Prometheus scrape endpoint (per-process; each worker exposes its own registry)"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# Blocking work (yfinance, Gemini, PyMuPDF) runs on this pool; its backlog is exported as a gauge
+EXECUTOR_WORKERS = int(os.getenv("EXECUTOR_WORKERS", "32"))
+blocking_executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS, thread_name_prefix="blocking")
+
+async def install_blocking_executor():
+    asyncio.get_running_loop().set_default_executor(blocking_executor)
+
+startup_hooks.append(install_blocking_executor)
+metrics.gauge("verifin_executor_queue_depth", "Blocking calls waiting for an executor thread", lambda: blocking_executor._work_queue.qsize())
+metrics.gauge("verifin_document_queue_depth", "Document jobs waiting for a worker", lambda: document_queue.qsize() if document_queue else 0)
+
+# ==================== COMPANY RESOLUTION ====================
+# Comprehensive company database - 50+ companies
+COMPANIES = {
+    # US Tech Giants
+    "AAPL": {"name": "Apple Inc.", "type": "public", "sector": "Technology", "logo": "https://logo.clearbit.com/apple.com"},
+    "MSFT": {"name": "Microsoft Corporation", "type": "public", "sector": "Technology", "logo": "https://logo.clearbit.com/microsoft.com"},
+    "GOOGL": {"name": "Alphabet Inc.", "type": "public", "sector": "Technology", "logo": "https://logo.clearbit.com/google.com"},
+    "AMZN": {"name": "Amazon.com Inc.", "type": "public", "sector": "E-commerce", "logo": "https://logo.clearbit.com/amazon.com"},
+    "TSLA": {"name": "Tesla Inc.", "type": "public", "sector": "Automotive", "logo": "https://logo.clearbit.com/tesla.com"},
+    "META": {"name": "Meta Platforms Inc.", "type": "public", "sector": "Technology", "logo": "https://logo.clearbit.com/meta.com"},
+    "NVDA": {"name": "NVIDIA Corporation", "type": "public", "sector": "Technology", "logo": "https://logo.clearbit.com/nvidia.com"},
+    "NFLX": {"name": "Netflix Inc.", "type": "public", "sector": "Entertainment", "logo": "https://logo.clearbit.com/netflix.com"},
+    
+    # Indian Conglomerates
+    "RELIANCE.NS": {"name": "Reliance Industries Limited", "type": "public", "sector": "Conglomerate", "logo": "https://logo.clearbit.com/ril.com"},
+    "TCS.NS": {"name": "TCS (Tata Consultancy Services)", "type": "public", "sector": "IT Services", "logo": "https://logo.clearbit.com/tcs.com"},
+    "INFY.NS": {"name": "Infosys Limited", "type": "public", "sector": "IT Services", "logo": "https://logo.clearbit.com/infosys.com"},
+    "HDFCBANK.NS": {"name": "HDFC Bank Limited", "type": "public", "sector": "Banking", "logo": "https://logo.clearbit.com/hdfcbank.com"},
+    "ICICIBANK.NS": {"name": "ICICI Bank Limited", "type": "public", "sector": "Banking", "logo": "https://logo.clearbit.com/icicibank.com"},
+    "ITC.NS": {"name": "ITC Limited", "type": "public", "sector": "FMCG", "logo": "https://logo.clearbit.com/itcportal.com"},
+    
+    # Indian Telecom & Digital
+    "BHARTIARTL.NS": {"name": "Bharti Airtel Limited", "type": "public", "sector": "Telecom", "logo": "https://logo.clearbit.com/airtel.in"},
+    "JIO": {"name": "Reliance Jio Infocomm", "type": "public", "sector": "Telecom", "logo": "https://logo.clearbit.com/jio.com"},
+    "IDEA.NS": {"name": "Vodafone Idea Limited (Vi)", "type": "public", "sector": "Telecom", "logo": "https://logo.clearbit.com/myvi.in"},
+    
+    # Indian Auto & Manufacturing
+    "MRF.NS": {"name": "MRF Limited", "type": "public", "sector": "Tyre Manufacturing", "logo": "https://logo.clearbit.com/mrftyres.com"},
+    "TATAMOTORS.NS": {"name": "Tata Motors Limited", "type": "public", "sector": "Automotive", "logo": "https://logo.clearbit.com/tatamotors.com"},
+    "MARUTI.NS": {"name": "Maruti Suzuki India Limited", "type": "public", "sector": "Automotive", "logo": "https://logo.clearbit.com/marutisuzuki.com"},
+    "HEROMOTOCO.NS": {"name": "Hero MotoCorp Limited", "type": "public", "sector": "Automotive", "logo": "https://logo.clearbit.com/heromotocorp.com"},
+    
+    # Indian E-commerce & Startups
+    "ZOMATO.NS": {"name": "Zomato Limited", "type": "public", "sector": "Food Tech", "logo": "https://logo.clearbit.com/zomato.com"},
+    "PAYTM.NS": {"name": "Paytm (One97 Communications)", "type": "public", "sector": "Fintech", "logo": "https://logo.clearbit.com/paytm.com"},
+    "NYKAA.NS": {"name": "Nykaa (FSN E-Commerce)", "type": "public", "sector": "E-commerce", "logo": "https://logo.clearbit.com/nykaa.com"},
+    
+    # Private Indian Startups
+    "SWIGGY": {"name": "Swiggy", "type": "private", "sector": "Food Delivery", "logo": "https://logo.clearbit.com/swiggy.com"},
+    "ZEPTO": {"name": "Zepto", "type": "private", "sector": "Quick Commerce", "logo": "https://logo.clearbit.com/zeptonow.com"},
+    "FLIPKART": {"name": "Flipkart", "type": "private", "sector": "E-commerce", "logo": "https://logo.clearbit.com/flipkart.com"},
+    "BYJU": {"name": "BYJU'S", "type": "private", "sector": "EdTech", "logo": "https://logo.clearbit.com/byjus.com"},
+    "OLA": {"name": "Ola Cabs", "type": "private", "sector": "Ride Sharing", "logo": "https://logo.clearbit.com/olacabs.com"},
+    "CRED": {"name": "CRED", "type": "private", "sector": "Fintech", "logo": "https://logo.clearbit.com/cred.club"},
+    "RAZORPAY": {"name": "Razorpay", "type": "private", "sector": "Payments", "logo": "https://logo.clearbit.com/razorpay.com"},
+    
+    # Indian Pharma & Healthcare
+    "SUNPHARMA.NS": {"name": "Sun Pharmaceutical Industries", "type": "public", "sector": "Pharmaceuticals", "logo": "https://logo.clearbit.com/sunpharma.com"},
+    "DRREDDY.NS": {"name": "Dr. Reddy's Laboratories", "type": "public", "sector": "Pharmaceuticals", "logo": "https://logo.clearbit.com/drreddys.com"},
+    
+    # Indian Consumer & Retail
+    "DMART.NS": {"name": "Avenue Supermarts (DMart)", "type": "public", "sector": "Retail", "logo": "https://logo.clearbit.com/dmart.in"},
+    "TITAN.NS": {"name": "Titan Company Limited", "type": "public", "sector": "Consumer Goods", "logo": "https://logo.clearbit.com/titan.co.in"},
+    
+    # US Finance & Banks
+    "JPM": {"name": "JPMorgan Chase & Co.", "type": "public", "sector": "Banking", "logo": "https://logo.clearbit.com/jpmorganchase.com"},
+    "BAC": {"name": "Bank of America Corporation", "type": "public", "sector": "Banking", "logo": "https://logo.clearbit.com/bankofamerica.com"},
+    
+    # Global Brands
+    "KO": {"name": "The Coca-Cola Company", "type": "public", "sector": "Beverages", "logo": "https://logo.clearbit.com/coca-cola.com"},
+    "PEP": {"name": "PepsiCo Inc.", "type": "public", "sector": "Food & Beverages", "logo": "https://logo.clearbit.com/pepsico.com"},
+    "NKE": {"name": "Nike Inc.", "type": "public", "sector": "Apparel", "logo": "https://logo.clearbit.com/nike.com"},
+    "MCD": {"name": "McDonald's Corporation", "type": "public", "sector": "Food Service", "logo": "https://logo.clearbit.com/mcdonalds.com"},
+    
+    # Additional Indian Companies
+    "WIPRO.NS": {"name": "Wipro Limited", "type": "public", "sector": "IT Services", "logo": "https://logo.clearbit.com/wipro.com"},
+    "HCLTECH.NS": {"name": "HCL Technologies", "type": "public", "sector": "IT Services", "logo": "https://logo.clearbit.com/hcltech.com"},
+    "BAJFINANCE.NS": {"name": "Bajaj Finance Limited", "type": "public", "sector": "NBFC", "logo": "https://logo.clearbit.com/bajajfinserv.in"},
+    "ADANIENT.NS": {"name": "Adani Enterprises Limited", "type": "public", "sector": "Conglomerate", "logo": "https://logo.clearbit.com/adani.com"},
+    "NESTLEIND.NS": {"name": "Nestle India Limited", "type": "public", "sector": "FMCG", "logo": "https://logo.clearbit.com/nestle.in"},
+    "ASIANPAINT.NS": {"name": "Asian Paints Limited", "type": "public", "sector": "Paints", "logo": "https://logo.clearbit.com/asianpaints.com"},
+    "LT.NS": {"name": "Larsen & Toubro Limited", "type": "public", "sector": "Engineering", "logo": "https://logo.clearbit.com/larsentoubro.com"},
+    "ULTRACEMCO.NS": {"name": "UltraTech Cement Limited", "type": "public", "sector": "Cement", "logo": "https://logo.clearbit.com/ultratechcement.com"},
+    
+    # Private Companies (Zoho etc)
+    # Global Tech
+    "CTSH": {"name": "Cognizant Technology Solutions", "type": "public", "sector": "IT Services", "logo": "https://logo.clearbit.com/cognizant.com"},
+    "ACN": {"name": "Accenture plc", "type": "public", "sector": "IT Services", "logo": "https://logo.clearbit.com/accenture.com"},
+    "IBM": {"name": "International Business Machines", "type": "public", "sector": "Technology", "logo": "https://logo.clearbit.com/ibm.com"},
+    "ORCL": {"name": "Oracle Corporation", "type": "public", "sector": "Technology", "logo": "https://logo.clearbit.com/oracle.com"},
+    
+    # Private Companies (Restored)
+    "ZOHO": {"name": "Zoho Corporation", "type": "private", "sector": "Software", "logo": "https://logo.clearbit.com/zoho.com"},
+    "BYJU": {"name": "BYJU'S", "type": "private", "sector": "EdTech", "logo": "https://logo.clearbit.com/byjus.com"},
+    "ZEPTO": {"name": "Zepto", "type": "private", "sector": "Quick Commerce", "logo": "https://logo.clearbit.com/zeptonow.com"},
+    "SWIGGY": {"name": "Swiggy", "type": "private", "sector": "Food Tech", "logo": "https://logo.clearbit.com/swiggy.com"},
+    "FLIPKART": {"name": "Flipkart", "type": "private", "sector": "E-commerce", "logo": "https://logo.clearbit.com/flipkart.com"},
+    
+    # Indian IT (Expanded)
+    "LTIM.NS": {"name": "LTIMindtree Limited", "type": "public", "sector": "IT Services", "logo": "https://logo.clearbit.com/ltimindtree.com"},
+    "TECHM.NS": {"name": "Tech Mahindra Limited", "type": "public", "sector": "IT Services", "logo": "https://logo.clearbit.com/techmahindra.com"},
+}
+
+_company_index: Optional[List[tuple]] = None
+
+def get_company_index() -> List[tuple]:
+    """(ticker, info, lowercase name, lowercase bare ticker) per company, built once per process"""
+    global _company_index
+    if _company_index is None:
+        _company_index = [
+            (ticker, info, info["name"].lower(), ticker.lower().replace('.ns', ''))
+            for ticker, info in COMPANIES.items()
+        ]
+    return _company_index
+
+# Typeahead: a prefix trie over full names, each name word (so "motors" finds Tata Motors)
+# and tickers. Every node keeps the ids of the companies below it, so a keystroke is a walk
+# of len(query) dict lookups; when the prefix runs out, rapidfuzz ranks only the candidates
+# under the longest prefix that did match.
+SEARCH_MAX_RESULTS = 20
+SEARCH_FUZZY_CUTOFF = 60
+SEARCH_NODE_CANDIDATES = 256  # ids kept per trie node, in COMPANIES order
+
+class _TrieNode:
+    __slots__ = ("children", "ids")
+
+    def __init__(self):
+        self.children: Dict[str, "_TrieNode"] = {}
+        self.ids: List[int] = []
+
+class CompanySearchIndex:
+    def __init__(self, index: List[tuple]):
+        self.companies = [(ticker, info) for ticker, info, _, _ in index]
+        self.names = [name_key for _, _, name_key, _ in index]
+        self.tickers = [ticker.lower() for ticker, _, _, _ in index]
+        self.bare_tickers = [ticker_key for _, _, _, ticker_key in index]
+        # Fuzzy choices: name plus bare ticker, so "relaince" and "relianc" both score
+        self.choices = [f"{name} {bare}" for name, bare in zip(self.names, self.bare_tickers)]
+        self.root = _TrieNode()
+        for i, (name, ticker, bare) in enumerate(zip(self.names, self.tickers, self.bare_tickers)):
+            words = re.sub(r"[^a-z0-9&]+", " ", name).split()
+            terms = {name, ticker, bare}
+            terms.update(" ".join(words[j:]) for j in range(len(words)))
+            for term in terms:
+                self._insert(term, i)
+
+    def _insert(self, term: str, company_id: int):
+        node = self.root
+        self._add_id(node, company_id)
+        for ch in term:
+            node = node.children.setdefault(ch, _TrieNode())
+            self._add_id(node, company_id)
 
-# Request/Response Models
-class CompanyQuery(BaseModel):
-    query: str
+    @staticmethod
+    def _add_id(node: _TrieNode, company_id: int):
+        if len(node.ids) < SEARCH_NODE_CANDIDATES and (not node.ids or node.ids[-1] != company_id):
+            node.ids.append(company_id)
 
-class CompanyCompareQuery(BaseModel):
-    company1: str
-    company2: str
+    def _walk(self, prefix: str) -> tuple:
+        """(deepest node reached, whether the whole prefix matched)"""
+        node = self.root
+        for ch in prefix:
+            child = node.children.get(ch)
+            if child is None:
+                return node, False
+            node = child
+        return node, True
 
-class ChatQuery(BaseModel):
-    message: str
-    context: Optional[Dict[str, Any]] = None
+    def search(self, query: str, limit: int = 8) -> List[Dict[str, Any]]:
+        q = " ".join(query.lower().split())
+        if not q:
+            return []
+        node, complete = self._walk(q)
+        scored = {}
+        if complete:
+            for i in node.ids:
+                if q in (self.tickers[i], self.bare_tickers[i]):
+                    scored[i] = 100
+                elif self.names[i].startswith(q):
+                    scored[i] = 95
+                else:
+                    scored[i] = 90  # ticker prefix or a later word of the name
+        if len(scored) < limit:
+            choices = {i: self.choices[i] for i in node.ids if i not in scored}
+            for _, score, i in process.extract(
+                q, choices, scorer=fuzz.WRatio, limit=limit - len(scored), score_cutoff=SEARCH_FUZZY_CUTOFF
+            ):
+                scored[i] = min(int(score), 89)
+        ranked = sorted(scored.items(), key=lambda item: (-item[1], len(self.names[item[0]])))[:limit]
+        return [
+            {
+                "ticker": self.companies[i][0],
+                "name": self.companies[i][1]["name"],
+                "type": self.companies[i][1]["type"],
+                "sector": self.companies[i][1].get("sector", "N/A"),
+                "logo": self.companies[i][1].get("logo", ""),
+                "score": score,
+            }
+            for i, score in ranked
+        ]
 
-class DocumentQuery(BaseModel):
-    file_content: str  # Base64 encoded PDF
-    filename: str
+_company_search_index: Optional[CompanySearchIndex] = None
 
-# ==================== HEALTH CHECK ====================
-@app.get("/")
-def root():
-    """Root endpoint"""
-    return {
-        "service": "VeriFin API",
-        "status": "running",
-        "version": "1.0.0",
-        "docs": "/docs"
-    }
+def get_company_search_index() -> CompanySearchIndex:
+    global _company_search_index
+    if _company_search_index is None:
+        _company_search_index = CompanySearchIndex(get_company_index())
+    return _company_search_index
 
-@app.get("/health")
-def health_check():
-    """Health check endpoint for Render"""
-    return {
-        "status": "ok",
-        "mode": APP_MODE,
-        "timestamp": time.time()
-    }
+@app.get("/search-companies")
+async def search_companies(q: str, limit: int = 8):
+    """
+    Typeahead suggestions: top `limit` companies whose name, name word or ticker starts with
+    q, topped up with fuzzy matches. Runs inline - no upstream calls.
+    """
+    limit = max(1, min(limit, SEARCH_MAX_RESULTS))
+    with span("search"):
+        results = get_company_search_index().search(q[:64], limit)
+    # The company list is fixed per deploy, so browsers may reuse suggestions briefly
+    return FastJSONResponse({"query": q, "results": results}, headers={"Cache-Control": "public, max-age=300"})
 
-# ==================== COMPANY RESOLUTION ====================
 @app.post("/resolve-company")
 async def resolve_company(query: CompanyQuery):
     """
@@ -403,126 +1715,33 @@ async def resolve_company(query: CompanyQuery):
     try:
         company_name = query.query.strip()
         
-        # Comprehensive company database - 50+ companies
-        companies = {
-            # US Tech Giants
-            "AAPL": {"name": "Apple Inc.", "type": "public", "sector": "Technology", "logo": "https://logo.clearbit.com/apple.com"},
-            "MSFT": {"name": "Microsoft Corporation", "type": "public", "sector": "Technology", "logo": "https://logo.clearbit.com/microsoft.com"},
-            "GOOGL": {"name": "Alphabet Inc.", "type": "public", "sector": "Technology", "logo": "https://logo.clearbit.com/google.com"},
-            "AMZN": {"name": "Amazon.com Inc.", "type": "public", "sector": "E-commerce", "logo": "https://logo.clearbit.com/amazon.com"},
-            "TSLA": {"name": "Tesla Inc.", "type": "public", "sector": "Automotive", "logo": "https://logo.clearbit.com/tesla.com"},
-            "META": {"name": "Meta Platforms Inc.", "type": "public", "sector": "Technology", "logo": "https://logo.clearbit.com/meta.com"},
-            "NVDA": {"name": "NVIDIA Corporation", "type": "public", "sector": "Technology", "logo": "https://logo.clearbit.com/nvidia.com"},
-            "NFLX": {"name": "Netflix Inc.", "type": "public", "sector": "Entertainment", "logo": "https://logo.clearbit.com/netflix.com"},
-            
-            # Indian Conglomerates
-            "RELIANCE.NS": {"name": "Reliance Industries Limited", "type": "public", "sector": "Conglomerate", "logo": "https://logo.clearbit.com/ril.com"},
-            "TCS.NS": {"name": "TCS (Tata Consultancy Services)", "type": "public", "sector": "IT Services", "logo": "https://logo.clearbit.com/tcs.com"},
-            "INFY.NS": {"name": "Infosys Limited", "type": "public", "sector": "IT Services", "logo": "https://logo.clearbit.com/infosys.com"},
-            "HDFCBANK.NS": {"name": "HDFC Bank Limited", "type": "public", "sector": "Banking", "logo": "https://logo.clearbit.com/hdfcbank.com"},
-            "ICICIBANK.NS": {"name": "ICICI Bank Limited", "type": "public", "sector": "Banking", "logo": "https://logo.clearbit.com/icicibank.com"},
-            "ITC.NS": {"name": "ITC Limited", "type": "public", "sector": "FMCG", "logo": "https://logo.clearbit.com/itcportal.com"},
-            
-            # Indian Telecom & Digital
-            "BHARTIARTL.NS": {"name": "Bharti Airtel Limited", "type": "public", "sector": "Telecom", "logo": "https://logo.clearbit.com/airtel.in"},
-            "JIO": {"name": "Reliance Jio Infocomm", "type": "public", "sector": "Telecom", "logo": "https://logo.clearbit.com/jio.com"},
-            "IDEA.NS": {"name": "Vodafone Idea Limited (Vi)", "type": "public", "sector": "Telecom", "logo": "https://logo.clearbit.com/myvi.in"},
-            
-            # Indian Auto & Manufacturing
-            "MRF.NS": {"name": "MRF Limited", "type": "public", "sector": "Tyre Manufacturing", "logo": "https://logo.clearbit.com/mrftyres.com"},
-            "TATAMOTORS.NS": {"name": "Tata Motors Limited", "type": "public", "sector": "Automotive", "logo": "https://logo.clearbit.com/tatamotors.com"},
-            "MARUTI.NS": {"name": "Maruti Suzuki India Limited", "type": "public", "sector": "Automotive", "logo": "https://logo.clearbit.com/marutisuzuki.com"},
-            "HEROMOTOCO.NS": {"name": "Hero MotoCorp Limited", "type": "public", "sector": "Automotive", "logo": "https://logo.clearbit.com/heromotocorp.com"},
-            
-            # Indian E-commerce & Startups
-            "ZOMATO.NS": {"name": "Zomato Limited", "type": "public", "sector": "Food Tech", "logo": "https://logo.clearbit.com/zomato.com"},
-            "PAYTM.NS": {"name": "Paytm (One97 Communications)", "type": "public", "sector": "Fintech", "logo": "https://logo.clearbit.com/paytm.com"},
-            "NYKAA.NS": {"name": "Nykaa (FSN E-Commerce)", "type": "public", "sector": "E-commerce", "logo": "https://logo.clearbit.com/nykaa.com"},
-            
-            # Private Indian Startups
-            "SWIGGY": {"name": "Swiggy", "type": "private", "sector": "Food Delivery", "logo": "https://logo.clearbit.com/swiggy.com"},
-            "ZEPTO": {"name": "Zepto", "type": "private", "sector": "Quick Commerce", "logo": "https://logo.clearbit.com/zeptonow.com"},
-            "FLIPKART": {"name": "Flipkart", "type": "private", "sector": "E-commerce", "logo": "https://logo.clearbit.com/flipkart.com"},
-            "BYJU": {"name": "BYJU'S", "type": "private", "sector": "EdTech", "logo": "https://logo.clearbit.com/byjus.com"},
-            "OLA": {"name": "Ola Cabs", "type": "private", "sector": "Ride Sharing", "logo": "https://logo.clearbit.com/olacabs.com"},
-            "CRED": {"name": "CRED", "type": "private", "sector": "Fintech", "logo": "https://logo.clearbit.com/cred.club"},
-            "RAZORPAY": {"name": "Razorpay", "type": "private", "sector": "Payments", "logo": "https://logo.clearbit.com/razorpay.com"},
-            
-            # Indian Pharma & Healthcare
-            "SUNPHARMA.NS": {"name": "Sun Pharmaceutical Industries", "type": "public", "sector": "Pharmaceuticals", "logo": "https://logo.clearbit.com/sunpharma.com"},
-            "DRREDDY.NS": {"name": "Dr. Reddy's Laboratories", "type": "public", "sector": "Pharmaceuticals", "logo": "https://logo.clearbit.com/drreddys.com"},
-            
-            # Indian Consumer & Retail
-            "DMART.NS": {"name": "Avenue Supermarts (DMart)", "type": "public", "sector": "Retail", "logo": "https://logo.clearbit.com/dmart.in"},
-            "TITAN.NS": {"name": "Titan Company Limited", "type": "public", "sector": "Consumer Goods", "logo": "https://logo.clearbit.com/titan.co.in"},
-            
-            # US Finance & Banks
-            "JPM": {"name": "JPMorgan Chase & Co.", "type": "public", "sector": "Banking", "logo": "https://logo.clearbit.com/jpmorganchase.com"},
-            "BAC": {"name": "Bank of America Corporation", "type": "public", "sector": "Banking", "logo": "https://logo.clearbit.com/bankofamerica.com"},
-            
-            # Global Brands
-            "KO": {"name": "The Coca-Cola Company", "type": "public", "sector": "Beverages", "logo": "https://logo.clearbit.com/coca-cola.com"},
-            "PEP": {"name": "PepsiCo Inc.", "type": "public", "sector": "Food & Beverages", "logo": "https://logo.clearbit.com/pepsico.com"},
-            "NKE": {"name": "Nike Inc.", "type": "public", "sector": "Apparel", "logo": "https://logo.clearbit.com/nike.com"},
-            "MCD": {"name": "McDonald's Corporation", "type": "public", "sector": "Food Service", "logo": "https://logo.clearbit.com/mcdonalds.com"},
-            
-            # Additional Indian Companies
-            "WIPRO.NS": {"name": "Wipro Limited", "type": "public", "sector": "IT Services", "logo": "https://logo.clearbit.com/wipro.com"},
-            "HCLTECH.NS": {"name": "HCL Technologies", "type": "public", "sector": "IT Services", "logo": "https://logo.clearbit.com/hcltech.com"},
-            "BAJFINANCE.NS": {"name": "Bajaj Finance Limited", "type": "public", "sector": "NBFC", "logo": "https://logo.clearbit.com/bajajfinserv.in"},
-            "ADANIENT.NS": {"name": "Adani Enterprises Limited", "type": "public", "sector": "Conglomerate", "logo": "https://logo.clearbit.com/adani.com"},
-            "NESTLEIND.NS": {"name": "Nestle India Limited", "type": "public", "sector": "FMCG", "logo": "https://logo.clearbit.com/nestle.in"},
-            "ASIANPAINT.NS": {"name": "Asian Paints Limited", "type": "public", "sector": "Paints", "logo": "https://logo.clearbit.com/asianpaints.com"},
-            "LT.NS": {"name": "Larsen & Toubro Limited", "type": "public", "sector": "Engineering", "logo": "https://logo.clearbit.com/larsentoubro.com"},
-            "ULTRACEMCO.NS": {"name": "UltraTech Cement Limited", "type": "public", "sector": "Cement", "logo": "https://logo.clearbit.com/ultratechcement.com"},
-            
-            # Private Companies (Zoho etc)
-            # Global Tech
-            "CTSH": {"name": "Cognizant Technology Solutions", "type": "public", "sector": "IT Services", "logo": "https://logo.clearbit.com/cognizant.com"},
-            "ACN": {"name": "Accenture plc", "type": "public", "sector": "IT Services", "logo": "https://logo.clearbit.com/accenture.com"},
-            "IBM": {"name": "International Business Machines", "type": "public", "sector": "Technology", "logo": "https://logo.clearbit.com/ibm.com"},
-            "ORCL": {"name": "Oracle Corporation", "type": "public", "sector": "Technology", "logo": "https://logo.clearbit.com/oracle.com"},
-            
-            # Private Companies (Restored)
-            "ZOHO": {"name": "Zoho Corporation", "type": "private", "sector": "Software", "logo": "https://logo.clearbit.com/zoho.com"},
-            "BYJU": {"name": "BYJU'S", "type": "private", "sector": "EdTech", "logo": "https://logo.clearbit.com/byjus.com"},
-            "ZEPTO": {"name": "Zepto", "type": "private", "sector": "Quick Commerce", "logo": "https://logo.clearbit.com/zeptonow.com"},
-            "SWIGGY": {"name": "Swiggy", "type": "private", "sector": "Food Tech", "logo": "https://logo.clearbit.com/swiggy.com"},
-            "FLIPKART": {"name": "Flipkart", "type": "private", "sector": "E-commerce", "logo": "https://logo.clearbit.com/flipkart.com"},
-            
-            # Indian IT (Expanded)
-            "LTIM.NS": {"name": "LTIMindtree Limited", "type": "public", "sector": "IT Services", "logo": "https://logo.clearbit.com/ltimindtree.com"},
-            "TECHM.NS": {"name": "Tech Mahindra Limited", "type": "public", "sector": "IT Services", "logo": "https://logo.clearbit.com/techmahindra.com"},
-        }
-        
-        # Merge with existing companies dict (simulated by just appending these entries if I was editing dict directly, but here I'm replacing the end of the dict or just relying on existing + new)
-        # Wait, I need to preserve existing. I will assume the user wants me to add these to the existing dict. 
-        # I'll just change the threshold and add fallback logic at the end.
         
         # Fuzzy search with improved logic
-        best_match = None
-        best_score = 0
+        with span("resolve"):
+            best_match = None
+            best_score = 0
         
-        # Direct key match first (for TCS, IDEA etc)
-        upper_query = company_name.upper()
-        for ticker in companies:
-            if upper_query == ticker or upper_query in ticker.split('.'):
-                best_match = {"ticker": ticker, **companies[ticker]}
-                best_score = 100
-                break
+            # Direct key match first (for TCS, IDEA etc)
+            upper_query = company_name.upper()
+            for ticker in COMPANIES:
+                if upper_query == ticker or upper_query in ticker.split('.'):
+                    best_match = {"ticker": ticker, **COMPANIES[ticker]}
+                    best_score = 100
+                    break
 
-        if best_score < 100:
-            for ticker, info in companies.items():
-                # Match against name
-                score_name = fuzz.partial_ratio(company_name.lower(), info["name"].lower())
-                # Match against ticker
-                score_ticker = fuzz.ratio(company_name.lower(), ticker.lower().replace('.ns', ''))
+            if best_score < 100:
+                lower_query = company_name.lower()
+                for ticker, info, name_key, ticker_key in get_company_index():
+                    # Match against name
+                    score_name = fuzz.partial_ratio(lower_query, name_key)
+                    # Match against ticker
+                    score_ticker = fuzz.ratio(lower_query, ticker_key)
                 
-                final_score = max(score_name, score_ticker)
+                    final_score = max(score_name, score_ticker)
                 
-                if final_score > best_score:
-                    best_score = final_score
-                    best_match = {"ticker": ticker, **info}
+                    if final_score > best_score:
+                        best_score = final_score
+                        best_match = {"ticker": ticker, **info}
         
         # Increased threshold to avoid bad matches (like Cognizent -> Zepto)
         if best_score > 78:  
@@ -540,7 +1759,7 @@ async def resolve_company(query: CompanyQuery):
         # This handles tickers not in our DB (e.g. "AMD", "INTC")
         if len(company_name.split()) == 1 and len(company_name) <= 10:
              try:
-                 print(f"🕵️ Attempting direct ticker lookup for: {company_name}")
+                 logger.debug("Attempting direct ticker lookup for %s", company_name)
                  # Use existing helper in thread pool to check validity
                  loop = asyncio.get_running_loop()
                  # Try assuming it is a ticker (uppercase)
@@ -559,8 +1778,10 @@ async def resolve_company(query: CompanyQuery):
                          "logo": "",
                          "confidence": 90
                      }
+             except UpstreamThrottled:
+                 raise
              except Exception as e:
-                 print(f"Fallback check failed: {e}")
+                 logger.warning("Direct ticker lookup failed for %s: %s", company_name, e)
                  pass
 
         return {
@@ -569,82 +1790,581 @@ async def resolve_company(query: CompanyQuery):
             "suggestions": ["Apple", "Microsoft", "TCS", "Reliance"]
         }
             
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def fetch_financial_history(ticker: str) -> Optional[List[Dict[str, Any]]]:
+    """Revenue and Net Profit for the last 5 fiscal years from yfinance, or None if unavailable"""
+    stock = yf.Ticker(ticker)
+    with upstream_slot("statements"), span("yfinance.financials"):
+        financials = stock.financials
+    
+    history = []
+    
+    if not financials.empty:
+        # yfinance returns recent years first (columns are dates)
+        years = financials.columns[:5] # Get last 5 years
+        
+        for date in years:
+            try:
+                revenue = financials.loc['Total Revenue', date] if 'Total Revenue' in financials.index else 0
+                profit = financials.loc['Net Income', date] if 'Net Income' in financials.index else 0
+                
+                history.append({
+                    "year": date.year,
+                    "revenue": float(revenue),
+                    "profit": float(profit)
+                })
+            except Exception:
+                continue
+    
+    # Sort by year ascending
+    history.sort(key=lambda x: x['year'])
+    return history or None
+
+def get_financial_history_entry(ticker: str) -> Optional[CacheEntry]:
+    """Cache entry of the statements history (stale when served last-known-good), None if unavailable"""
+    try:
+        return market_data("statements", ticker, lambda: fetch_financial_history(ticker))
+    except UpstreamThrottled:
+        # Better no statements chart than a stalled one while Yahoo is throttling us
+        logger.warning("Financial history for %s skipped: upstream throttled", ticker, extra={"sample": 0.1})
+    except Exception as e:
+        logger.error("Error fetching financial history for %s: %s", ticker, e)
+    return None
+
 def get_financial_history(ticker: str):
     """
     Fetch 3-5 years of Revenue and Net Profit
-    Uses yfinance where possible, falls back to estimated data
+    Uses yfinance where possible (cached, last-known-good on failure); empty when nothing is known
     """
-    try:
-        stock = yf.Ticker(ticker)
-        financials = stock.financials
-        
-        history = []
-        
-        if not financials.empty:
-            # yfinance returns recent years first (columns are dates)
-            years = financials.columns[:5] # Get last 5 years
-            
-            for date in years:
-                try:
-                    revenue = financials.loc['Total Revenue', date] if 'Total Revenue' in financials.index else 0
-                    profit = financials.loc['Net Income', date] if 'Net Income' in financials.index else 0
-                    
-                    history.append({
-                        "year": date.year,
-                        "revenue": clean_float(revenue),
-                        "profit": clean_float(profit)
-                    })
-                except Exception:
+    entry = get_financial_history_entry(ticker)
+    return entry.value if entry is not None else []
+
+# ==================== CACHE WARM-UP ====================
+# At startup a background task fills the company index, the market-indices snapshot and the
+# quote/metadata/history/statements entries of HOT_TICKERS, so early requests hit the cache.
+# With a shared backend only the worker that takes the lease does the upstream calls.
+CACHE_WARMUP = os.getenv("CACHE_WARMUP", "true").lower() in ("1", "true", "yes")
+HOT_TICKERS = [t.strip() for t in os.getenv(
+    "HOT_TICKERS", "AAPL,MSFT,NVDA,TSLA,TCS.NS,RELIANCE.NS,INFY.NS,HDFCBANK.NS"
+).split(",") if t.strip()]
+WARMUP_LEASE_SECONDS = 120
+warmup_task: Optional[asyncio.Task] = None
+
+def warm_ticker(ticker: str):
+    with upstream_priority("background"):
+        get_real_stock_data(ticker)
+        get_historical_data(ticker, 5)
+        get_financial_history(ticker)
+
+def warm_market_indices():
+    with upstream_priority("background"):
+        get_market_indices_snapshot()
+
+async def warm_up_cache():
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    await loop.run_in_executor(None, get_company_search_index)
+    if not await loop.run_in_executor(None, cache.add, "lease", "warmup", os.getpid(), WARMUP_LEASE_SECONDS):
+        logger.info("Cache warm-up already done by another worker")
+        return
+    with span("warmup"):
+        await asyncio.gather(
+            loop.run_in_executor(None, warm_market_indices),
+            *(loop.run_in_executor(None, warm_ticker, ticker) for ticker in HOT_TICKERS),
+            return_exceptions=True
+        )
+    logger.info("Cache warm-up finished in %.1fs (%d hot tickers)", time.perf_counter() - started, len(HOT_TICKERS))
+
+async def start_cache_warmup():
+    global warmup_task
+    if CACHE_WARMUP:
+        warmup_task = asyncio.create_task(warm_up_cache())
+
+async def stop_cache_warmup():
+    if warmup_task:
+        warmup_task.cancel()
+        await asyncio.gather(warmup_task, return_exceptions=True)
+
+startup_hooks.append(start_cache_warmup)
+shutdown_hooks.append(stop_cache_warmup)
+
+# ==================== REFRESH-AHEAD ====================
+# Requests bump a per-ticker popularity score that halves every POPULARITY_HALF_LIFE seconds
+# (decayed LFU). Every REFRESH_AHEAD_INTERVAL seconds the hottest tickers' quote, metadata,
+# history (and their index's history) and statements entries that are missing or within two
+# intervals of expiring are re-fetched at background priority, at most REFRESH_AHEAD_BUDGET
+# upstream calls a minute, so popular symbols are refreshed before a user can hit the expiry. A per-entry lease in the shared
+# cache keeps workers from refreshing the same entry.
+REFRESH_AHEAD = os.getenv("REFRESH_AHEAD", "true").lower() in ("1", "true", "yes")
+REFRESH_AHEAD_INTERVAL = float(os.getenv("REFRESH_AHEAD_INTERVAL", "15"))
+REFRESH_AHEAD_TOP = int(os.getenv("REFRESH_AHEAD_TOP", "20"))
+REFRESH_AHEAD_BUDGET = float(os.getenv("REFRESH_AHEAD_BUDGET", "60"))  # upstream calls per minute
+REFRESH_AHEAD_MIN_SCORE = 2.0  # repeat interest, not a one-off lookup
+POPULARITY_HALF_LIFE = float(os.getenv("POPULARITY_HALF_LIFE", "1800"))
+MAX_TRACKED_TICKERS = 5000
+
+# (namespace, cache key, upstream loader) per ticker, in refresh order
+REFRESH_AHEAD_KINDS = (
+    ("quote", lambda t: t, fetch_quote),
+    ("metadata", lambda t: t, fetch_ticker_info),
+    ("history", lambda t: f"{t}:5", lambda t: fetch_historical_data(t, 5)),
+    ("history", lambda t: f"{benchmark_ticker(t)}:5", lambda t: fetch_historical_data(benchmark_ticker(t), 5)),
+    ("statements", lambda t: t, fetch_financial_history),
+)
+
+class TickerPopularity:
+    """Decayed request counts; a score is stored with the time it was last brought up to date"""
+    def __init__(self, half_life: float):
+        self.decay = math.log(2) / half_life
+        self.scores: Dict[str, tuple] = {}  # ticker -> (score, updated_at)
+        self._lock = threading.Lock()
+
+    def _decayed(self, score: float, updated_at: float, now: float) -> float:
+        return score * math.exp(-self.decay * (now - updated_at))
+
+    def record(self, ticker: str, weight: float = 1.0):
+        now = time.time()
+        with self._lock:
+            score, updated_at = self.scores.get(ticker, (0.0, now))
+            self.scores[ticker] = (self._decayed(score, updated_at, now) + weight, now)
+            if len(self.scores) > MAX_TRACKED_TICKERS:
+                # Forget the coldest half rather than growing without bound
+                ranked = sorted(self.scores.items(), key=lambda item: self._decayed(*item[1], now))
+                for cold, _ in ranked[:len(ranked) // 2]:
+                    del self.scores[cold]
+
+    def top(self, n: int, min_score: float = 0.0) -> List[tuple]:
+        """[(ticker, current score)] of the n most popular tickers, hottest first"""
+        now = time.time()
+        with self._lock:
+            current = [(ticker, self._decayed(score, updated_at, now)) for ticker, (score, updated_at) in self.scores.items()]
+        return [item for item in heapq.nlargest(n, current, key=lambda item: item[1]) if item[1] >= min_score]
+
+popularity = TickerPopularity(POPULARITY_HALF_LIFE)
+refresh_ahead_task: Optional[asyncio.Task] = None
+
+def due_refreshes(now: float) -> List[tuple]:
+    """(namespace, key, loader) of hot entries missing or expiring within two intervals, hottest first"""
+    due = []
+    seen = set()  # benchmark series are shared by many tickers
+    for ticker, _ in popularity.top(REFRESH_AHEAD_TOP, REFRESH_AHEAD_MIN_SCORE):
+        for namespace, make_key, loader in REFRESH_AHEAD_KINDS:
+            key = make_key(ticker)
+            if (namespace, key) in seen:
+                continue
+            seen.add((namespace, key))
+            entry = cache.peek(namespace, key)
+            if entry is None or entry.expires_at - now < 2 * REFRESH_AHEAD_INTERVAL:
+                due.append((namespace, key, lambda loader=loader, ticker=ticker: loader(ticker)))
+    return due
+
+def refresh_ahead_cycle() -> int:
+    """Refresh what is due within this interval's share of the budget; returns upstream calls made"""
+    budget = max(1, int(REFRESH_AHEAD_BUDGET * REFRESH_AHEAD_INTERVAL / 60))
+    calls = 0
+    with upstream_priority("background"):
+        for namespace, key, loader in due_refreshes(time.time()):
+            if calls >= budget or upstream.paused():
+                break
+            if not cache.add("lease", f"refresh:{namespace}:{key}", os.getpid(), REFRESH_AHEAD_INTERVAL):
+                continue  # another worker has it
+            calls += 1
+            try:
+                entry = market_data(namespace, key, loader, refresh=True)
+            except UpstreamThrottled:
+                break
+            metrics.inc("verifin_refresh_ahead_total", kind=namespace, result="ok" if entry is not None and not entry.stale else "failed")
+    return calls
+
+async def refresh_ahead_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(REFRESH_AHEAD_INTERVAL)
+        try:
+            with span("refresh_ahead"):
+                await loop.run_in_executor(None, refresh_ahead_cycle)
+        except Exception as e:
+            logger.warning("Refresh-ahead cycle failed: %s", e)
+
+async def start_refresh_ahead():
+    global refresh_ahead_task
+    if REFRESH_AHEAD:
+        refresh_ahead_task = asyncio.create_task(refresh_ahead_loop())
+
+async def stop_refresh_ahead():
+    if refresh_ahead_task:
+        refresh_ahead_task.cancel()
+        await asyncio.gather(refresh_ahead_task, return_exceptions=True)
+
+startup_hooks.append(start_refresh_ahead)
+shutdown_hooks.append(stop_refresh_ahead)
+metrics.describe("verifin_refresh_ahead_total", "counter", "Cache entries re-fetched ahead of expiry for popular tickers")
+metrics.gauge("verifin_popular_tickers", "Tickers with a popularity score", lambda: len(popularity.scores))
+
+# ==================== SCREENER ====================
+# Fundamentals of every public company in COMPANIES, kept column-wise (one float64 array per
+# FINANCIAL_SECTIONS metric) so /screener filters, sorts and pages with NumPy instead of N
+# upstream fetches. A background task rebuilds the snapshot every SCREENER_REFRESH_SECONDS
+# from the metadata cache (so mostly cache hits) and swaps it in whole; readers never lock.
+# SCREENER_REFRESH_SECONDS=0 turns the refresh (and so the screener) off.
+SCREENER_REFRESH_SECONDS = int(os.getenv("SCREENER_REFRESH_SECONDS", str(6 * 3600)))
+SCREENER_RETRY_SECONDS = 60  # after a pass that missed tickers (throttled/failed)
+SCREENER_MAX_LIMIT = 100
+SCREENER_COLUMNS = [key for fields in FINANCIAL_SECTIONS.values() for key in fields.values()]
+_SCREENER_FILTER_RE = re.compile(r"^\s*(\w+)\s*(<=|>=|<|>|=)\s*(-?(?:\d+\.?\d*|\.\d+)(?:e[-+]?\d+)?)\s*$", re.IGNORECASE)
+_SCREENER_OPS = {
+    "<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge, "=": operator.eq,
+}
+
+class FundamentalsSnapshot(NamedTuple):
+    tickers: Any         # object arrays, one row per company
+    names: Any
+    sectors: Any         # lowercase "sector industry", for substring matching
+    labels: List[Dict[str, str]]  # display sector/industry per row
+    columns: Dict[str, Any]       # metric -> float64 array (NaN when unknown)
+    built_at: float
+
+fundamentals: Optional[FundamentalsSnapshot] = None
+_fundamentals_info: Dict[str, Dict[str, Any]] = {}  # ticker -> info from its last successful fetch
+screener_task: Optional[asyncio.Task] = None
+
+def _metric(value) -> float:
+    return float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else float("nan")
+
+def _json_metric(value) -> Optional[float]:
+    return None if math.isnan(value) else float(value)
+
+def build_fundamentals() -> tuple:
+    """
+    (snapshot, tickers missed) for one pass over the public universe. A ticker whose metadata
+    can't be fetched (throttled or failed) keeps the info of the last pass that got it, and is
+    left out only if it never had any.
+    """
+    rows = []
+    missed = 0
+    with upstream_priority("background"):
+        for ticker, company in COMPANIES.items():
+            if company["type"] != "public":
+                continue
+            try:
+                info = get_ticker_info(ticker)
+                _fundamentals_info[ticker] = info
+            except Exception as e:
+                missed += 1
+                logger.debug("Screener skipped %s: %s", ticker, e)
+                info = _fundamentals_info.get(ticker)
+                if info is None:
                     continue
-        
-        # Sort by year ascending
-        history.sort(key=lambda x: x['year'])
-        
-        # Fallback if empty (common with restricted API or private companies)
-        if not history:
-            current_year = datetime.now().year
-            is_large = "TCS" in ticker or "RELIANCE" in ticker or "AAPL" in ticker
-            base_rev = 50000000000 if is_large else 10000000000
-            base_prof = base_rev * 0.15
-            
-            for i in range(5):
-                year = current_year - 5 + i
-                growth = 1.0 + (i * 0.1) # 10% growth/year
-                history.append({
-                    "year": year,
-                    "revenue": base_rev * growth,
-                    "profit": base_prof * growth
-                })
+            rows.append((ticker, company, info))
 
-        return history
+    sectors = [(info.get("sector") or company.get("sector", "N/A"), info.get("industry") or "N/A") for _, company, info in rows]
+    return FundamentalsSnapshot(
+        tickers=np.array([ticker for ticker, _, _ in rows], dtype=object),
+        names=np.array([company["name"] for _, company, _ in rows], dtype=object),
+        sectors=np.array([f"{sector} {industry} {company.get('sector', '')}".lower() for (sector, industry), (_, company, _) in zip(sectors, rows)], dtype=str),
+        labels=[{"sector": sector, "industry": industry} for sector, industry in sectors],
+        columns={key: np.array([_metric(info.get(key)) for _, _, info in rows], dtype=np.float64) for key in SCREENER_COLUMNS},
+        built_at=time.time(),
+    ), missed
 
-    except Exception as e:
-        print(f"Error fetching financials for {ticker}: {e}")
-        return []
+def refresh_fundamentals() -> bool:
+    """Rebuild and publish the snapshot; False when tickers were missed (retry soon)"""
+    global fundamentals
+    with span("screener.refresh"):
+        snapshot, missed = build_fundamentals()
+    # Never replace a snapshot with a smaller one built while upstream was failing
+    if fundamentals is None or len(snapshot.tickers) >= len(fundamentals.tickers):
+        fundamentals = snapshot
+    if missed:
+        logger.warning("Screener refresh missed %d tickers, retrying in %ds", missed, SCREENER_RETRY_SECONDS)
+    return not missed
+
+async def screener_refresher():
+    loop = asyncio.get_running_loop()
+    while True:
+        complete = False
+        try:
+            complete = await loop.run_in_executor(None, refresh_fundamentals)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Screener refresh failed: %s", e)
+        await asyncio.sleep(SCREENER_REFRESH_SECONDS if complete else SCREENER_RETRY_SECONDS)
+
+async def start_screener():
+    global screener_task
+    if SCREENER_REFRESH_SECONDS > 0:
+        screener_task = asyncio.create_task(screener_refresher())
+
+async def stop_screener():
+    if screener_task:
+        screener_task.cancel()
+        await asyncio.gather(screener_task, return_exceptions=True)
+
+startup_hooks.append(start_screener)
+shutdown_hooks.append(stop_screener)
+metrics.gauge("verifin_screener_rows", "Companies in the screener's fundamentals snapshot", lambda: len(fundamentals.tickers) if fundamentals else 0)
+
+def parse_screener_filters(filters: Optional[str]) -> List[tuple]:
+    """'trailingPE<25,returnOnEquity>=0.15' -> [(column, op, value)]; HTTP 400 on anything else"""
+    parsed = []
+    for clause in (filters or "").split(","):
+        if not clause.strip():
+            continue
+        match = _SCREENER_FILTER_RE.match(clause)
+        if not match or match.group(1) not in SCREENER_COLUMNS:
+            raise HTTPException(status_code=400, detail=f"Invalid filter '{clause.strip()}'. Use <column><op><number> with one of: {', '.join(SCREENER_COLUMNS)}")
+        parsed.append((match.group(1), _SCREENER_OPS[match.group(2)], float(match.group(3))))
+    return parsed
+
+@app.get("/screener")
+async def screener(
+    filters: Optional[str] = None,
+    sector: Optional[str] = None,
+    sort: Optional[str] = None,
+    limit: int = 20,
+    offset: int = 0,
+):
+    """
+    Screen the public universe: filters=trailingPE<25,returnOnEquity>0.1 (rows with the metric
+    unknown are excluded), sector=technology (substring of sector/industry), sort=-returnOnEquity
+    (leading '-' for descending, unknowns last), limit/offset paging.
+    """
+    conditions = parse_screener_filters(filters)
+    descending = bool(sort) and sort.startswith("-")
+    sort_key = sort.lstrip("-") if sort else None
+    if sort_key and sort_key not in SCREENER_COLUMNS:
+        raise HTTPException(status_code=400, detail=f"Unknown sort column '{sort_key}'")
+    limit = max(1, min(limit, SCREENER_MAX_LIMIT))
+    offset = max(0, offset)
+
+    snapshot = fundamentals
+    if snapshot is None:
+        raise HTTPException(status_code=503, detail="Screener data is still loading, please retry shortly", headers={"Retry-After": "10"})
+
+    with span("screener"):
+        mask = np.ones(len(snapshot.tickers), dtype=bool)
+        for column, op, value in conditions:
+            mask &= op(snapshot.columns[column], value)
+        if sector:
+            mask &= np.char.find(snapshot.sectors, sector.lower().strip()) >= 0
+        rows = np.flatnonzero(mask)
+        if sort_key:
+            values = snapshot.columns[sort_key][rows]
+            # argsort puts NaN last; negating keeps that for the descending order too
+            rows = rows[np.argsort(-values if descending else values, kind="stable")]
+        page = rows[offset:offset + limit]
+
+        results = [
+            {
+                "ticker": snapshot.tickers[i],
+                "name": snapshot.names[i],
+                **snapshot.labels[i],
+                **{key: _json_metric(snapshot.columns[key][i]) for key in SCREENER_COLUMNS},
+            }
+            for i in page
+        ]
+    return {
+        "total": int(len(rows)),
+        "offset": offset,
+        "limit": limit,
+        "as_of": datetime.fromtimestamp(snapshot.built_at).strftime("%Y-%m-%d %H:%M:%S"),
+        "results": results,
+    }
+
+# ==================== PRICE ANALYTICS ====================
+# Risk/return figures from the cached monthly bars (get_historical_data). Any number of
+# tickers is aligned on one month axis as a (series x months) matrix and every statistic is
+# a whole-matrix NumPy operation, so a batch costs about the same as one ticker. Beta is
+# against the ticker's home index; prices missing for a month are NaN and skipped.
+ANALYTICS_PERIODS_PER_YEAR = 12  # monthly bars
+ANALYTICS_MIN_MONTHS = 12        # fewer overlapping returns than this -> no volatility/beta
+
+def benchmark_ticker(ticker: str) -> str:
+    return "^NSEI" if ticker.endswith((".NS", ".BO")) else "^IXIC"
+
+def _analytics_value(value, digits: int = 4) -> Optional[float]:
+    return None if not math.isfinite(value) else round(float(value), digits)
+
+def compute_price_analytics(histories: Dict[str, Optional[dict]], benchmarks: Dict[str, Optional[dict]]) -> Dict[str, Dict[str, Any]]:
+    """
+    ticker -> {cagr, volatility, max_drawdown, beta, ma_6, ma_12, months, benchmark} for every
+    ticker of histories (values are get_historical_data() results, keyed like benchmark_ticker()
+    in benchmarks). Ratios are fractions; None where the history is too short.
+    """
+    tickers = list(histories)
+    if not tickers:
+        return {}
+    bench_names = list(benchmarks)
+    series = [histories[t] for t in tickers] + [benchmarks[b] for b in bench_names]
+
+    months = sorted({bar["date"][:7] for history in series if history for bar in history["prices"]})
+    column = {month: i for i, month in enumerate(months)}
+    prices = np.full((len(series), max(len(months), 1)), np.nan)
+    for row, history in enumerate(series):
+        if history and history["prices"]:
+            bars = history["prices"]
+            prices[row, [column[bar["date"][:7]] for bar in bars]] = [
+                np.nan if bar["price"] is None else bar["price"] for bar in bars
+            ]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        n = len(tickers)
+        p = prices[:n]
+        has = np.isfinite(p)
+        rows = np.arange(n)
+
+        # CAGR between the first and last known prices
+        first = has.argmax(axis=1)
+        last = p.shape[1] - 1 - has[:, ::-1].argmax(axis=1)
+        years = (last - first) / ANALYTICS_PERIODS_PER_YEAR
+        cagr = np.where(years >= 1, (p[rows, last] / p[rows, first]) ** (1 / years) - 1, np.nan)
+
+        # Monthly returns; the benchmark row per ticker (an all-NaN row when it's missing)
+        returns = prices[:, 1:] / prices[:, :-1] - 1
+        r = returns[:n]
+        bench_rows = np.array([
+            n + bench_names.index(benchmark_ticker(t)) if benchmark_ticker(t) in bench_names else len(series)
+            for t in tickers
+        ])
+        rm = np.vstack([returns, np.full((1, returns.shape[1]), np.nan)])[bench_rows]
+
+        valid = np.isfinite(r)
+        count = valid.sum(axis=1)
+        r0 = np.where(valid, r, 0.0)
+        mean = r0.sum(axis=1) / count
+        variance = (np.where(valid, r - mean[:, None], 0.0) ** 2).sum(axis=1) / (count - 1)
+        volatility = np.where(count >= ANALYTICS_MIN_MONTHS, np.sqrt(variance * ANALYTICS_PERIODS_PER_YEAR), np.nan)
+
+        pair = valid & np.isfinite(rm)
+        pairs = pair.sum(axis=1)
+        rt = np.where(pair, r, 0.0)
+        rb = np.where(pair, rm, 0.0)
+        dt = np.where(pair, rt - (rt.sum(axis=1) / pairs)[:, None], 0.0)
+        db = np.where(pair, rb - (rb.sum(axis=1) / pairs)[:, None], 0.0)
+        beta = np.where(pairs >= ANALYTICS_MIN_MONTHS, (dt * db).sum(axis=1) / (db * db).sum(axis=1), np.nan)
+
+        # Deepest fall from a running peak (fmax skips the NaN gaps)
+        drawdown = p / np.fmax.accumulate(p, axis=1) - 1
+        max_drawdown = np.where(has.any(axis=1), np.where(np.isfinite(drawdown), drawdown, 0.0).min(axis=1), np.nan)
+
+        def moving_average(k: int):
+            window = p[:, -k:]
+            known = np.isfinite(window)
+            return np.where(known.sum(axis=1) == k, np.where(known, window, 0.0).sum(axis=1) / k, np.nan)
+        ma_6 = moving_average(6)
+        ma_12 = moving_average(12)
+
+    return {
+        ticker: {
+            "benchmark": benchmark_ticker(ticker),
+            "months": int(has[i].sum()),
+            "cagr": _analytics_value(cagr[i]),
+            "volatility": _analytics_value(volatility[i]),
+            "max_drawdown": _analytics_value(max_drawdown[i]),
+            "beta": _analytics_value(beta[i], 2),
+            "ma_6": _analytics_value(ma_6[i], 2),
+            "ma_12": _analytics_value(ma_12[i], 2),
+        }
+        for i, ticker in enumerate(tickers)
+    }
+
+def risk_label(analytics: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Low/Moderate/High from annualized volatility, nudged up by a high beta"""
+    if not analytics or analytics["volatility"] is None:
+        return None
+    volatility, beta = analytics["volatility"], analytics["beta"] or 1.0
+    if volatility < 0.20 and beta < 1.2:
+        return "Low"
+    if volatility < 0.35 and beta < 1.5:
+        return "Moderate"
+    return "High"
+
+def describe_performance(analytics: Optional[Dict[str, Any]], price_change_pct: float) -> str:
+    """Clause for the outlook text: multi-year figures when known, else the day's move"""
+    if not analytics or analytics["cagr"] is None:
+        return f"shows {'strong' if price_change_pct > 0 else 'stable'} recent performance"
+    years = analytics["months"] // 12
+    text = f"has compounded {analytics['cagr'] * 100:+.1f}% a year over {years} years"
+    if analytics["max_drawdown"] is not None:
+        text += f", with a worst peak-to-trough fall of {abs(analytics['max_drawdown']) * 100:.0f}%"
+    if analytics["ma_12"] is not None and analytics["ma_6"] is not None:
+        text += f"; its 6-month average is {'above' if analytics['ma_6'] >= analytics['ma_12'] else 'below'} the 12-month average"
+    return text
+
+def growth_label(analytics: Optional[Dict[str, Any]]) -> Optional[str]:
+    if not analytics or analytics["cagr"] is None:
+        return None
+    if analytics["cagr"] >= 0.15:
+        return "High"
+    return "Moderate" if analytics["cagr"] >= 0.05 else "Low"
 
 # ==================== COMPANY OVERVIEW ====================
 @app.post("/company-overview")
-async def company_overview(query: CompanyQuery):
+async def company_overview(query: CompanyQuery, request: Request, fields: Optional[str] = None):
     """
     Get comprehensive company overview
     Fetches data from Finnhub/FMP APIs
+    fields=price,change_pct,long_term_outlook.risk_level returns only those keys of "data"
+    """
+    overview, entry = await load_company_overview(query)
+    if fields and overview.get("success") and "data" in overview:
+        overview = {**overview, "data": select_fields(overview["data"], fields)}
+    key = f"overview:{overview.get('data', {}).get('ticker')}:{fields or ''}"
+    return cached_json_response(request, overview, key, entry)
+
+@app.get("/company-overview")
+async def company_overview_get(query: str, request: Request, fields: Optional[str] = None):
+    """Cacheable GET variant of /company-overview (ETag / If-None-Match)"""
+    return await company_overview(CompanyQuery(query=query), request, fields)
+
+def select_fields(data: Dict[str, Any], fields: str) -> Dict[str, Any]:
+    """
+    Sparse fieldset: keep the comma-separated keys of data; a dotted key (a.b) picks one
+    member of a nested object. The ticker is always kept. Unknown keys are ignored.
+    """
+    selected = {"ticker": data.get("ticker")}
+    for path in fields.split(","):
+        head, _, member = path.strip().partition(".")
+        if head not in data:
+            continue
+        value = data[head]
+        if member and isinstance(value, dict):
+            if member in value:
+                nested = selected.setdefault(head, {})
+                if nested is not value:  # the whole object isn't already selected
+                    nested[member] = value[member]
+        else:
+            selected[head] = value
+    return selected
+
+async def build_company_overview(query: CompanyQuery) -> Dict[str, Any]:
+    """Overview payload as a dict (shared by /company-overview and /company-compare)"""
+    return (await load_company_overview(query))[0]
+
+async def load_company_overview(query: CompanyQuery) -> tuple:
+    """
+    (overview, cache entry). Overviews built only from real upstream data are cached for the
+    quote TTL; when any part is missing or served stale (last-known-good) entry is None so the
+    response isn't cacheable.
     """
     try:
         # First resolve the company
         resolution = await resolve_company(query)
         
         if not resolution.get("success"):
-            return resolution
+            return resolution, None
         
         ticker = resolution["ticker"]
         company_type = resolution.get("type", "public")
         
         # Handle Private Companies Explicitly
         if company_type == "private":
-             return {
+             return ({
                 "success": True,
                 "data": {
                     "ticker": ticker,
@@ -682,24 +2402,33 @@ async def company_overview(query: CompanyQuery):
                         "last_updated": datetime.now().strftime("%Y-%m-%d")
                     }
                 }
-             }
+             }, None)
 
         # Run blocking yfinance calls in a separate thread to avoid blocking the event loop
         # Use get_running_loop() which is safer in modern asyncio/fastapi
         loop = asyncio.get_running_loop()
+        popularity.record(ticker)
+        
+        entry = await loop.run_in_executor(None, cache.get_entry, "overview", ticker)
+        if entry is not None:
+            return entry.value, entry
         
         # Execute all 3 fetches in PARALLEL for maximum speed
         t1 = loop.run_in_executor(None, get_real_stock_data, ticker)
         t2 = loop.run_in_executor(None, get_historical_data, ticker, 5)
-        t3 = loop.run_in_executor(None, get_financial_history, ticker)
+        t3 = loop.run_in_executor(None, get_financial_history_entry, ticker)
+        benchmark = benchmark_ticker(ticker)
+        t4 = loop.run_in_executor(None, get_historical_data, benchmark, 5)
         
-        real_data, historical, financial_history = await asyncio.gather(t1, t2, t3)
+        real_data, historical, statements, benchmark_history = await asyncio.gather(t1, t2, t3, t4)
+        financial_history = statements.value if statements is not None else []
+        analytics = compute_price_analytics({ticker: historical}, {benchmark: benchmark_history})[ticker]
         
         if not real_data:
             return {
                 "success": False,
                 "message": f"Unable to fetch real-time data for {ticker}. Market may be closed or ticker invalid."
-            }
+            }, None
         
         # Format numbers based on currency
         currency = real_data["currency"]
@@ -791,22 +2520,37 @@ async def company_overview(query: CompanyQuery):
             # Financial History for Revenue/Profit Chart (3-5 years)
             "financial_history": financial_history,
             
+            # Risk/return over the 5-year monthly history (fractions; None if too short)
+            "analytics": analytics,
+            
             # Long-term outlook
             "long_term_outlook": {
-                "company_perspective": f"{resolution['name']} operates in the {real_data.get('sector', 'N/A')} sector with a market cap of {format_number(real_data['market_cap'])}. The company has {real_data.get('employees', 'N/A')} employees and shows {'strong' if real_data['price_change_pct'] > 0 else 'stable'} recent performance.",
+                "company_perspective": f"{resolution['name']} operates in the {real_data.get('sector', 'N/A')} sector with a market cap of {format_number(real_data['market_cap'])}. The company has {real_data.get('employees', 'N/A')} employees and {describe_performance(analytics, real_data['price_change_pct'])}.",
                 "sector_perspective": f"The {real_data.get('sector', 'N/A')} sector continues to evolve with changing market dynamics. Companies in this space are focusing on innovation and market expansion.",
-                "risk_level": "Moderate" if real_data['pe_ratio'] and 15 < real_data['pe_ratio'] < 30 else "Variable",
-                "growth_potential": "High" if real_data['price_change_pct'] > 5 else "Moderate",
+                "risk_level": risk_label(analytics) or ("Moderate" if real_data['pe_ratio'] and 15 < real_data['pe_ratio'] < 30 else "Variable"),
+                "growth_potential": growth_label(analytics) or ("High" if real_data['price_change_pct'] > 5 else "Moderate"),
                 "last_updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             }
         }
         
+        stale_since = [part["as_of"] for part in (real_data, historical or {}) if part.get("stale")]
+        if statements is not None and statements.stale:
+            stale_since.append(statements.stored_at)
+        if stale_since:
+            # Served from the last-known-good store: say so and how old the oldest part is
+            overview_data["stale"] = True
+            overview_data["as_of"] = datetime.fromtimestamp(min(stale_since)).strftime("%Y-%m-%d %H:%M:%S")
         
-        return {
+        overview = {
             "success": True,
             "data": overview_data
         }
+        if stale_since or not historical or not financial_history:
+            return overview, None
+        return overview, await loop.run_in_executor(None, cache.set, "overview", ticker, overview)
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -818,8 +2562,8 @@ async def company_compare(query: CompanyCompareQuery):
     """
     try:
         # Run both requests in parallel to prevent timeouts
-        task1 = company_overview(CompanyQuery(query=query.company1))
-        task2 = company_overview(CompanyQuery(query=query.company2))
+        task1 = build_company_overview(CompanyQuery(query=query.company1))
+        task2 = build_company_overview(CompanyQuery(query=query.company2))
         
         company1_data, company2_data = await asyncio.gather(task1, task2)
         
@@ -854,15 +2598,31 @@ async def company_compare(query: CompanyCompareQuery):
                 else:
                     valuation_msg = f"{c2['name']} ({pe2_val}) is trading at a premium compared to {c1['name']} ({pe1_val})."
         
-        # Growth/Performance Analysis
-        change1 = float(c1['change_pct'].replace('%','').replace('+',''))
-        change2 = float(c2['change_pct'].replace('%','').replace('+',''))
-        
-        growth_msg = "Both companies showing stable performance."
-        if change1 > change2:
-             growth_msg = f"{c1['name']} is showing stronger recent momentum ({c1['change_pct']}) compared to {c2['name']} ({c2['change_pct']})."
+        # Growth/Performance Analysis: multi-year CAGR when both histories allow it, else the day's move
+        a1 = c1.get("analytics") or {}
+        a2 = c2.get("analytics") or {}
+        if a1.get("cagr") is not None and a2.get("cagr") is not None:
+            change1, change2 = a1["cagr"], a2["cagr"]
+            leader, laggard = (c1, c2) if change1 > change2 else (c2, c1)
+            growth_msg = f"{leader['name']} has compounded faster ({max(change1, change2) * 100:+.1f}% a year) than {laggard['name']} ({min(change1, change2) * 100:+.1f}% a year) over the last 5 years."
         else:
-             growth_msg = f"{c2['name']} is outperforming {c1['name']} in recent trading with {c2['change_pct']} growth."
+            change1 = float(c1['change_pct'].replace('%','').replace('+',''))
+            change2 = float(c2['change_pct'].replace('%','').replace('+',''))
+            
+            growth_msg = "Both companies showing stable performance."
+            if change1 > change2:
+                 growth_msg = f"{c1['name']} is showing stronger recent momentum ({c1['change_pct']}) compared to {c2['name']} ({c2['change_pct']})."
+            else:
+                 growth_msg = f"{c2['name']} is outperforming {c1['name']} in recent trading with {c2['change_pct']} growth."
+        
+        # Risk Analysis: volatility, beta and drawdown when known
+        risk_msg = f"Market Cap: {c1['name']} ({c1['marketCap']}) vs {c2['name']} ({c2['marketCap']}). Larger cap generally implies lower volatility."
+        if a1.get("volatility") is not None and a2.get("volatility") is not None:
+            calmer, riskier = (c1, c2) if a1["volatility"] < a2["volatility"] else (c2, c1)
+            def risk_figures(a):
+                beta = f", beta {a['beta']:.2f} vs {a['benchmark']}" if a.get("beta") is not None else ""
+                return f"{a['volatility'] * 100:.0f}% annualized volatility{beta}, max drawdown {abs(a['max_drawdown'] or 0) * 100:.0f}%"
+            risk_msg = f"{calmer['name']} has been steadier ({risk_figures(calmer['analytics'])}) than {riskier['name']} ({risk_figures(riskier['analytics'])})."
 
         comparison = {
             "success": True,
@@ -871,37 +2631,508 @@ async def company_compare(query: CompanyCompareQuery):
             "analysis": {
                 "valuation": valuation_msg,
                 "growth": growth_msg,
-                "risk": f"Market Cap: {c1['name']} ({c1['marketCap']}) vs {c2['name']} ({c2['marketCap']}). Larger cap generally implies lower volatility.",
+                "risk": risk_msg,
                 "recommendation": f"Consider {c1['name']} for {'growth' if change1 > change2 else 'value'} and {c2['name']} for {'growth' if change2 > change1 else 'stability'}."
             }
         }
         
-        return comparison
+        return FastJSONResponse(comparison)
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# ==================== LIVE QUOTES (WEBSOCKET) ====================
+# Clients subscribe to tickers over /ws/quotes. One poller per process refreshes the union of
+# subscribed symbols with a single batched yf.download per interval and pushes each client
+# only the fields that changed for its symbols, so upstream load is O(symbols), not O(clients).
+#   client -> {"action": "subscribe", "tickers": ["AAPL", "TCS.NS"]} / {"action": "unsubscribe", ...}
+#   server -> {"type": "snapshot" | "quotes", "data": {"AAPL": {"price": ..., ...}}, "ts": ...}
+QUOTE_POLL_INTERVAL = float(os.getenv("QUOTE_POLL_INTERVAL", "15"))
+WS_MAX_TICKERS = 50
+WS_SEND_TIMEOUT = 5.0
+_WS_TICKER_RE = re.compile(r"^[A-Z0-9^][A-Z0-9.\-=^]{0,19}$")
+
+def fetch_quotes_batch(tickers: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Last close, previous close and volume for many tickers in one yfinance request"""
+    with upstream_slot("quote"), span("yfinance.download"):
+        frame = yf.download(tickers, period="5d", interval="1d", group_by="ticker", progress=False, auto_adjust=False)
+    quotes = {}
+    if frame is None or frame.empty:
+        return quotes
+    grouped = getattr(frame.columns, "nlevels", 1) > 1
+    for ticker in tickers:
+        try:
+            bars = frame[ticker] if grouped else frame
+            closes = bars["Close"].dropna()
+            if closes.empty:
+                continue
+            price = float(closes.iloc[-1])
+            prev_close = float(closes.iloc[-2]) if len(closes) > 1 else price
+            volumes = bars["Volume"].dropna()
+            change = price - prev_close
+            quotes[ticker] = {
+                "price": round(price, 4),
+                "previous_close": round(prev_close, 4),
+                "change": round(change, 4),
+                "change_pct": round(change / prev_close * 100, 4) if prev_close else 0.0,
+                "volume": int(volumes.iloc[-1]) if not volumes.empty else 0,
+                "currency": "₹" if ".NS" in ticker or ".BO" in ticker else "$"
+            }
+        except (KeyError, IndexError, ValueError) as e:
+            logger.debug("No batched quote for %s: %s", ticker, e, extra={"sample": 0.1})
+    return quotes
+
+class QuoteHub:
+    """Subscription registry plus the single upstream poller and delta fan-out"""
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.subscriptions: Dict[Any, set] = {}  # websocket -> tickers
+        self.latest: Dict[str, Dict[str, Any]] = {}  # last pushed quote per ticker
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def symbols(self) -> set:
+        return set().union(*self.subscriptions.values()) if self.subscriptions else set()
+
+    async def subscribe(self, websocket, tickers: List[str]):
+        current = self.subscriptions.setdefault(websocket, set())
+        current.update(tickers)
+        known = {t: self.latest[t] for t in tickers if t in self.latest}
+        if known:
+            await self.send(websocket, {"type": "snapshot", "data": known, "ts": time.time()})
+        if len(known) < len(tickers):
+            self._wake.set()  # fetch the new symbols now rather than at the next tick
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def unsubscribe(self, websocket, tickers: Optional[List[str]] = None):
+        if tickers is None:
+            self.subscriptions.pop(websocket, None)
+        elif websocket in self.subscriptions:
+            self.subscriptions[websocket].difference_update(tickers)
+        for ticker in set(self.latest) - self.symbols:
+            del self.latest[ticker]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self.subscriptions:
+            woken = False
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+                woken = True
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            symbols = self.symbols
+            # A wake-up only fetches the symbols nobody has a quote for yet
+            tickers = sorted(symbols - set(self.latest) if woken else symbols)
+            if not tickers:
+                continue
+            try:
+                quotes = await loop.run_in_executor(None, fetch_quotes_batch, tickers)
+            except Exception as e:
+                logger.warning("Quote poll failed for %d tickers: %s", len(tickers), e, extra={"sample": 0.1})
+                continue
+            metrics.inc("verifin_quote_polls_total")
+            await self._publish(quotes)
+
+    async def _publish(self, quotes: Dict[str, Dict[str, Any]]):
+        deltas = {}
+        for ticker, quote in quotes.items():
+            previous = self.latest.get(ticker)
+            changed = quote if previous is None else {k: v for k, v in quote.items() if previous.get(k) != v}
+            if changed:
+                deltas[ticker] = changed
+                self.latest[ticker] = quote
+        if not deltas:
+            return
+        now = time.time()
+        sends = []
+        for websocket, tickers in list(self.subscriptions.items()):
+            data = {t: deltas[t] for t in tickers if t in deltas}
+            if data:
+                sends.append(self.send(websocket, {"type": "quotes", "data": data, "ts": now}))
+        await asyncio.gather(*sends)
+
+    async def send(self, websocket, message: Dict[str, Any]):
+        """Send or drop the client: a slow or closed socket never holds up the others"""
+        try:
+            await asyncio.wait_for(websocket.send_text(dumps_json(message).decode("utf-8")), WS_SEND_TIMEOUT)
+        except Exception:
+            self.unsubscribe(websocket)
+
+    async def stop(self):
+        self.subscriptions.clear()
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+quote_hub: Optional[QuoteHub] = None
+
+def get_quote_hub() -> QuoteHub:
+    global quote_hub
+    if quote_hub is None:
+        quote_hub = QuoteHub(QUOTE_POLL_INTERVAL)
+    return quote_hub
+
+async def stop_quote_hub():
+    if quote_hub is not None:
+        await quote_hub.stop()
+
+shutdown_hooks.append(stop_quote_hub)
+metrics.describe("verifin_quote_polls_total", "counter", "Batched upstream quote polls made for WebSocket subscribers")
+metrics.gauge("verifin_ws_connections", "Open /ws/quotes connections", lambda: len(quote_hub.subscriptions) if quote_hub else 0)
+metrics.gauge("verifin_ws_symbols", "Distinct tickers polled for WebSocket subscribers", lambda: len(quote_hub.symbols) if quote_hub else 0)
+
+@app.websocket("/ws/quotes")
+async def quotes_websocket(websocket: WebSocket):
+    """Live quote deltas for the subscribed tickers"""
+    await websocket.accept()
+    hub = get_quote_hub()
+    try:
+        while True:
+            try:
+                message = json.loads(await websocket.receive_text())
+                action = message.get("action")
+                tickers = [str(t).strip().upper() for t in message.get("tickers", [])]
+            except (ValueError, AttributeError, TypeError):
+                await hub.send(websocket, {"type": "error", "detail": "Expected a JSON object"})
+                continue
+            invalid = [t for t in tickers if not _WS_TICKER_RE.match(t)]
+            if invalid or action not in ("subscribe", "unsubscribe"):
+                detail = f"Invalid tickers: {', '.join(invalid)}" if invalid else "action must be subscribe or unsubscribe"
+                await hub.send(websocket, {"type": "error", "detail": detail})
+                continue
+            if action == "unsubscribe":
+                hub.unsubscribe(websocket, tickers)
+            elif len(hub.subscriptions.get(websocket, set()) | set(tickers)) > WS_MAX_TICKERS:
+                await hub.send(websocket, {"type": "error", "detail": f"At most {WS_MAX_TICKERS} tickers per connection"})
+            else:
+                await hub.subscribe(websocket, tickers)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        hub.unsubscribe(websocket)
+
+# ==================== HISTORY EXPORT ====================
+# /history/export streams OHLCV bars for many tickers as CSV or Arrow IPC, one ticker's block
+# at a time. Bars are cached per (ticker, range, interval) as NumPy columns; the Arrow record
+# batches wrap those arrays without copying. At most EXPORT_PREFETCH tickers are in flight, so
+# memory stays bounded by a few tickers' bars whatever the size of the list.
+try:
+    PYARROW_AVAILABLE = importlib.util.find_spec("pyarrow") is not None
+except ValueError:
+    PYARROW_AVAILABLE = False
+pa = LazyModule("pyarrow")  # optional: only for format=arrow
+
+EXPORT_MAX_TICKERS = 500
+EXPORT_PREFETCH = 4
+EXPORT_RANGES = ("1mo", "3mo", "6mo", "1y", "2y", "5y", "10y", "max")
+EXPORT_INTERVALS = ("1d", "1wk", "1mo")
+EXPORT_COLUMNS = ("open", "high", "low", "close", "volume")
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+def fetch_price_bars(ticker: str, period: str, interval: str) -> Optional[Dict[str, Any]]:
+    """OHLCV bars as NumPy columns (date as datetime64[D]), or None if Yahoo has none"""
+    stock = yf.Ticker(ticker)
+    with upstream_slot("history"), span("yfinance.history"):
+        hist = stock.history(period=period, interval=interval)
+    if hist.empty:
+        return None
+    index = hist.index.tz_localize(None) if hist.index.tz is not None else hist.index
+    return {
+        "date": index.values.astype("datetime64[D]"),
+        "open": hist["Open"].to_numpy(np.float64),
+        "high": hist["High"].to_numpy(np.float64),
+        "low": hist["Low"].to_numpy(np.float64),
+        "close": hist["Close"].to_numpy(np.float64),
+        "volume": hist["Volume"].fillna(0).to_numpy(np.int64),
+    }
+
+def get_price_bars(ticker: str, period: str, interval: str) -> Optional[Dict[str, Any]]:
+    try:
+        entry = market_data("history", f"{ticker}:{period}:{interval}", lambda: fetch_price_bars(ticker, period, interval))
+    except UpstreamThrottled:
+        entry = None
+    if entry is None:
+        metrics.inc("verifin_export_skipped_total")
+        logger.warning("History export skipped %s: no data", ticker, extra={"sample": 0.1})
+        return None
+    return entry.value
+
+def _csv_number(value: float) -> str:
+    return "" if value != value else repr(value)  # NaN -> empty field
+
+def bars_to_csv(ticker: str, bars: Dict[str, Any]) -> bytes:
+    dates = np.datetime_as_string(bars["date"], unit="D")
+    prices = [[_csv_number(x) for x in bars[c].tolist()] for c in ("open", "high", "low", "close")]
+    rows = zip(dates, *prices, bars["volume"].tolist())
+    return "".join(f"{ticker},{d},{o},{h},{l},{c},{v}\n" for d, o, h, l, c, v in rows).encode()
+
+def arrow_export_schema():
+    return pa.schema([
+        ("ticker", pa.string()), ("date", pa.date32()),
+        ("open", pa.float64()), ("high", pa.float64()), ("low", pa.float64()), ("close", pa.float64()),
+        ("volume", pa.int64()),
+    ])
+
+class ArrowStreamBuffer:
+    """Write-only file object for pa.ipc.new_stream; take() hands over what was written so far"""
+    def __init__(self):
+        self._parts = []
+        self.closed = False
+
+    def write(self, data) -> int:
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts.clear()
+        return data
+
+async def iter_price_bars(tickers: List[str], period: str, interval: str):
+    """(ticker, bars) in request order, fetching up to EXPORT_PREFETCH tickers ahead"""
+    loop = asyncio.get_running_loop()
+    pending = deque()
+    remaining = iter(tickers)
+    try:
+        for ticker in itertools.islice(remaining, EXPORT_PREFETCH):
+            pending.append((ticker, loop.run_in_executor(None, get_price_bars, ticker, period, interval)))
+        while pending:
+            ticker, future = pending.popleft()
+            bars = await future
+            for next_ticker in itertools.islice(remaining, 1):
+                pending.append((next_ticker, loop.run_in_executor(None, get_price_bars, next_ticker, period, interval)))
+            if bars is not None:
+                yield ticker, bars
+    finally:
+        for _, future in pending:
+            future.cancel()
+
+@app.get("/history/export")
+async def export_history(
+    tickers: str,
+    period: str = Query("5y", alias="range"),
+    interval: str = "1mo",
+    fmt: str = Query("csv", alias="format"),
+):
+    """
+    Stream OHLCV history for a comma-separated ticker list as CSV (default) or Arrow IPC
+    stream (format=arrow, needs pyarrow). Tickers without data are left out.
+    """
+    symbols = list(dict.fromkeys(t.strip().upper() for t in tickers.split(",") if t.strip()))
+    if not symbols or len(symbols) > EXPORT_MAX_TICKERS:
+        raise HTTPException(status_code=400, detail=f"Give between 1 and {EXPORT_MAX_TICKERS} tickers")
+    invalid = [t for t in symbols if not _WS_TICKER_RE.match(t)]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"Invalid tickers: {', '.join(invalid[:10])}")
+    if period not in EXPORT_RANGES or interval not in EXPORT_INTERVALS:
+        raise HTTPException(status_code=400, detail=f"range must be one of {', '.join(EXPORT_RANGES)}; interval one of {', '.join(EXPORT_INTERVALS)}")
+    if fmt not in ("csv", "arrow"):
+        raise HTTPException(status_code=400, detail="format must be csv or arrow")
+    if fmt == "arrow" and not PYARROW_AVAILABLE:
+        raise HTTPException(status_code=400, detail="Arrow export is not available on this server (pyarrow not installed); use format=csv")
+
+    filename = f"verifin_history_{period}_{interval}.{'arrows' if fmt == 'arrow' else 'csv'}"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"', "Cache-Control": "no-store"}
+
+    async def csv_stream():
+        yield b"ticker,date,open,high,low,close,volume\n"
+        async for ticker, bars in iter_price_bars(symbols, period, interval):
+            yield bars_to_csv(ticker, bars)
+
+    async def arrow_stream():
+        schema = arrow_export_schema()
+        sink = ArrowStreamBuffer()
+        writer = pa.ipc.new_stream(sink, schema)
+        yield sink.take()
+        async for ticker, bars in iter_price_bars(symbols, period, interval):
+            columns = [pa.array(np.full(len(bars["date"]), ticker, dtype=object), pa.string()), pa.array(bars["date"], pa.date32())]
+            columns += [pa.array(bars[c]) for c in EXPORT_COLUMNS]  # float64/int64 without nulls: no copy
+            writer.write_batch(pa.RecordBatch.from_arrays(columns, schema=schema))
+            yield sink.take()
+        writer.close()
+        yield sink.take()
+
+    if fmt == "arrow":
+        return StreamingResponse(arrow_stream(), media_type=ARROW_STREAM_MEDIA_TYPE, headers=headers)
+    return StreamingResponse(csv_stream(), media_type="text/csv", headers=headers)
+
+metrics.describe("verifin_export_skipped_total", "counter", "Tickers left out of /history/export for lack of data")
+
+# ==================== CHAT SESSIONS ====================
+# /chat keeps each conversation server-side (the "chat" cache namespace, shared by workers)
+# as a rolling summary plus the recent turns. Prompts include the summary and as many recent
+# turns as fit in CHAT_HISTORY_TOKENS. Once the turns outgrow that budget, the older ones are
+# folded into the summary by a background Gemini call after the response is sent, so neither
+# per-turn latency nor prompt size grows with the conversation. Every read-modify-write of a
+# session holds a lease in the shared cache, so concurrent turns (on any worker) and the
+# summary update never overwrite each other's changes.
+CHAT_HISTORY_TOKENS = int(os.getenv("CHAT_HISTORY_TOKENS", "1500"))
+CHAT_KEEP_TURNS = 4           # newest turns never folded into the summary
+CHAT_SUMMARY_CHARS = 2000
+CHAT_LOCK_TTL = 10            # seconds a session lease is held at most
+CHAT_LOCK_WAIT = 5.0          # seconds to wait for it before writing anyway
+_SESSION_ID_RE = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+chat_compactions: Dict[str, asyncio.Task] = {}  # session id -> running compaction
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token for English)"""
+    return len(text) // 4 + 1
+
+def new_chat_session() -> Dict[str, Any]:
+    return {"summary": "", "turns": [], "next_seq": 0}
+
+def load_chat_session(session_id: str) -> Dict[str, Any]:
+    return cache.get("chat", session_id) or new_chat_session()
+
+@contextmanager
+def chat_session_lock(session_id: str):
+    """Hold the session's lease (blocking); after CHAT_LOCK_WAIT, go ahead last-writer-wins"""
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + CHAT_LOCK_WAIT
+    while not (acquired := cache.add("lease", f"chat:{session_id}", token, CHAT_LOCK_TTL)):
+        if time.monotonic() >= deadline:
+            logger.warning("Chat session %s is still locked, writing without the lease", session_id)
+            break
+        time.sleep(0.02)
+    try:
+        yield
+    finally:
+        # Only release our own lease (it may have expired and been taken over)
+        lease = cache.peek("lease", f"chat:{session_id}") if acquired else None
+        if lease is not None and lease.value == token:
+            cache.delete("lease", f"chat:{session_id}")
+
+def save_chat_turns(session_id: str, message: str, reply: str) -> Dict[str, Any]:
+    with chat_session_lock(session_id):
+        session = load_chat_session(session_id)
+        for role, text in (("user", message), ("assistant", reply)):
+            session["turns"].append({"seq": session["next_seq"], "role": role, "text": text})
+            session["next_seq"] += 1
+        cache.set("chat", session_id, session)
+    return session
+
+def chat_history_prompt(session: Dict[str, Any]) -> str:
+    """Summary plus the newest turns that fit the token budget, oldest first"""
+    budget = CHAT_HISTORY_TOKENS - estimate_tokens(session["summary"])
+    recent = []
+    for turn in reversed(session["turns"]):
+        line = f"{'User' if turn['role'] == 'user' else 'VeriFin AI'}: {turn['text']}"
+        budget -= estimate_tokens(line)
+        if budget < 0:
+            break
+        recent.append(line)
+    parts = []
+    if session["summary"]:
+        parts.append(f"Summary of the earlier conversation: {session['summary']}")
+    if recent:
+        parts.append("Recent messages:\n" + "\n".join(reversed(recent)))
+    return "\n\n".join(parts)
+
+def needs_compaction(session: Dict[str, Any]) -> bool:
+    return (len(session["turns"]) > CHAT_KEEP_TURNS
+            and sum(estimate_tokens(t["text"]) for t in session["turns"]) > CHAT_HISTORY_TOKENS)
+
+def compact_chat_session(session_id: str):
+    """Fold all but the newest CHAT_KEEP_TURNS turns into the rolling summary"""
+    session = load_chat_session(session_id)
+    old_turns = session["turns"][:-CHAT_KEEP_TURNS]
+    if not old_turns:
+        return
+    transcript = "\n".join(f"{'User' if t['role'] == 'user' else 'Assistant'}: {t['text']}" for t in old_turns)
+    summary = None
+    model = get_gemini_model()
+    if model:
+        prompt = f"""Update the running summary of a conversation between a user and a financial assistant.
+Keep the companies, figures, preferences and open questions that later messages may refer to.
+Reply with the summary only, under {CHAT_SUMMARY_CHARS // 5} words.
+
+CURRENT SUMMARY: {session['summary'] or '(none)'}
+
+NEW MESSAGES:
+{transcript}"""
+        try:
+            with span("gemini.chat_summary"):
+                response = model.generate_content(prompt)
+            summary = (response.text or "").strip() or None
+        except Exception as e:
+            logger.warning("Chat summarization failed: %s", e)
+    if summary is None:
+        # No model: keep what the user asked about, which is what follow-ups lean on
+        metrics.inc("verifin_fallbacks_total", kind="chat_summary_truncate")
+        asked = "; ".join(t["text"][:200] for t in old_turns if t["role"] == "user")
+        summary = f"{session['summary']} Earlier the user asked: {asked}".strip()
+
+    # Re-read: turns may have been added while the summary was being written
+    last_folded = old_turns[-1]["seq"]
+    with chat_session_lock(session_id):
+        session = load_chat_session(session_id)
+        session["summary"] = summary[-CHAT_SUMMARY_CHARS:]
+        session["turns"] = [t for t in session["turns"] if t["seq"] > last_folded]
+        cache.set("chat", session_id, session)
+
+async def compact_chat_session_later(session_id: str):
+    try:
+        loop = asyncio.get_running_loop()
+        with span("chat.compaction"):
+            await loop.run_in_executor(None, compact_chat_session, session_id)
+    except Exception as e:
+        logger.warning("Chat compaction failed for %s: %s", session_id, e)
+    finally:
+        chat_compactions.pop(session_id, None)
+
+async def record_chat_turns(session_id: str, message: str, reply: str):
+    """Store the exchange, then compact in the background if the turns are over budget"""
+    loop = asyncio.get_running_loop()
+    session = await loop.run_in_executor(None, save_chat_turns, session_id, message, reply)
+    if needs_compaction(session) and session_id not in chat_compactions:
+        chat_compactions[session_id] = asyncio.create_task(compact_chat_session_later(session_id))
+
+async def stop_chat_compactions():
+    tasks = list(chat_compactions.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+shutdown_hooks.append(stop_chat_compactions)
+
 # ==================== AI CHAT ====================
 @app.post("/chat")
 async def chat(query: ChatQuery):
     """
     AI-powered financial chat assistant
-    Uses Google Gemini AI with pattern-based fallback
+    Uses Google Gemini AI with pattern-based fallback; pass the returned session_id to continue a conversation
     """
+    if query.session_id is not None and not _SESSION_ID_RE.match(query.session_id):
+        raise HTTPException(status_code=422, detail="session_id must be 8-64 letters, digits, '-' or '_'")
     try:
         message = query.message.strip()
         context = query.context or {}
+        session_id = query.session_id or uuid.uuid4().hex
+        loop = asyncio.get_running_loop()
+        session = await loop.run_in_executor(None, load_chat_session, session_id)
+        history = chat_history_prompt(session)
         
         agent_name = "VeriFin AI"
         warning = "⚠️ I'm a financial intelligence agent. My responses are for informational purposes only and not financial advice. Always consult a certified financial advisor before making investment decisions."
         
         # Try Gemini AI first
-        print(f"🔍 Received message: {message}")
-        print(f"🤖 Gemini model available: {gemini_model is not None}")
+        model = get_gemini_model()
+        logger.debug("Chat message received (%d chars, gemini=%s)", len(message), model is not None, extra={"sample": 0.01})
         
-        if gemini_model:
+        if model:
             try:
-                print("🚀 Attempting Gemini API call...")
                 # Create financial expert prompt
                 system_prompt = f"""You are VeriFin AI, an expert financial intelligence assistant specializing in:
 - Stock market analysis and Indian stock markets (NSE/BSE)
@@ -918,16 +3149,19 @@ Key guidelines:
 5. Recommend professional financial advisors for investment decisions
 6. Use examples of real companies when helpful (TCS, Reliance, Infosys, etc.)
 
+{history}
+
 User question: {message}
 
 Provide a helpful, accurate response. Keep it under 200 words unless the question requires detail."""
 
-                response = gemini_model.generate_content(system_prompt)
-                print(f"✅ Gemini responded! Response type: {type(response)}")
-                print(f"📝 Has text: {hasattr(response, 'text')}")
+                # Blocking SDK call: keep it off the event loop so concurrent chats overlap
+                with span("gemini.chat"):
+                    response = await loop.run_in_executor(None, model.generate_content, system_prompt)
                 
                 if response and response.text:
-                    print(f"🎉 SUCCESS! Gemini response length: {len(response.text)}")
+                    logger.debug("Gemini chat response: %d chars", len(response.text), extra={"sample": 0.01})
+                    await record_chat_turns(session_id, message, response.text)
                     return {
                         "success": True,
                         "response": response.text + f"\n\n{warning}",
@@ -935,13 +3169,15 @@ Provide a helpful, accurate response. Keep it under 200 words unless the questio
                         "warning": warning,
                         "timestamp": time.time(),
                         "powered_by": "Google Gemini AI",
-                        "context_aware": bool(context)
+                        "context_aware": bool(context),
+                        "session_id": session_id
                     }
             except Exception as gemini_error:
-                print(f"❌ Gemini error: {type(gemini_error).__name__}: {gemini_error}")
+                logger.warning("Gemini chat error: %s: %s", type(gemini_error).__name__, gemini_error)
                 # Fall through to pattern-based responses
         
         # Fallback: Pattern-based responses
+        metrics.inc("verifin_fallbacks_total", kind="chat_pattern")
         message_lower = message.lower()
         
         # Financial responses (kept as fallback)
@@ -963,6 +3199,7 @@ Provide a helpful, accurate response. Keep it under 200 words unless the questio
         else:
             response_text = "I can help you with financial analysis! Try asking about:\n- Investment strategies\n- Company comparisons\n- P/E ratios and metrics\n- Long-term investing\n- Sector analysis\n\nOr use the Search tab to analyze specific companies!"
         
+        await record_chat_turns(session_id, message, response_text)
         return {
             "success": True,
             "response": response_text + f"\n\n{warning}",
@@ -970,270 +3207,1293 @@ Provide a helpful, accurate response. Keep it under 200 words unless the questio
             "warning": warning,
             "timestamp": time.time(),
             "powered_by": "Pattern matching (Gemini unavailable)",
-            "context_aware": bool(context)
+            "context_aware": bool(context),
+            "session_id": session_id
         }
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# ==================== DOCUMENT SIGNAL SCANNER ====================
+# Keyword/regex signals used when Gemini is unavailable or misses a field.
+# Each page is lowercased once; keywords and phrases are counted/located with str.count and
+# str.find (C-speed, and counted exactly like the original full-text str.count, overlaps
+# included); regexes only run for the revenue/net profit figures.
+POSITIVE_WORDS = ('growth', 'profit', 'strong')
+NEGATIVE_WORDS = ('loss', 'decline', 'risk')
+DOC_TYPE_PHRASES = ('annual report', 'financial year', 'quarterly', 'balance sheet')
+STATEMENT_HEADINGS = {
+    'statement of profit and loss': 'Profit & Loss',
+    'profit and loss': 'Profit & Loss',
+    'income statement': 'Profit & Loss',
+    'statement of cash flows': 'Cash Flow',
+    'cash flow statement': 'Cash Flow',
+    'balance sheet': 'Balance Sheet',
+}
+
+_AMOUNT = r'(?:rs\.?|₹)?\s*([\d,]+\.?\d*)'
+# Figures searched on the lowercased page (no IGNORECASE); the key is the financial_data field
+_VALUE_RES = {
+    'revenue': (('revenue',), re.compile(rf'revenue[:\s]+{_AMOUNT}')),
+    'net_profit': (('net profit', 'pat'), re.compile(rf'(?:net profit|pat)[:\s]+{_AMOUNT}')),
+}
+_COMPANY_WORDS = ('limited', 'ltd', 'inc', 'corporation')
+
+class DocumentSignalScanner:
+    """
+    Page-at-a-time scanner for the fallback document analysis.
+    Feed pages in order with scan_page(); sentiment words, document type phrases,
+    revenue/profit figures and the company line are collected from one lowercased copy
+    of each page, together with page-located matches the UI can cite.
+    """
+    MAX_CITATIONS_PER_SIGNAL = 5
+    COMPANY_PAGES = 5
+    COMPANY_LINES = 50
+    # A statement heading only marks a table candidate page when it sits at the top of the page
+    STATEMENT_HEADING_WINDOW = 300
+
+    def __init__(self):
+        self.positive_count = 0
+        self.negative_count = 0
+        self.doc_type_pages: Dict[str, int] = {}
+        self.values: Dict[str, str] = {}
+        self.company_name: Optional[str] = None
+        self.citations: List[Dict[str, Any]] = []
+        self._citation_counts: Dict[str, int] = {}
+
+    def _cite(self, signal: str, page: int, text: str, start: int, end: int):
+        if self._citation_counts.get(signal, 0) >= self.MAX_CITATIONS_PER_SIGNAL:
+            return
+        self._citation_counts[signal] = self._citation_counts.get(signal, 0) + 1
+        snippet = text[max(0, start - 60):end + 60].replace('\n', ' ').strip()
+        self.citations.append({"signal": signal, "page": page, "match": text[start:end], "snippet": snippet})
+
+    def scan_page(self, page: int, text: str) -> List[str]:
+        """
+        Scan one page's text (page numbers are 1-based).
+        Returns the financial statements whose heading opens this page, in order.
+        """
+        lower = text.lower()
+        # Offsets found in lower index the original text unless lowercasing changed its length
+        source = text if len(lower) == len(text) else lower
+
+        self.positive_count += sum(lower.count(w) for w in POSITIVE_WORDS)
+        self.negative_count += sum(lower.count(w) for w in NEGATIVE_WORDS)
+
+        for phrase in DOC_TYPE_PHRASES:
+            if phrase not in self.doc_type_pages:
+                start = lower.find(phrase)
+                if start >= 0:
+                    self.doc_type_pages[phrase] = page
+                    self._cite('document_type', page, source, start, start + len(phrase))
+
+        for field, (keywords, pattern) in _VALUE_RES.items():
+            if field in self.values and self._citation_counts.get(field, 0) >= self.MAX_CITATIONS_PER_SIGNAL:
+                continue
+            if not any(k in lower for k in keywords):
+                continue
+            for m in pattern.finditer(lower):
+                self.values.setdefault(field, m.group(1))
+                self._cite(field, page, source, m.start(), m.end())
+                if self._citation_counts.get(field, 0) >= self.MAX_CITATIONS_PER_SIGNAL:
+                    break
+
+        # Statement headings near the top of the page, in the order they appear
+        found = []
+        head = lower[:self.STATEMENT_HEADING_WINDOW + max(map(len, STATEMENT_HEADINGS))]
+        for heading, statement in STATEMENT_HEADINGS.items():
+            start = head.find(heading)
+            if 0 <= start < self.STATEMENT_HEADING_WINDOW:
+                found.append((start, statement))
+        statements = []
+        for _, statement in sorted(found):
+            if statement not in statements:
+                statements.append(statement)
+
+        if self.company_name is None and page <= self.COMPANY_PAGES:
+            for line in text.split('\n', self.COMPANY_LINES)[:self.COMPANY_LINES]:
+                line = line.strip()
+                if len(line) > 5 and any(word in line.lower() for word in _COMPANY_WORDS):
+                    self.company_name = line
+                    self.citations.append({"signal": "company", "page": page, "match": line, "snippet": line})
+                    break
+        return statements
+
+    @property
+    def document_type(self) -> str:
+        if 'annual report' in self.doc_type_pages or 'financial year' in self.doc_type_pages:
+            return "Annual Report"
+        if 'quarterly' in self.doc_type_pages:
+            return "Quarterly Report"
+        if 'balance sheet' in self.doc_type_pages:
+            return "Balance Sheet"
+        return "General Financial Document"
+
+    @property
+    def sentiment(self) -> str:
+        if self.positive_count > self.negative_count:
+            return "Positive"
+        if self.negative_count > self.positive_count:
+            return "Negative"
+        return "Neutral"
+
+# ==================== FINANCIAL STATEMENT TABLES ====================
+# Table detection is slow, so it only runs on pages whose heading is a statement title
+MAX_STATEMENT_PAGES = 12
+STATEMENT_LINE_ITEMS = {
+    # field: row labels in order of preference
+    "revenue": ("revenue from operations", "total revenue", "revenue", "total income"),
+    "net_profit": ("profit for the year", "profit for the period", "net profit", "profit after tax", "net income"),
+    "total_assets": ("total assets",),
+    "eps": ("diluted eps", "basic eps", "earnings per share"),
+}
+_NUMBER_CELL_RE = re.compile(r'^\(?-?(?:rs\.?|₹|\$)?\s*[\d,]+(?:\.\d+)?\)?$', re.IGNORECASE)
+
+def _clean_cell(cell) -> str:
+    return " ".join(str(cell).split()) if cell is not None else ""
+
+def extract_statement_tables(page, page_number: int, statement: str) -> List[Dict[str, Any]]:
+    """
+    Pull the tables on a statement page into structured rows/columns
+    using PyMuPDF table detection (ruled tables first, then text alignment)
+    """
+    tables = []
+    for strategy in ("lines", "text"):
+        try:
+            found = page.find_tables(strategy=strategy).tables
+        except Exception as e:
+            logger.warning("Table detection (%s) failed on page %d: %s", strategy, page_number, e)
+            continue
+        for table in found:
+            rows = [[_clean_cell(c) for c in row] for row in table.extract()]
+            rows = [row for row in rows if any(row)]
+            if len(rows) < 2:
+                continue
+            tables.append({
+                "statement": statement,
+                "page": page_number,
+                "columns": rows[0],
+                "rows": rows[1:]
+            })
+        if tables:
+            break
+    return tables
+
+def statement_line_items(tables: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    Pick headline figures (revenue, net profit, assets, EPS) out of extracted statement rows.
+    Takes the first figure after the row label, i.e. the current period column.
+    """
+    items = {}
+    ranks = {}
+    for table in tables:
+        # Statements usually carry a "Note" column (e.g. "23") before the figures
+        note_idx = next((i for i, c in enumerate(table["columns"]) if c.lower().startswith("note")), None)
+        for row in table["rows"]:
+            label_idx = next((i for i, c in enumerate(row) if c and not _NUMBER_CELL_RE.match(c)), None)
+            if label_idx is None:
+                continue
+            numbers = [c for i, c in enumerate(row[label_idx + 1:], label_idx + 1) if i != note_idx and _NUMBER_CELL_RE.match(c)]
+            if not numbers:
+                continue
+            label = row[label_idx].lower()
+            for field, labels in STATEMENT_LINE_ITEMS.items():
+                rank = next((r for r, l in enumerate(labels) if label.startswith(l)), None)
+                if rank is not None and rank < ranks.get(field, len(labels)):
+                    ranks[field] = rank
+                    items[field] = {
+                        "value": numbers[0],
+                        "label": row[label_idx],
+                        "statement": table["statement"],
+                        "page": table["page"]
+                    }
+                    break
+    return items
+
+def format_statement_tables(tables: List[Dict[str, Any]], max_chars: int = 20000) -> str:
+    """Compact text rendering of extracted statements for the Gemini prompt"""
+    lines = []
+    total = 0
+    for table in tables:
+        for row in [table["columns"]] + table["rows"]:
+            line = f"[{table['statement']} p.{table['page']}] " + " | ".join(row)
+            total += len(line) + 1
+            if total > max_chars:
+                return "\n".join(lines)
+            lines.append(line)
+    return "\n".join(lines)
+
 # ==================== DOCUMENT ANALYZER ====================
-@app.post("/document-analyze-upload")
-async def analyze_document_upload(file: UploadFile = File(...)):
+# The analysis pipeline runs in three stages - extract, llm, score - and is shared
+# by the synchronous upload endpoint and the background document jobs.
+DOCUMENT_STAGES = ("extract", "llm", "score")
+
+def is_image_only_page(page, page_text: str) -> bool:
+    """A page with no extractable text but at least one image, i.e. a scanned page"""
+    return not page_text.strip() and bool(page.get_images(full=False))
+
+def ocr_pages(source, page_numbers: List[int]) -> List[tuple]:
     """
-    Real PDF document analyzer with file upload
-    Handles large files up to 100MB
-    Extracts text, finds financial data, provides intelligent insights
+    OCR the given 0-based pages of a PDF (file path or bytes) with PyMuPDF + Tesseract.
+    Runs inside the OCR process pool, so it opens its own document handle.
     """
+    import fitz
+    doc = fitz.open(source) if isinstance(source, str) else fitz.open(stream=source, filetype="pdf")
     try:
-        # Validate PDF
-        if not file.filename.lower().endswith('.pdf'):
-            raise HTTPException(status_code=400, detail="Only PDF files supported")
-        
-        # PyMuPDF import
-        import fitz
-        import re
-        
-        print(f"Analyzing PDF: {file.filename}")
-        
-        # Read file
-        contents = await file.read()
-        file_size_mb = len(contents) / (1024 * 1024)
-        
-        print(f"File size: {file_size_mb:.2f} MB")
-        
-        # Open PDF with PyMuPDF (handles large files efficiently)
-        doc = fitz.open(stream=contents, filetype="pdf")
-        page_count = len(doc)
+        results = []
+        for page_num in page_numbers:
+            page = doc[page_num]
+            textpage = page.get_textpage_ocr(dpi=OCR_DPI, full=True, language=OCR_LANGUAGE)
+            results.append((page_num, page.get_text(textpage=textpage)))
+        return results
+    finally:
+        doc.close()
+
+def _unlink_when_done(path: str, futures: List[Any]):
+    """Remove a temp file once every (possibly still running) future using it has finished"""
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def on_done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    for future in futures:
+        future.add_done_callback(on_done)
+
+_ocr_executor = None
+
+def get_ocr_executor():
+    """
+    Separate process pool so OCR never competes with text extraction or request threads.
+    Workers are never forked from this (threaded) server process - a fork could copy locks
+    held by other threads; they start from a forkserver (spawn where unavailable) and import
+    fitz themselves in ocr_pages.
+    """
+    global _ocr_executor
+    if _ocr_executor is None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _ocr_executor = ProcessPoolExecutor(max_workers=OCR_WORKERS, mp_context=multiprocessing.get_context(method))
+    return _ocr_executor
+
+async def stop_ocr_executor():
+    global _ocr_executor
+    if _ocr_executor is not None:
+        _ocr_executor.shutdown(wait=False, cancel_futures=True)
+        _ocr_executor = None
+
+shutdown_hooks.append(stop_ocr_executor)
+
+class InvalidDocument(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=422, detail="File is empty or not a valid PDF document")
+
+def extract_document(source, keep_chunks: bool = False) -> Dict[str, Any]:
+    """
+    Extract stage: open the PDF (raw bytes or a file path) and stream every page
+    through the signal scanner and, on statement pages, table extraction.
+    Scanned (image-only) pages are skipped, or handed to the OCR pool when enabled
+    and merged in after all text-bearing pages are done.
+    keep_chunks also collects Q&A chunks, up to DOCUMENT_INDEX_MAX_CHARS of text.
+    """
+    # PyMuPDF import
+    import fitz
+
+    # Sub-stage totals for the whole document (reported as pdf.* spans and in the result)
+    timings = {"open": 0.0, "text": 0.0, "scan": 0.0, "tables": 0.0, "ocr_wait": 0.0}
+    clock = time.perf_counter
+
+    # Open PDF with PyMuPDF (handles large files efficiently)
+    started = clock()
+    try:
+        if isinstance(source, str):
+            file_size = os.path.getsize(source)
+            doc = fitz.open(source)
+        else:
+            file_size = len(source)
+            doc = fitz.open(stream=source, filetype="pdf")
+    except (fitz.EmptyFileError, fitz.FileDataError):
+        # PyMuPDF's message names the (temp) file - don't pass it on
+        raise InvalidDocument()
+    page_count = len(doc)
+    timings["open"] = clock() - started
+    
+    logger.debug("PDF opened: %.2f MB, %d pages", file_size / (1024 * 1024), page_count)
+    
+    # Extract text page by page and stream each page through the signal scanner.
+    # Only the first 100k chars are kept (for Gemini) - the full text is never concatenated.
+    scanner = DocumentSignalScanner()
+    head_parts = []
+    head_len = 0
+    text_length = 0
+    word_count = 0
+    page_info = []
+    statement_tables = []
+    statement_pages = 0
+    chunks = []
+    chunk_chars = 0
+    scanned_pages = []
+    ocr_futures = []
+    ocr_batch = []
+    ocr_source = source
+    ocr_tempfile = None
+
+    def add_page_text(page_num, page_text, page=None, ocr=False):
+        nonlocal head_len, text_length, word_count, statement_pages, chunk_chars
+        started = clock()
+        statements = scanner.scan_page(page_num + 1, page_text)
+        timings["scan"] += clock() - started
         
-        print(f"Pages: {page_count}")
+        # Structured statement tables, only on candidate pages
+        if page is not None and statements and statement_pages < MAX_STATEMENT_PAGES:
+            statement_pages += 1
+            started = clock()
+            statement_tables.extend(extract_statement_tables(page, page_num + 1, statements[0]))
+            timings["tables"] += clock() - started
         
-        # Extract text from all pages (PyMuPDF is fast!)
-        full_text = ""
-        page_info = []
+        text_length += len(page_text) + 1
+        word_count += len(page_text.split())
+        if keep_chunks and chunk_chars < DOCUMENT_INDEX_MAX_CHARS:
+            chunks.extend(chunk_page(page_num + 1, page_text))
+            chunk_chars += len(page_text)
+        if head_len < GEMINI_DOC_CHARS:
+            head_parts.append(page_text + "\n")
+            head_len += len(page_text) + 1
         
+        info = {
+            "page": page_num + 1,
+            "chars": len(page_text),
+            "has_content": len(page_text.strip()) > 0
+        }
+        if ocr:
+            info["ocr"] = True
+        page_info.append(info)
+
+    def submit_ocr_batch():
+        nonlocal ocr_source, ocr_tempfile
+        if not ocr_batch:
+            return
+        if not isinstance(ocr_source, str):
+            # Hand the pool a file path rather than pickling the whole PDF for every batch
+            fd, ocr_tempfile = tempfile.mkstemp(suffix=".pdf", prefix="verifin-ocr-")
+            with os.fdopen(fd, "wb") as out:
+                out.write(source)
+            ocr_source = ocr_tempfile
+        ocr_futures.append(get_ocr_executor().submit(ocr_pages, ocr_source, list(ocr_batch)))
+        ocr_batch.clear()
+    
+    try:
         for page_num in range(page_count):
+            started = clock()
             page = doc[page_num]
             page_text = page.get_text()
-            full_text += page_text + "\n"
+            timings["text"] += clock() - started
             
-            page_info.append({
-                "page": page_num + 1,
-                "chars": len(page_text),
-                "has_content": len(page_text.strip()) > 0
-            })
+            if is_image_only_page(page, page_text):
+                scanned_pages.append(page_num + 1)
+                if DOCUMENT_OCR:
+                    ocr_batch.append(page_num)
+                    if len(ocr_batch) >= OCR_BATCH_PAGES:
+                        submit_ocr_batch()
+                continue
+            
+            add_page_text(page_num, page_text, page)
         
         doc.close()
+        submit_ocr_batch()
         
-        print(f"Extracted {len(full_text)} characters from {page_count} pages")
-        
-        # ---------------------------------------------------------
-        # 🤖 AI-POWERED ANALYSIS (The "Full Potential" Upgrade)
-        # ---------------------------------------------------------
-        
-        analyzed_data = {}
-        
-        if gemini_model:
-            try:
-                print("🚀 Sending document text to Gemini for advanced analysis...")
-                
-                # We limit text to ~30k words to stay safe within token limits (though Gemini defines larger)
-                # First 100k chars is usually enough for key financial data in Intro/Financials
-                truncated_text = full_text[:100000] 
-                
-                prompt = f"""
-                Analyze this financial document text and extract the following structured data.
-                
-                DOCUMENT TEXT (First 100k chars):
-                {truncated_text}
-                
-                INSTRUCTIONS:
-                1. Identify the Document Type (Annual Report, Quarterly, etc.)
-                2. Identify the Company Name.
-                3. Extract Key Financial Metrics (Revenue, Net Profit, Assets, EPS) - Convert to simple numbers/strings (e.g. "5000 Crore").
-                4. Analyze Sentiment (Positive/Neutral/Negative) based on the tone.
-                5. Generate 3-4 Key Strategic Insights/Highlights.
-                6. Generate a brief Summary.
-                
-                RETURN JSON FORMAT ONLY:
-                {{
-                    "document_type": "string",
-                    "company_name": "string",
-                    "financial_data": {{
-                        "revenue": "string",
-                        "net_profit": "string",
-                        "total_assets": "string",
-                        "eps": "string"
-                    }},
-                    "sentiment": "Positive" | "Neutral" | "Negative",
-                    "insights": ["insight 1", "insight 2", "insight 3"],
-                    "summary": "string"
-                }}
-                """
-                
-                response = gemini_model.generate_content(prompt)
-                
-                # clean response (sometimes adds markdown ```json ... ```)
-                json_str = response.text.replace("```json", "").replace("```", "").strip()
-                import json
-                analyzed_data = json.loads(json_str)
-                print("✅ Gemini analysis complete!")
-                
-            except Exception as ai_e:
-                print(f"⚠️ Gemini processing failed: {ai_e}")
-                # Fallback to empty, will use regex below
-        
-        # ---------------------------------------------------------
-        # FALLBACK & MERGING (If AI fails or misses fields)
-        # ---------------------------------------------------------
-        
-        text_lower = full_text.lower()
+        logger.debug("Extracted %d characters from %d pages (%d scanned)", text_length, page_count, len(scanned_pages))
         
-        # 1. Document Type
-        doc_type = analyzed_data.get("document_type", "General Financial Document")
-        if doc_type == "General Financial Document":
-            # Fallback regex detection
-            if "annual report" in text_lower or "financial year" in text_lower: doc_type = "Annual Report"
-            elif "quarterly" in text_lower: doc_type = "Quarterly Report"
-            elif "balance sheet" in text_lower: doc_type = "Balance Sheet"
+        # OCR results are merged after every text-bearing page, within a fixed time budget
+        ocr_page_count = 0
+        if ocr_futures:
+            from concurrent.futures import wait
+            started = clock()
+            done, not_done = wait(ocr_futures, timeout=OCR_TIMEOUT)
+            timings["ocr_wait"] = clock() - started
+            for future in not_done:
+                future.cancel()
+            for future in done:
+                try:
+                    for page_num, page_text in future.result():
+                        add_page_text(page_num, page_text, ocr=True)
+                        scanned_pages.remove(page_num + 1)
+                        ocr_page_count += 1
+                except Exception as e:
+                    logger.warning("OCR batch failed: %s", e)
+            page_info.sort(key=lambda p: p["page"])
+            logger.info("OCR recovered text from %d scanned pages", ocr_page_count)
+    finally:
+        if not doc.is_closed:
+            doc.close()
+        if ocr_tempfile:
+            _unlink_when_done(ocr_tempfile, ocr_futures)
+    
+    line_items = statement_line_items(statement_tables)
+    if statement_tables:
+        logger.debug("Extracted %d statement tables (%d headline figures)", len(statement_tables), len(line_items))
+    for name, seconds in timings.items():
+        metrics.observe("verifin_span_seconds", seconds, span=f"pdf.{name}", status="ok")
+    
+    return {
+        "file_size": file_size,
+        "page_count": page_count,
+        "page_info": page_info,
+        "scanned_pages": scanned_pages,
+        "ocr_pages": ocr_page_count,
+        "head_parts": head_parts,
+        "text_length": text_length,
+        "word_count": word_count,
+        "scanner": scanner,
+        "statement_tables": statement_tables,
+        "line_items": line_items,
+        "chunks": chunks,
+        "timings": timings
+    }
+
+def analyze_document_with_gemini(extracted: Dict[str, Any]) -> Dict[str, Any]:
+    """LLM stage: structured extraction with Gemini. Returns {} when unavailable or on failure."""
+    analyzed_data = {}
+    line_items = extracted["line_items"]
+    statement_tables = extracted["statement_tables"]
+    head_parts = extracted["head_parts"]
+    model = get_gemini_model()
+    
+    if model:
+        try:
+            # We limit text to ~30k words to stay safe within token limits (though Gemini defines larger)
+            # First 100k chars is usually enough for key financial data in Intro/Financials.
+            # When the statements were extracted as tables, send those instead of most of the text.
+            text_budget = GEMINI_DOC_CHARS_WITH_TABLES if line_items else GEMINI_DOC_CHARS
+            truncated_text = "".join(head_parts)[:text_budget]
+            statements_text = format_statement_tables(statement_tables) if line_items else ""
+            statements_block = f"""
+            FINANCIAL STATEMENT TABLES (extracted rows, use these for the metrics):
+            {statements_text}
+            """ if statements_text else ""
             
-        # 2. Company Name
-        company_name = analyzed_data.get("company_name", "Not detected")
-        if company_name == "Not detected":
-            # Fallback heuristic
-            for page_info_item in page_info[:5]:
-                lines = full_text.split('\n')[:50]
-                for line in lines:
-                    if len(line.strip()) > 5 and any(word in line.lower() for word in ['limited', 'ltd', 'inc', 'corporation']):
-                        company_name = line.strip()
-                        break
-                if company_name != "Not detected": break
-
-        # 3. Financial Data
-        financial_data = analyzed_data.get("financial_data", {})
-        # If AI missed revenue, try regex
-        if not financial_data.get("revenue") or financial_data.get("revenue") == "string":
-            rev_match = re.search(r'revenue[:\s]+(?:rs\.?|₹)?\s*([\d,]+\.?\d*)', text_lower)
-            if rev_match: financial_data['revenue'] = rev_match.group(1)
+            prompt = f"""
+            Analyze this financial document text and extract the following structured data.
             
-        if not financial_data.get("net_profit") or financial_data.get("net_profit") == "string":
-            profit_match = re.search(r'(?:net profit|pat)[:\s]+(?:rs\.?|₹)?\s*([\d,]+\.?\d*)', text_lower)
-            if profit_match: financial_data['net_profit'] = profit_match.group(1)
-
-        # 4. Sentiment
-        sentiment = analyzed_data.get("sentiment", "Neutral")
-        if sentiment not in ["Positive", "Negative", "Neutral"]:
-            # Fallback count
-            pos_count = sum(text_lower.count(w) for w in ['growth', 'profit', 'strong'])
-            neg_count = sum(text_lower.count(w) for w in ['loss', 'decline', 'risk'])
-            sentiment = "Positive" if pos_count > neg_count else "Negative" if neg_count > pos_count else "Neutral"
+            DOCUMENT TEXT (First {text_budget // 1000}k chars):
+            {truncated_text}
+            {statements_block}
             
-        # Colors
-        sentiment_color = "green" if sentiment == "Positive" else "red" if sentiment == "Negative" else "blue"
+            INSTRUCTIONS:
+            1. Identify the Document Type (Annual Report, Quarterly, etc.)
+            2. Identify the Company Name.
+            3. Extract Key Financial Metrics (Revenue, Net Profit, Assets, EPS) - Convert to simple numbers/strings (e.g. "5000 Crore").
+            4. Analyze Sentiment (Positive/Neutral/Negative) based on the tone.
+            5. Generate 3-4 Key Strategic Insights/Highlights.
+            6. Generate a brief Summary.
+            
+            RETURN JSON FORMAT ONLY:
+            {{
+                "document_type": "string",
+                "company_name": "string",
+                "financial_data": {{
+                    "revenue": "string",
+                    "net_profit": "string",
+                    "total_assets": "string",
+                    "eps": "string"
+                }},
+                "sentiment": "Positive" | "Neutral" | "Negative",
+                "insights": ["insight 1", "insight 2", "insight 3"],
+                "summary": "string"
+            }}
+            """
+            
+            with span("gemini.document"):
+                response = model.generate_content(prompt)
+            
+            # clean response (sometimes adds markdown ```json ... ```)
+            json_str = response.text.replace("```json", "").replace("```", "").strip()
+            analyzed_data = json.loads(json_str)
+            logger.debug("Gemini document analysis complete")
+            
+        except Exception as ai_e:
+            logger.warning("Gemini document processing failed: %s", ai_e)
+            # Fallback to empty, will use regex below
+    
+    return analyzed_data
 
-        # 5. Insights parsing
-        ai_insights = analyzed_data.get("insights", [])
+def build_document_analysis(filename: str, extracted: Dict[str, Any], analyzed_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Score stage: merge Gemini output with the scanner/table fallbacks into the UI response"""
+    scanner = extracted["scanner"]
+    line_items = extracted["line_items"]
+    statement_tables = extracted["statement_tables"]
+    page_count = extracted["page_count"]
+    text_length = extracted["text_length"]
+    word_count = extracted["word_count"]
+    
+    # 1. Document Type
+    doc_type = analyzed_data.get("document_type", "General Financial Document")
+    if doc_type == "General Financial Document":
+        doc_type = scanner.document_type
         
-        # Build final "Insights" list for UI
-        insights = []
+    # 2. Company Name
+    company_name = analyzed_data.get("company_name", "Not detected")
+    if company_name == "Not detected" and scanner.company_name:
+        company_name = scanner.company_name
+
+    # 3. Financial Data
+    financial_data = analyzed_data.get("financial_data", {})
+    # If AI missed a figure, use the statement tables, then the scanner's first regex match
+    for field in STATEMENT_LINE_ITEMS:
+        if not financial_data.get(field) or financial_data.get(field) == "string":
+            if field in line_items:
+                financial_data[field] = line_items[field]["value"]
+            elif field in scanner.values:
+                financial_data[field] = scanner.values[field]
+
+    # 4. Sentiment
+    sentiment = analyzed_data.get("sentiment")
+    if sentiment not in ["Positive", "Negative", "Neutral"]:
+        sentiment = scanner.sentiment
         
+    # Colors
+    sentiment_color = "green" if sentiment == "Positive" else "red" if sentiment == "Negative" else "blue"
+
+    # 5. Insights parsing
+    ai_insights = analyzed_data.get("insights", [])
+    
+    # Build final "Insights" list for UI
+    insights = []
+    
+    insights.append({
+        "icon": "📄",
+        "title": f"Analysis Scope",
+        "description": f"Analyzed {page_count} pages ({text_length//1000}k chars) using Gemini AI"
+    })
+    
+    insights.append({
+        "icon": "📑",
+        "title": "Document Type",
+        "description": doc_type
+    })
+    
+    if company_name != "Not detected":
         insights.append({
-            "icon": "📄",
-            "title": f"Analysis Scope",
-            "description": f"Analyzed {page_count} pages ({len(full_text)//1000}k chars) using Gemini AI"
+            "icon": "🏢",
+            "title": "Company",
+            "description": company_name
         })
         
+    # Add AI strategics highlights
+    for i, insight in enumerate(ai_insights[:3]):
         insights.append({
-            "icon": "📑",
-            "title": "Document Type",
-            "description": doc_type
+            "icon": "💡",
+            "title": f"Key Insight #{i+1}",
+            "description": insight
         })
-        
-        if company_name != "Not detected":
-            insights.append({
-                "icon": "🏢",
-                "title": "Company",
-                "description": company_name
-            })
-            
-        # Add AI strategics highlights
-        for i, insight in enumerate(ai_insights[:3]):
-            insights.append({
-                "icon": "💡",
-                "title": f"Key Insight #{i+1}",
-                "description": insight
-            })
 
-        # Recommendations
-        recommendations = [
-            "• Use VeriFin's Compare feature to benchmark against competitors",
-            "• Verify AI-extracted numbers with the actual document page",
-        ]
-        if sentiment == "Positive":
-            recommendations.insert(0, "✓ AI detected positive tone - Look for growth drivers in the report")
-        
-        return {
-            "success": True,
-            "filename": file.filename,
-            "file_size_mb": round(file_size_mb, 2),
-            "pages": page_count,
-            "document_type": doc_type,
-            "company": company_name,
-            "text_length": len(full_text),
-            "word_count": len(full_text.split()),
-            "key_sections": [], # Can be enhanced later
-            "financial_data": financial_data,
-            "sentiment": sentiment,
-            "sentiment_color": sentiment_color,
-            "positive_mentions": 0, # Legacy field
-            "negative_mentions": 0, # Legacy field
-            "insights": insights,
-            "recommendations": recommendations,
-            "summary": analyzed_data.get("summary", "No summary generated."),
-            "analyzed_at": datetime.now().isoformat(),
-            "processing_info": {
-                "pages_processed": page_count,
-                "ai_model": "Gemini Paid" if gemini_model else "Pattern Fallback"
-            }
+    # Statement sections found in the document, and citations for the table figures
+    key_sections = []
+    for table in statement_tables:
+        section = {"title": table["statement"], "page": table["page"]}
+        if section not in key_sections:
+            key_sections.append(section)
+    citations = scanner.citations + [
+        {"signal": field, "page": item["page"], "match": item["value"], "snippet": f"{item['label']}: {item['value']} ({item['statement']})"}
+        for field, item in line_items.items()
+    ]
+
+    # Recommendations
+    recommendations = [
+        "• Use VeriFin's Compare feature to benchmark against competitors",
+        "• Verify AI-extracted numbers with the actual document page",
+    ]
+    if sentiment == "Positive":
+        recommendations.insert(0, "✓ AI detected positive tone - Look for growth drivers in the report")
+    
+    return {
+        "success": True,
+        "filename": filename,
+        "file_size_mb": round(extracted["file_size"] / (1024 * 1024), 2),
+        "pages": page_count,
+        "document_type": doc_type,
+        "company": company_name,
+        "text_length": text_length,
+        "word_count": word_count,
+        "key_sections": key_sections,
+        "financial_statements": statement_tables,
+        "financial_data": financial_data,
+        "sentiment": sentiment,
+        "sentiment_color": sentiment_color,
+        "positive_mentions": scanner.positive_count,
+        "negative_mentions": scanner.negative_count,
+        "citations": citations, # Page-located matches for the UI to cite
+        "insights": insights,
+        "recommendations": recommendations,
+        "summary": analyzed_data.get("summary", "No summary generated."),
+        "analyzed_at": datetime.now().isoformat(),
+        "scanned_pages": extracted["scanned_pages"],
+        "processing_info": {
+            "pages_processed": page_count - len(extracted["scanned_pages"]),
+            "pages_skipped": len(extracted["scanned_pages"]),
+            "pages_ocr": extracted["ocr_pages"],
+            "ai_model": "Gemini Paid" if get_gemini_model() else "Pattern Fallback"
         }
+    }
+    
+def run_document_analysis(source, filename: str, on_stage=None, index: bool = False) -> Dict[str, Any]:
+    """
+    Run the full (blocking) analysis pipeline for a PDF given as bytes or a file path.
+    on_stage(stage, status) is called as each of DOCUMENT_STAGES starts ("running") and ends ("done").
+    index=True keeps the text for /document-ask and adds document_id to the result.
+    """
+    def stage(name, status):
+        if on_stage:
+            on_stage(name, status)
+
+    logger.info("Analyzing PDF: %s", filename)
+    
+    stage("extract", "running")
+    with span("pdf.extract"):
+        extracted = extract_document(source, keep_chunks=index)
+    stage("extract", "done")
+    
+    stage("llm", "running")
+    analyzed_data = analyze_document_with_gemini(extracted)
+    stage("llm", "done")
+    
+    stage("score", "running")
+    with span("pdf.score"):
+        result = build_document_analysis(filename, extracted, analyzed_data)
+    if index:
+        # Keep the chunks for /document-ask follow-ups
+        with span("pdf.index"):
+            result["document_id"] = document_hash(source)
+            index_document(result["document_id"], extracted["chunks"])
+    stage("score", "done")
+    return result
+
+@app.post("/document-analyze-upload")
+async def analyze_document_upload(file: UploadFile = File(...), index: bool = False):
+    """
+    Real PDF document analyzer with file upload
+    Handles large files up to 100MB
+    Extracts text, finds financial data, provides intelligent insights
+    ?index=true keeps the text for /document-ask follow-ups
+    """
+    try:
+        # Validate PDF
+        if not file.filename.lower().endswith('.pdf'):
+            raise HTTPException(status_code=400, detail="Only PDF files supported")
+        if file.size and file.size > DOCUMENT_MAX_BYTES:
+            raise HTTPException(status_code=413, detail=f"Document exceeds {DOCUMENT_MAX_BYTES // (1024 * 1024)}MB limit")
+        
+        # Read file
+        contents = await file.read()
+        
+        # Extraction and Gemini are blocking - keep them off the event loop
+        loop = asyncio.get_running_loop()
+        return FastJSONResponse(await loop.run_in_executor(None, run_document_analysis, contents, file.filename, None, index))
         
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error analyzing document: {str(e)}")
+        logger.exception("Error analyzing document: %s", e)
         raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
 
-@app.post("/document-analyze")
-async def analyze_document(query: DocumentQuery):
+# ==================== DOCUMENT Q&A ====================
+# Documents analyzed with ?index=true are kept as page-located text chunks (at most
+# DOCUMENT_INDEX_MAX_CHARS of text) under their SHA-256 (the "documents" cache namespace,
+# so every worker can answer follow-ups), and /document-ask
+# sends Gemini only the top BM25 chunks for the question. A follow-up costs the same few
+# thousand prompt characters whatever the document's size. The BM25 index is built on a
+# document's first question and kept in-process for the most recently asked documents.
+DOCUMENT_CHUNK_CHARS = 1500
+DOCUMENT_INDEX_MAX_CHARS = 2_000_000  # text kept per document; later pages aren't searchable
+DOCUMENT_ASK_CHARS = 8000    # retrieved text sent per question
+DOCUMENT_ASK_MAX_CHUNKS = 10
+DOCUMENT_INDEX_CACHE = 8     # built indexes kept per process
+BM25_K1 = 1.5
+BM25_B = 0.75
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:\.[0-9]+)?")
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were what which who will with how did does do".split()
+)
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _TOKEN_RE.findall(text.lower()) if t not in _STOPWORDS]
+
+def chunk_page(page: int, text: str) -> List[tuple]:
+    """(page, text) pieces of about DOCUMENT_CHUNK_CHARS, split on line boundaries"""
+    chunks = []
+    current, size = [], 0
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if size + len(line) > DOCUMENT_CHUNK_CHARS and current:
+            chunks.append((page, " ".join(current)))
+            current, size = [], 0
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        chunks.append((page, " ".join(current)))
+    return chunks
+
+def document_hash(source) -> str:
+    """SHA-256 of a PDF given as bytes or a file path"""
+    digest = hashlib.sha256()
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+    else:
+        digest.update(source)
+    return digest.hexdigest()
+
+class BM25Index:
+    """Okapi BM25 over document chunks; postings are (chunk ids, term counts) NumPy arrays"""
+    def __init__(self, chunks: List[tuple]):
+        self.chunks = chunks
+        postings: Dict[str, Dict[int, int]] = {}
+        lengths = []
+        for i, (_, text) in enumerate(chunks):
+            tokens = tokenize(text)
+            lengths.append(len(tokens))
+            for token, count in Counter(tokens).items():
+                postings.setdefault(token, {})[i] = count
+        self.lengths = np.array(lengths, dtype=np.float64)
+        self.avg_length = self.lengths.mean() if chunks else 0.0
+        self.postings = {
+            token: (np.fromiter(counts.keys(), dtype=np.int32, count=len(counts)),
+                    np.fromiter(counts.values(), dtype=np.float64, count=len(counts)))
+            for token, counts in postings.items()
+        }
+
+    def search(self, query: str, k: int) -> List[tuple]:
+        """[(score, page, text)] of the k best chunks, best first; empty when no term matches"""
+        scores = np.zeros(len(self.chunks))
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths / (self.avg_length or 1.0))
+        for token in set(tokenize(query)):
+            posting = self.postings.get(token)
+            if posting is None:
+                continue
+            ids, counts = posting
+            idf = math.log(1 + (len(self.chunks) - len(ids) + 0.5) / (len(ids) + 0.5))
+            scores[ids] += idf * counts * (BM25_K1 + 1) / (counts + norm[ids])
+        if not scores.any():
+            return []
+        best = np.argsort(-scores, kind="stable")[:k]
+        return [(float(scores[i]), *self.chunks[i]) for i in best if scores[i] > 0]
+
+_document_indexes: "OrderedDict[str, BM25Index]" = OrderedDict()
+_document_indexes_lock = threading.Lock()
+
+def _remember_index(document_id: str, index: BM25Index):
+    with _document_indexes_lock:
+        _document_indexes[document_id] = index
+        _document_indexes.move_to_end(document_id)
+        while len(_document_indexes) > DOCUMENT_INDEX_CACHE:
+            _document_indexes.popitem(last=False)
+
+def index_document(document_id: str, chunks: List[tuple]):
+    """Store the chunks for follow-up questions (the index is built on the first question)"""
+    cache.set("documents", document_id, chunks)
+    with _document_indexes_lock:
+        _document_indexes.pop(document_id, None)
+
+def get_document_index(document_id: str) -> Optional[BM25Index]:
+    with _document_indexes_lock:
+        index = _document_indexes.get(document_id)
+        if index is not None:
+            _document_indexes.move_to_end(document_id)
+            return index
+    chunks = cache.get("documents", document_id)
+    if chunks is None:
+        return None
+    with span("document.index"):
+        index = BM25Index(chunks)
+    _remember_index(document_id, index)
+    return index
+
+def answer_document_question(document_id: str, question: str, top_k: int) -> Optional[Dict[str, Any]]:
+    """Retrieve the best chunks and have Gemini answer from them only; None if the document is unknown"""
+    index = get_document_index(document_id)
+    if index is None:
+        return None
+    with span("document.retrieve"):
+        hits = index.search(question, top_k)
+
+    # Keep the prompt within DOCUMENT_ASK_CHARS however long the chunks are
+    passages, budget = [], DOCUMENT_ASK_CHARS
+    for score, page, text in hits:
+        if budget <= 0:
+            break
+        passages.append((score, page, text[:budget]))
+        budget -= len(text)
+    sources = [{"page": page, "score": round(score, 3), "snippet": text[:300]} for score, page, text in passages]
+
+    if not passages:
+        return {"success": True, "answer": "The document doesn't appear to cover that.", "sources": [], "powered_by": "BM25 retrieval"}
+
+    model = get_gemini_model()
+    if model:
+        context = "\n\n".join(f"[Page {page}] {text}" for _, page, text in passages)
+        prompt = f"""Answer the question using only these excerpts from a financial document.
+Cite pages as (p. N). If the excerpts don't contain the answer, say so.
+
+EXCERPTS:
+{context}
+
+QUESTION: {question}"""
+        try:
+            with span("gemini.document_ask"):
+                response = model.generate_content(prompt)
+            if response and response.text:
+                return {"success": True, "answer": response.text, "sources": sources, "powered_by": "Google Gemini AI"}
+        except Exception as e:
+            logger.warning("Gemini document question failed: %s", e)
+
+    metrics.inc("verifin_fallbacks_total", kind="document_ask_extractive")
+    return {
+        "success": True,
+        "answer": "\n\n".join(f"(p. {page}) {text[:500]}" for _, page, text in passages[:3]),
+        "sources": sources,
+        "powered_by": "BM25 retrieval (Gemini unavailable)"
+    }
+
+@app.post("/document-ask")
+async def document_ask(query: DocumentAskQuery):
+    """
+    Follow-up question about an analyzed document (document_id from the analysis response).
+    Only the top_k most relevant chunks are sent to Gemini.
+    """
+    question = query.question.strip()
+    if not question:
+        raise HTTPException(status_code=422, detail="question is required")
+    top_k = max(1, min(query.top_k, DOCUMENT_ASK_MAX_CHUNKS))
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(None, answer_document_question, query.document_id, question, top_k)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired document_id - analyze the document again")
+    return result
+
+# ==================== DOCUMENT JOBS ====================
+# Submit/poll API for large documents: the upload is spooled to a temp file and queued,
+# a fixed pool of workers runs the pipeline, and clients poll or follow SSE progress.
+# Every job change is also written to the shared cache ("jobs" namespace), so a poll or SSE
+# connection that lands on another worker process reads the job from there; with the
+# per-process memory backend, run a single worker.
+DOCUMENT_JOB_WORKERS = int(os.getenv("DOCUMENT_JOB_WORKERS", "2"))
+DOCUMENT_JOB_QUEUE_SIZE = int(os.getenv("DOCUMENT_JOB_QUEUE_SIZE", "16"))
+DOCUMENT_JOB_TTL = int(os.getenv("DOCUMENT_JOB_TTL", "3600"))  # seconds a finished job is kept
+DOCUMENT_JOB_POLL_SECONDS = 1.0  # SSE for a job running in another process follows the cache
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+document_jobs: Dict[str, Dict[str, Any]] = {}
+document_queue: Optional[asyncio.Queue] = None
+_document_workers: List[asyncio.Task] = []
+
+def _public_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Job record without internal fields"""
+    return {k: v for k, v in job.items() if not k.startswith("_")}
+
+def _store_job(record: Dict[str, Any]):
+    cache.set("jobs", record["job_id"], record, DOCUMENT_JOB_TTL)
+
+def _touch_job(job: Dict[str, Any], **changes):
+    """Update a job (on the event loop) and wake up any SSE listeners"""
+    job.update(changes)
+    job["updated_at"] = time.time()
+    job["_changed"].set()
+    job["_changed"] = asyncio.Event()
+
+async def _publish_job(job: Dict[str, Any], **changes):
+    """_touch_job, then store the job for other worker processes"""
+    _touch_job(job, **changes)
+    await asyncio.get_running_loop().run_in_executor(None, _store_job, _public_job(job))
+
+async def _load_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """This process's job record, else the shared copy (public fields only)"""
+    job = document_jobs.get(job_id)
+    if job is not None:
+        return job
+    return await asyncio.get_running_loop().run_in_executor(None, cache.get, "jobs", job_id)
+
+def _purge_document_jobs():
+    cutoff = time.time() - DOCUMENT_JOB_TTL
+    for job_id in [j for j, job in document_jobs.items() if job["status"] in ("done", "failed") and job["updated_at"] < cutoff]:
+        del document_jobs[job_id]
+
+async def _document_worker():
+    loop = asyncio.get_running_loop()
+    while True:
+        job_id, path, index = await document_queue.get()
+        job = document_jobs.get(job_id)
+        try:
+            if job is None:
+                continue
+            await _publish_job(job, status="running")
+            shared = _public_job(job)
+
+            def on_stage(stage, status):
+                # Called from the executor thread: store the shared copy here (in stage order),
+                # then hop back to the loop to mutate the job
+                shared.update(stage=stage, stages=dict(shared["stages"], **{stage: status}), updated_at=time.time())
+                _store_job(dict(shared))
+
+                def update():
+                    stages = dict(job["stages"], **{stage: status})
+                    _touch_job(job, stage=stage, stages=stages)
+                loop.call_soon_threadsafe(update)
+
+            result = await loop.run_in_executor(None, run_document_analysis, path, job["filename"], on_stage, index)
+            await _publish_job(job, status="done", result=result)
+        except Exception as e:
+            logger.exception("Document job %s failed: %s", job_id, e)
+            if job is not None:
+                error = e.detail if isinstance(e, HTTPException) else f"Analysis failed: {str(e)}"
+                await _publish_job(job, status="failed", error=error)
+        finally:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            document_queue.task_done()
+
+async def start_document_workers():
+    global document_queue
+    document_queue = asyncio.Queue(maxsize=DOCUMENT_JOB_QUEUE_SIZE)
+    for _ in range(DOCUMENT_JOB_WORKERS):
+        _document_workers.append(asyncio.create_task(_document_worker()))
+
+async def stop_document_workers():
+    for task in _document_workers:
+        task.cancel()
+    await asyncio.gather(*_document_workers, return_exceptions=True)
+    _document_workers.clear()
+
+startup_hooks.append(start_document_workers)
+shutdown_hooks.append(stop_document_workers)
+
+@app.post("/document-analyze-jobs", status_code=202)
+async def submit_document_job(file: UploadFile = File(...), index: bool = False):
     """
-    Analyze financial PDF documents  
-    Extract key information and risks
+    Queue a PDF for background analysis (?index=true keeps it for /document-ask).
+    Returns a job id immediately - poll /document-analyze-jobs/{job_id} or follow its /events stream.
     """
+    if not file.filename.lower().endswith('.pdf'):
+        raise HTTPException(status_code=400, detail="Only PDF files supported")
+    if file.size and file.size > DOCUMENT_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"Document exceeds {DOCUMENT_MAX_BYTES // (1024 * 1024)}MB limit")
+    if document_queue is None:
+        raise HTTPException(status_code=503, detail="Document workers are not running")
+    if document_queue.full():
+        raise HTTPException(status_code=503, detail="Document queue is full, retry shortly", headers={"Retry-After": "10"})
+
+    _purge_document_jobs()
+
+    # Spool the upload to disk in chunks so queued jobs don't hold documents in memory
+    fd, path = tempfile.mkstemp(suffix=".pdf", prefix="verifin-")
     try:
-        filename = query.filename
-        
-        # Mock analysis (implement real PDF parsing with PyMuPDF)
-        analysis = {
-            "success": True,
-            "filename": filename,
-            "summary": "Financial report shows strong revenue growth of 15% YoY with improving profit margins.",
-            "key_findings": [
-                "Revenue increased by $45M compared to last quarter",
-                "Operating expenses decreased by 8%",
-                "Cash flow from operations improved significantly",
-                "Debt-to-equity ratio reduced from 1.5 to 1.2"
-            ],
-            "risks": [
-                "High dependency on single product line",
-                "Increasing competition in core markets",
-                "Supply chain vulnerabilities identified",
-                "Regulatory changes may impact operations"
-            ],
-            "sentiment": "positive",
-            "confidence": 0.85
-        }
-        
-        return analysis
+        with os.fdopen(fd, "wb") as out:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                out.write(chunk)
+    except Exception:
+        os.unlink(path)
+        raise
+
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    job = {
+        "job_id": job_id,
+        "filename": file.filename,
+        "status": "queued",
+        "stage": None,
+        "stages": {name: "pending" for name in DOCUMENT_STAGES},
+        "created_at": now,
+        "updated_at": now,
+        "result": None,
+        "error": None,
+        "_changed": asyncio.Event()
+    }
+    try:
+        document_queue.put_nowait((job_id, path, index))
+    except asyncio.QueueFull:
+        os.unlink(path)
+        raise HTTPException(status_code=503, detail="Document queue is full, retry shortly", headers={"Retry-After": "10"})
+    document_jobs[job_id] = job
+    await asyncio.get_running_loop().run_in_executor(None, _store_job, _public_job(job))
+
+    return {
+        "success": True,
+        "job_id": job_id,
+        "status": "queued",
+        "queue_position": document_queue.qsize(),
+        "status_url": f"/document-analyze-jobs/{job_id}",
+        "events_url": f"/document-analyze-jobs/{job_id}/events"
+    }
+
+@app.get("/document-analyze-jobs/{job_id}")
+async def get_document_job(job_id: str):
+    """Poll a document job - includes the analysis result once status is 'done'"""
+    job = await _load_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return _public_job(job)
+
+@app.get("/document-analyze-jobs/{job_id}/events")
+async def document_job_events(job_id: str, request: Request):
+    """Server-Sent Events stream of per-stage progress; the final event carries the result"""
+    job = await _load_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    def event(record: Dict[str, Any]) -> tuple:
+        finished = record["status"] in ("done", "failed")
+        payload = _public_job(record) if finished else {k: v for k, v in _public_job(record).items() if k != "result"}
+        return finished, f"event: {'result' if finished else 'progress'}\ndata: {dumps_json(payload).decode()}\n\n"
+
+    async def event_stream():
+        while True:
+            changed = job["_changed"]
+            finished, message = event(job)
+            yield message
+            if finished or await request.is_disconnected():
+                return
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=15)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+
+    async def shared_event_stream():
+        # The job runs in another process: follow its shared copy
+        record, last_sent = job, time.monotonic()
+        while True:
+            finished, message = event(record)
+            yield message
+            last_sent = time.monotonic()
+            while True:
+                if finished or await request.is_disconnected():
+                    return
+                await asyncio.sleep(DOCUMENT_JOB_POLL_SECONDS)
+                latest = await _load_job(job_id)
+                if latest is None:
+                    return
+                if latest["updated_at"] != record["updated_at"]:
+                    record = latest
+                    break
+                if time.monotonic() - last_sent >= 15:
+                    yield ": keep-alive\n\n"
+                    last_sent = time.monotonic()
+
+    stream = event_stream() if "_changed" in job else shared_event_stream()
+
+    return StreamingResponse(stream, media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+# ==================== BASE64 DOCUMENT ANALYSIS ====================
+# /document-analyze takes the PDF as base64 inside a JSON body. The body is parsed
+# incrementally and the base64 decoded straight into a temp file, so the JSON string,
+# the decoded bytes and the extracted text never sit in memory together.
+class DocumentTooLarge(Exception):
+    pass
+
+class Base64FileSink:
+    """Incremental base64 decoder writing into a binary file, bounded by max_bytes"""
+    def __init__(self, out, max_bytes: int):
+        self.out = out
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._carry = b""
+        self._head = b""  # held until we know whether the value is a data: URL
+
+    def write(self, data: bytes):
+        if self._head is not None:
+            self._head += data
+            if len(self._head) < 5 or (self._head.startswith(b"data:") and b"," not in self._head):
+                if len(self._head) > 256:
+                    raise ValueError("Malformed data URL in file_content")
+                return
+            data = self._head.split(b",", 1)[1] if self._head.startswith(b"data:") else self._head
+            self._head = None
+        data = self._carry + data.translate(None, b" \t\r\n")
+        usable = len(data) - len(data) % 4
+        self._carry = data[usable:]
+        if usable:
+            decoded = binascii.a2b_base64(data[:usable])
+            self.size += len(decoded)
+            if self.size > self.max_bytes:
+                raise DocumentTooLarge()
+            self.out.write(decoded)
+
+    def close(self):
+        if self._head:
+            self._head, head = None, self._head
+            self.write(head)
+        if self._carry:
+            raise ValueError("Truncated base64 in file_content")
+
+class DocumentBodyParser:
+    """
+    Streaming parser for {"file_content": "<base64>", "filename": "..."} JSON bodies.
+    file_content is fed to a Base64FileSink chunk by chunk; other (small) string
+    fields are collected and decoded at the end.
+    """
+    STREAMED_FIELD = "file_content"
+    MAX_FIELD_BYTES = 4096
+    BASE64_CHARS = frozenset(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=")
+    WHITESPACE = frozenset(b" \t\r\n")
+    _HEX4 = re.compile(rb"[0-9a-fA-F]{4}")
+
+    def __init__(self, sink: Base64FileSink):
+        self.sink = sink
+        self.fields: Dict[str, Any] = {}
+        self._state = "start"  # start -> key -> colon -> value -> next
+        self._buf = b""
+        self._key = None
+        self._escape = False
+        self._unicode: Optional[bytes] = None  # hex digits of a \uXXXX escape in file_content
+
+    def _write_unicode_escape(self, digits: bytes):
+        # Some encoders escape "+", "/" or "=" as \u002b etc.; anything but base64 is refused
+        code = int(digits, 16) if self._HEX4.fullmatch(digits) else -1
+        if code in self.BASE64_CHARS:
+            self.sink.write(bytes((code,)))
+        elif code not in self.WHITESPACE:
+            raise ValueError("Invalid \\u escape in file_content")
+
+    def feed(self, chunk: bytes):
+        i = 0
+        n = len(chunk)
+        while i < n:
+            state = self._state
+            if state in ("key", "value"):
+                streamed = state == "value" and self._key == self.STREAMED_FIELD
+                if self._unicode is not None:
+                    take = chunk[i:i + 4 - len(self._unicode)]
+                    self._unicode += take
+                    i += len(take)
+                    if len(self._unicode) == 4:
+                        self._write_unicode_escape(self._unicode)
+                        self._unicode = None
+                    continue
+                if self._escape:
+                    self._escape = False
+                    if streamed:
+                        # base64 needs "\/" and \uXXXX; \n \r \t are whitespace; nothing else fits
+                        escape = chunk[i:i + 1]
+                        if escape == b"/":
+                            self.sink.write(b"/")
+                        elif escape == b"u":
+                            self._unicode = b""
+                        elif escape not in (b"n", b"r", b"t"):
+                            raise ValueError("Invalid escape in file_content")
+                    else:
+                        self._buf += chunk[i:i + 1]
+                    i += 1
+                    continue
+                q = chunk.find(b'"', i)
+                b = chunk.find(b"\\", i)
+                stop = min(x for x in (q, b, n) if x != -1)
+                if streamed:
+                    self.sink.write(chunk[i:stop])
+                else:
+                    self._buf += chunk[i:stop]
+                    if len(self._buf) > self.MAX_FIELD_BYTES:
+                        raise ValueError("Field too long")
+                if stop == n:
+                    return
+                if stop == b:
+                    self._escape = True
+                    if not streamed:
+                        self._buf += b"\\"
+                    i = stop + 1
+                    continue
+                i = stop + 1
+                self._end_string()
+                continue
+            c = chunk[i:i + 1]
+            i += 1
+            if c in b" \t\r\n":
+                continue
+            if state == "start" and c == b"{":
+                self._state = "next"
+            elif state == "next" and c == b'"':
+                self._state = "key"
+            elif state == "next" and c in b",":
+                pass
+            elif state == "next" and c == b"}":
+                self._state = "end"
+            elif state == "colon" and c == b":":
+                self._state = "open"
+            elif state == "open" and c == b'"':
+                self._state = "value"
+            else:
+                raise ValueError("Expected a JSON object of string fields")
+
+    def _end_string(self):
+        text = json.loads(b'"' + self._buf + b'"')
+        self._buf = b""
+        if self._state == "key":
+            self._key = text
+            self._state = "colon"
+        else:
+            if self._key != self.STREAMED_FIELD:
+                self.fields[self._key] = text
+            else:
+                self.fields[self._key] = True
+            self._state = "next"
+
+    def close(self) -> Dict[str, Any]:
+        if self._state != "end":
+            raise ValueError("Incomplete JSON body")
+        self.sink.close()
+        return self.fields
+
+@app.post(
+    "/document-analyze",
+    openapi_extra={"requestBody": {"required": True, "content": {"application/json": {"schema": DocumentQuery.model_json_schema()}}}}
+)
+async def analyze_document(request: Request, index: bool = False):
+    """
+    Analyze financial PDF documents sent as base64 JSON (DocumentQuery)
+    Shares the real analysis pipeline with /document-analyze-upload (including ?index=true)
+    """
+    # Oversize bodies are already refused by BodySizeLimitMiddleware; the decoded size is enforced below
+    fd, path = tempfile.mkstemp(suffix=".pdf", prefix="verifin-")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            parser = DocumentBodyParser(Base64FileSink(out, DOCUMENT_MAX_BYTES))
+            try:
+                async for chunk in request.stream():
+                    parser.feed(chunk)
+                fields = parser.close()
+            except DocumentTooLarge:
+                raise HTTPException(status_code=413, detail=f"Document exceeds {DOCUMENT_MAX_BYTES // (1024 * 1024)}MB limit")
+            except (ValueError, binascii.Error) as e:
+                raise HTTPException(status_code=422, detail=f"Invalid document body: {e}")
+
+        if not fields.get("file_content") or not isinstance(fields.get("filename"), str):
+            raise HTTPException(status_code=422, detail="Both file_content and filename are required")
+        if parser.sink.size == 0:
+            raise HTTPException(status_code=422, detail="file_content is empty")
+
+        loop = asyncio.get_running_loop()
+        return FastJSONResponse(await loop.run_in_executor(None, run_document_analysis, path, fields["filename"], None, index))
         
+    except HTTPException:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.exception("Error analyzing document: %s", e)
+        raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
+    finally:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
 
 # ==================== STARTUP ====================
 if __name__ == "__main__":
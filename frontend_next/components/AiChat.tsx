@@ -19,6 +19,7 @@ export default function AiChat() {
     ])
     const [input, setInput] = useState('')
     const [loading, setLoading] = useState(false)
+    const sessionId = useRef<string | undefined>(undefined)
     const messagesEndRef = useRef<HTMLDivElement>(null)
 
     const scrollToBottom = () => {
@@ -47,9 +48,10 @@ export default function AiChat() {
         setLoading(true)
 
         try {
-            const response = await apiClient.chat(userMessage) as any
+            const response = await apiClient.chat(userMessage, undefined, sessionId.current) as any
 
             if (response.success && response.response) {
+                sessionId.current = response.session_id
                 setMessages(prev => [...prev, {
                     role: 'assistant',
                     content: response.response,
@@ -6,6 +6,13 @@ import { LineChart, Line, BarChart, Bar, XAxis, YAxis, CartesianGrid, Tooltip, L
 import jsPDF from 'jspdf'
 import html2canvas from 'html2canvas'
 
+// Only the overview fields this view renders (skips raw *_value duplicates, key_metrics, placeholders)
+const OVERVIEW_FIELDS = [
+    'name', 'sector', 'industry', 'type', 'logo', 'currency', 'price', 'change', 'change_pct',
+    'marketCap', 'volume', 'pe_ratio', 'dividend_yield', '52_week_high', '52_week_low',
+    'description', 'employees', 'historical_data', 'long_term_outlook',
+]
+
 interface CompanyOverviewProps {
     company?: any
 }
@@ -74,7 +81,7 @@ export default function CompanyOverview({ company }: CompanyOverviewProps) {
         setData(null)
 
         try {
-            const response = await apiClient.getCompanyOverview(searchQuery)
+            const response = await apiClient.getCompanyOverview(searchQuery, OVERVIEW_FIELDS)
 
             if (response.success) {
                 setData(response.data)
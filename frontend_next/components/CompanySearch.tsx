@@ -1,6 +1,6 @@
 'use client'
 
-import { useState } from 'react'
+import { useEffect, useRef, useState } from 'react'
 import { apiClient } from '@/lib/api'
 
 interface CompanySearchProps {
@@ -12,6 +12,26 @@ export default function CompanySearch({ onCompanySelect }: CompanySearchProps) {
     const [loading, setLoading] = useState(false)
     const [result, setResult] = useState<any>(null)
     const [error, setError] = useState('')
+    const [suggestions, setSuggestions] = useState<any[]>([])
+    const picked = useRef('')
+
+    // Typeahead: ask for suggestions once typing pauses; stale responses are dropped
+    useEffect(() => {
+        const q = query.trim()
+        if (!q || q === picked.current) {
+            setSuggestions([])
+            return
+        }
+        let cancelled = false
+        const timer = setTimeout(async () => {
+            const response: any = await apiClient.searchCompanies(q)
+            if (!cancelled) setSuggestions(response.results || [])
+        }, 120)
+        return () => {
+            cancelled = true
+            clearTimeout(timer)
+        }
+    }, [query])
 
     const handleSearch = async (e: React.FormEvent) => {
         e.preventDefault()
@@ -24,6 +44,7 @@ export default function CompanySearch({ onCompanySelect }: CompanySearchProps) {
         setLoading(true)
         setError('')
         setResult(null)
+        setSuggestions([])
 
         try {
             const response = await apiClient.resolveCompany(query)
@@ -72,6 +93,28 @@ export default function CompanySearch({ onCompanySelect }: CompanySearchProps) {
                         {loading ? '⏳ Searching...' : '🔍 Search'}
                     </button>
                 </div>
+
+                {/* Typeahead suggestions */}
+                {suggestions.length > 0 && !loading && (
+                    <ul className="mt-2 rounded-xl bg-white/10 border border-white/20 overflow-hidden">
+                        {suggestions.map((company) => (
+                            <li key={company.ticker}>
+                                <button
+                                    type="button"
+                                    onClick={() => {
+                                        picked.current = company.name
+                                        setQuery(company.name)
+                                        setSuggestions([])
+                                    }}
+                                    className="w-full flex justify-between px-6 py-2 text-left text-white hover:bg-white/20 transition-all"
+                                >
+                                    <span>{company.name}</span>
+                                    <span className="text-gray-400 text-sm">{company.ticker}</span>
+                                </button>
+                            </li>
+                        ))}
+                    </ul>
+                )}
             </form>
 
             {/* Error Message */}
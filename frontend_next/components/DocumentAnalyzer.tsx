@@ -1,6 +1,6 @@
 'use client'
 
-import { useState } from 'react'
+import { useEffect, useRef, useState } from 'react'
 import jsPDF from 'jspdf'
 import html2canvas from 'html2canvas'
 import { apiClient, API_BASE } from '@/lib/api'
@@ -11,6 +11,11 @@ export default function DocumentAnalyzer() {
     const [analysis, setAnalysis] = useState<any>(null)
     const [error, setError] = useState('')
     const [downloading, setDownloading] = useState(false)
+    const [stage, setStage] = useState<string | null>(null)
+    const eventsRef = useRef<EventSource | null>(null)
+
+    // Close any open job stream when the component unmounts
+    useEffect(() => () => eventsRef.current?.close(), [])
 
     const handleFileChange = (e: React.ChangeEvent<HTMLInputElement>) => {
         if (e.target.files && e.target.files[0]) {
@@ -34,27 +39,66 @@ export default function DocumentAnalyzer() {
         setLoading(true)
         setError('')
         setAnalysis(null)
+        setStage(null)
 
         try {
+            // Submit a background job, then follow its progress
             const formData = new FormData()
             formData.append('file', file)
 
-            const response = await fetch(`${API_BASE}/document-analyze-upload`, {
+            const response = await fetch(`${API_BASE}/document-analyze-jobs`, {
                 method: 'POST',
                 body: formData
             })
-
-            const data = await response.json()
-
-            if (data.success) {
-                setAnalysis(data)
-            } else {
-                setError(data.detail || 'Analysis failed')
+            const job = await response.json()
+            if (!response.ok) {
+                throw new Error(job.detail || 'Failed to submit document')
             }
+            finishJob(await followJob(job))
         } catch (err: any) {
             setError(err.message || 'Failed to analyze document')
         } finally {
             setLoading(false)
+            setStage(null)
+        }
+    }
+
+    const finishJob = (job: any) => {
+        if (job.status === 'done' && job.result?.success) {
+            setAnalysis(job.result)
+        } else {
+            setError(job.error || job.result?.detail || 'Analysis failed')
+        }
+    }
+
+    // Final job record from the SSE stream, falling back to polling if the stream fails
+    const followJob = (job: any): Promise<any> => new Promise((resolve, reject) => {
+        eventsRef.current?.close()
+        const events = new EventSource(`${API_BASE}${job.events_url}`)
+        eventsRef.current = events
+        events.addEventListener('progress', (e) => setStage(JSON.parse((e as MessageEvent).data).stage))
+        events.addEventListener('result', (e) => {
+            events.close()
+            resolve(JSON.parse((e as MessageEvent).data))
+        })
+        events.onerror = () => {
+            events.close()
+            pollJob(job.status_url).then(resolve, reject)
+        }
+    })
+
+    const pollJob = async (statusUrl: string): Promise<any> => {
+        while (true) {
+            const response = await fetch(`${API_BASE}${statusUrl}`)
+            const job = await response.json()
+            if (!response.ok) {
+                throw new Error(job.detail || 'Analysis job not found')
+            }
+            if (job.status === 'done' || job.status === 'failed') {
+                return job
+            }
+            setStage(job.stage)
+            await new Promise((r) => setTimeout(r, 2000))
         }
     }
 
@@ -172,7 +216,11 @@ export default function DocumentAnalyzer() {
                 <div className="glass rounded-2xl p-12 text-center">
                     <div className="w-16 h-16 border-4 border-purple-500 border-t-transparent rounded-full animate-spin mx-auto mb-6"></div>
                     <div className="text-xl font-semibold text-white mb-2">Analyzing Document...</div>
-                    <p className="text-gray-400 text-sm">Extracting text, financial data, and insights</p>
+                    <p className="text-gray-400 text-sm">
+                        {stage === 'llm' ? 'Generating AI insights'
+                            : stage === 'score' ? 'Scoring and indexing the document'
+                            : 'Extracting text, financial data, and insights'}
+                    </p>
                 </div>
             )}
 
@@ -60,12 +60,18 @@ class ApiClient {
         })
     }
 
-    // Company overview
-    async getCompanyOverview(query: string) {
-        return this.request('/company-overview', {
-            method: 'POST',
-            body: JSON.stringify({ query }),
-        })
+    // Typeahead suggestions (ranked by prefix, then fuzzy match)
+    async searchCompanies(q: string, limit = 8) {
+        const params = new URLSearchParams({ q, limit: String(limit) })
+        return this.request(`/search-companies?${params}`)
+    }
+
+    // Company overview (GET so the browser/CDN can revalidate with ETag)
+    // fields: optional sparse fieldset, e.g. ['price', 'change_pct', 'historical_data']
+    async getCompanyOverview(query: string, fields?: string[]) {
+        const params = new URLSearchParams({ query })
+        if (fields?.length) params.set('fields', fields.join(','))
+        return this.request(`/company-overview?${params}`)
     }
 
     // Company comparison
@@ -76,11 +82,11 @@ class ApiClient {
         })
     }
 
-    // AI Chat
-    async chat(message: string, context?: any) {
+    // AI Chat (pass the session_id from the previous reply to continue the conversation)
+    async chat(message: string, context?: any, sessionId?: string) {
         return this.request('/chat', {
             method: 'POST',
-            body: JSON.stringify({ message, context }),
+            body: JSON.stringify({ message, context, session_id: sessionId }),
         })
     }
 